@@ -0,0 +1,160 @@
+"""
+Minimal AVI muxer for MJPEG video.
+
+Lets us store the JPEG frames the USB camera already produces without
+decoding and re-encoding them. The file layout is a plain AVI 1.0 file:
+
+RIFF 'AVI '
+    LIST 'hdrl'
+        'avih' main header
+        LIST 'strl'
+            'strh' stream header ('vids', 'MJPG')
+            'strf' BITMAPINFOHEADER
+    LIST 'movi'
+        '00dc' one chunk per JPEG frame
+    'idx1' one 16 byte entry per frame
+
+The headers have a fixed size, so the frame counts and sizes are written
+as zero first and patched in by release(). AVI 1.0 sizes are 32 bit, which
+limits a segment to 4 GB, far above a 15 minute segment at 800x600.
+"""
+
+import struct
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+# Offsets of the fields patched on release, relative to the start of the file
+RIFF_SIZE_OFFSET = 4
+AVIH_OFFSET = 32  # 'RIFF' size 'AVI ' 'LIST' size 'hdrl' 'avih' size
+STRH_OFFSET = AVIH_OFFSET + 56 + 20  # after avih, 'LIST' size 'strl' 'strh' size
+HEADER_SIZE = STRH_OFFSET + 56 + 8 + 40  # strh, 'strf' size, BITMAPINFOHEADER
+MOVI_LIST_OFFSET = HEADER_SIZE
+MOVI_DATA_OFFSET = MOVI_LIST_OFFSET + 12  # 'LIST' size 'movi'
+CHUNK_HEADER_SIZE = 8
+
+
+def build_header(width, height, framerate, frames=0, max_frame_size=0, movi_size=4, riff_size=0):
+    """Everything up to and including the 'movi' list header"""
+    avih = struct.pack("<10I4I",
+                       int(1000000 / framerate),  # dwMicroSecPerFrame
+                       int(max_frame_size * framerate),  # dwMaxBytesPerSec
+                       0,  # dwPaddingGranularity
+                       AVIF_HASINDEX,  # dwFlags
+                       frames,  # dwTotalFrames
+                       0,  # dwInitialFrames
+                       1,  # dwStreams
+                       max_frame_size,  # dwSuggestedBufferSize
+                       width, height,
+                       0, 0, 0, 0)
+    strh = struct.pack("<4s4sIHHIIIIIIiI4h",
+                       b'vids', b'MJPG',
+                       0,  # dwFlags
+                       0, 0,  # wPriority, wLanguage
+                       0,  # dwInitialFrames
+                       1000, int(framerate * 1000),  # dwScale, dwRate, so fractional rates work
+                       0,  # dwStart
+                       frames,  # dwLength
+                       max_frame_size,  # dwSuggestedBufferSize
+                       -1,  # dwQuality
+                       0,  # dwSampleSize
+                       0, 0, width, height)
+    strf = struct.pack("<IiiHH4sIiiII", 40, width, height, 1, 24, b'MJPG', width * height * 3, 0, 0, 0, 0)
+    strl = b'strl' + b'strh' + struct.pack("<I", len(strh)) + strh + b'strf' + struct.pack("<I", len(strf)) + strf
+    hdrl = b'hdrl' + b'avih' + struct.pack("<I", len(avih)) + avih + b'LIST' + struct.pack("<I", len(strl)) + strl
+    header = b'RIFF' + struct.pack("<I", riff_size) + b'AVI ' + b'LIST' + struct.pack("<I", len(hdrl)) + hdrl
+    header += b'LIST' + struct.pack("<I", movi_size) + b'movi'
+    assert len(header) == MOVI_DATA_OFFSET
+    return header
+
+
+def index_entry(offset, size):
+    """idx1 entry of the frame whose chunk header is at offset"""
+    # idx1 offsets are relative to the 'movi' fourcc
+    return struct.pack("<4sIII", b'00dc', AVIIF_KEYFRAME, offset - (MOVI_DATA_OFFSET - 4), size)
+
+
+class MjpegAviWriter:
+    def __init__(self, path, width, height, framerate, file=None):
+        """
+        Input: output path, frame size and rate, and optionally an already open binary file object to write to
+        """
+        self.path = path
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.file = file if file is not None else open(path, 'wb')
+        self.file.write(build_header(width, height, framerate))
+        self.position = MOVI_DATA_OFFSET
+        self.index = bytearray()
+        self.frames = 0
+        self.max_frame_size = 0
+
+    def write(self, frame):
+        """
+        Append one JPEG frame.
+        Input: bytes-like JPEG data
+        Returns: byte offset of the frame's chunk header in the file
+        """
+        size = len(frame)
+        offset = self.position
+        self.file.write(b'00dc' + struct.pack("<I", size))
+        self.file.write(frame)
+        padded = size + (size & 1)
+        if size & 1:
+            # Chunks are word aligned
+            self.file.write(b'\0')
+        self.index += index_entry(offset, size)
+        self.position += CHUNK_HEADER_SIZE + padded
+        self.frames += 1
+        if size > self.max_frame_size:
+            self.max_frame_size = size
+        return offset
+
+    def release(self):
+        """Write the index, patch the headers and close the file"""
+        if self.file is None:
+            return
+        self.file.write(b'idx1' + struct.pack("<I", len(self.index)))
+        self.file.write(self.index)
+        end = self.position + 8 + len(self.index)
+        header = build_header(self.width, self.height, self.framerate, self.frames, self.max_frame_size,
+                              movi_size=self.position - MOVI_LIST_OFFSET - 8, riff_size=end - 8)
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+        self.file = None
+
+
+def read_frames(path):
+    """
+    Iterate over the JPEG frames of an AVI file by walking the 'movi' chunks, without the index.
+    Returns: generator of (offset of the chunk header, frame bytes)
+    """
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:] != b'AVI ':
+            raise ValueError(F"{path} is not an AVI file")
+        # Find the movi list among the top level chunks
+        while True:
+            chunk = f.read(12)
+            if len(chunk) < 12:
+                return
+            fourcc, size, list_type = struct.unpack("<4sI4s", chunk)
+            if fourcc == b'LIST' and list_type == b'movi':
+                movi_end = f.tell() - 4 + size
+                break
+            f.seek(size - 4 + (size & 1), 1)
+        while f.tell() + CHUNK_HEADER_SIZE <= movi_end:
+            offset = f.tell()
+            chunk = f.read(CHUNK_HEADER_SIZE)
+            if len(chunk) < CHUNK_HEADER_SIZE:
+                return
+            fourcc, size = struct.unpack("<4sI", chunk)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            if size & 1:
+                f.seek(1, 1)
+            if fourcc[2:] == b'dc':
+                yield offset, data
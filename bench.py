@@ -0,0 +1,946 @@
+"""
+Benchmarks for the recording device that run without any camera hardware.
+
+Usage:
+    python bench.py [preview_ipc] [state] [buttons] [rotation] [record] [preview_latency] [motion] [counting] [writeback] [recovery]
+                    [--seconds 5] [--directory DIR] [--json FILE] [--compare FILE]
+
+Each benchmark prints one line per configuration. With --json every run is
+appended to a JSON lines file together with the git commit, and --compare
+prints each number next to the last run in such a file, so results can be
+compared between commits.
+
+rotation, record, preview_latency and motion run the real camera.py code on the
+cameras from fake_hardware.py, they need numpy and OpenCV and are skipped without them,
+as is counting, which runs the traffic counter on a synthetic road.
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from frame_ring import FrameRing
+import shared_state
+from shared_state import SharedState
+from telemetry import Telemetry, quantile
+
+# A high quality 800x600 JPEG from the day camera is around 60 KB
+PREVIEW_FRAME_SIZE = 60 * 1024
+PREVIEW_BENCH_FRAMERATE = 30.0
+
+
+def _preview_payload(size):
+    # Random bytes do not compress, so every frame has a realistic size
+    return bytearray(os.urandom(size))
+
+
+def _preview_producer(kind, channel, seconds, framerate, results):
+    payload = _preview_payload(PREVIEW_FRAME_SIZE)
+    interval = 1 / framerate
+    put_time = 0.0
+    frames = 0
+    next_time = time.perf_counter()
+    end_time = next_time + seconds
+    while next_time < end_time:
+        # Stamp the send time into the frame so the reader can measure latency
+        struct.pack_into("<d", payload, 0, time.perf_counter())
+        start = time.perf_counter()
+        if kind == "queue":
+            channel.put(bytes(payload))
+        else:
+            channel.write(payload)
+        put_time += time.perf_counter() - start
+        frames += 1
+        next_time += interval
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    results.put(("producer", frames, put_time))
+
+
+def _preview_consumer(kind, channel, seconds, read_delay, results):
+    received = 0
+    latency = 0.0
+    last_seq = 0
+    end_time = time.perf_counter() + seconds
+    while time.perf_counter() < end_time:
+        if kind == "queue":
+            try:
+                frame = channel.get(timeout=0.1)
+            except Exception:
+                continue
+        else:
+            last_seq, frame = channel.read_latest(last_seq)
+            if frame is None:
+                time.sleep(0.001)
+                continue
+        latency += time.perf_counter() - struct.unpack_from("<d", frame, 0)[0]
+        received += 1
+        if read_delay:
+            time.sleep(read_delay)
+    results.put(("consumer", received, latency))
+
+
+def bench_preview_ipc(seconds):
+    """Compare the old multiprocessing.Queue preview path with the shared memory ring"""
+    print(F"preview_ipc: {PREVIEW_FRAME_SIZE} byte frames at {PREVIEW_BENCH_FRAMERATE} fps for {seconds} s")
+    results = {}
+    for kind in ("queue", "ring"):
+        # A normal reader, and a slow phone that only manages 5 fps
+        for read_delay in (0.0, 0.2):
+            if kind == "queue":
+                channel = multiprocessing.Queue()
+            else:
+                channel = FrameRing.create(slot_count=4, slot_size=PREVIEW_FRAME_SIZE)
+            reports = multiprocessing.Queue()
+            producer = multiprocessing.Process(target=_preview_producer, args=(kind, channel, seconds, PREVIEW_BENCH_FRAMERATE, reports))
+            consumer = multiprocessing.Process(target=_preview_consumer, args=(kind, channel, seconds + 0.5, read_delay, reports))
+            consumer.start()
+            producer.start()
+            data = dict((name, (count, total)) for name, count, total in (reports.get(), reports.get()))
+            backlog = 0
+            if kind == "queue":
+                # Whatever is still queued is memory the web process would be holding on to.
+                # It has to be drained before joining, or the producer never exits.
+                while True:
+                    try:
+                        channel.get(timeout=0.5)
+                    except Exception:
+                        break
+                    backlog += 1
+            producer.join()
+            consumer.join()
+            sent, put_time = data["producer"]
+            received, latency = data["consumer"]
+            channel.close()
+            if kind == "ring":
+                channel.unlink()
+            print(F"  {kind:5s} reader_delay={read_delay:.1f}s sent={sent} received={received} "
+                  F"backlog={backlog} ({backlog * PREVIEW_FRAME_SIZE / 1024 / 1024:.1f} MB) "
+                  F"put={put_time / max(sent, 1) * 1e6:.1f} us/frame "
+                  F"latency={latency / max(received, 1) * 1e3:.2f} ms")
+            results[F"{kind}_delay_{read_delay:.1f}"] = {
+                'received': received,
+                'backlog_frames': backlog,
+                'put_us': put_time / max(sent, 1) * 1e6,
+                'latency_ms': latency / max(received, 1) * 1e3,
+            }
+    return results
+
+
+def _rate(operation, seconds):
+    """Run operation in a loop for about the given time, returns operations per second"""
+    count = 0
+    start = time.perf_counter()
+    end_time = start + seconds
+    while True:
+        for _ in range(100):
+            operation()
+        count += 100
+        now = time.perf_counter()
+        if now >= end_time:
+            return count / (now - start)
+
+
+def _state_writer(state, stop):
+    # Keeps the writer lock and the version counter busy like the camera process would
+    value = 0.0
+    while not stop.is_set():
+        state['recording_duration'] = value
+        value += 1
+
+
+def bench_state(seconds):
+    """Reads, writes and /status snapshots per second, Manager dict against the shared memory state"""
+    print(F"state: {seconds} s per operation")
+    manager = multiprocessing.Manager()
+    managed = manager.dict(shared_state.defaults())
+    shared = SharedState.create()
+    results = {}
+    for name, state in (("manager", managed), ("shared", shared)):
+        # Measured while another process is writing to the same state
+        stop = multiprocessing.Event()
+        writer = multiprocessing.Process(target=_state_writer, args=(state, stop))
+        writer.start()
+        reads = _rate(lambda: state['recording'], seconds / 3)
+        writes = _rate(lambda: state.__setitem__('sd_use', 1.0), seconds / 3)
+        copies = _rate(lambda: state.copy(), seconds / 3)
+        stop.set()
+        writer.join()
+        print(F"  {name:7s} reads={reads:12,.0f}/s writes={writes:12,.0f}/s snapshots={copies:10,.0f}/s")
+        results[name] = {'reads_per_s': reads, 'writes_per_s': writes, 'snapshots_per_s': copies}
+    manager.shutdown()
+    shared.close()
+    shared.unlink()
+    return results
+
+
+BUTTON_PRESSES = 20
+# main.py's RECORDING_BTN_PIN
+BUTTON_BENCH_PIN = 22
+# Contact bounces on every press and every release, 1 ms apart
+BUTTON_BOUNCES = 5
+# Longest a press may take from its last bounce to waking up a wait_for_change() on the shared state
+BUTTON_LATENCY_LIMIT = 0.1
+
+
+def _bounce(gpio, pin, level):
+    """Drive pin to level through BUTTON_BOUNCES contact bounces, returns the time of the last edge"""
+    for _ in range(BUTTON_BOUNCES):
+        gpio.set_input(pin, level)
+        time.sleep(0.001)
+        gpio.set_input(pin, gpio.HIGH if level == gpio.LOW else gpio.LOW)
+        time.sleep(0.001)
+    gpio.set_input(pin, level)
+    return time.monotonic()
+
+
+def bench_buttons(seconds):
+    """Bouncing presses of the record button through controls.ButtonWatcher into the shared state, like main.py"""
+    import controls
+    import fake_hardware
+    gpio = fake_hardware.gpio
+    print(F"buttons: {BUTTON_PRESSES} presses with {BUTTON_BOUNCES} bounces on press and on release, "
+          F"{controls.BUTTON_SETTLE_TIME * 1e3:.0f} ms settle time")
+    state = SharedState.create()
+    toggles = []
+
+    def toggle_recording():
+        toggles.append(time.monotonic())
+        state['should_record'] = not state['should_record']
+
+    gpio.setup(BUTTON_BENCH_PIN, gpio.IN, pull_up_down=gpio.PUD_UP)
+    buttons = controls.ButtonWatcher(gpio)
+    buttons.watch(BUTTON_BENCH_PIN, toggle_recording)
+    latencies = []
+    errors = []
+    try:
+        for press in range(BUTTON_PRESSES):
+            version = state.version()
+            last_edge = _bounce(gpio, BUTTON_BENCH_PIN, gpio.LOW)
+            version = state.wait_for_change(version, BUTTON_LATENCY_LIMIT * 10)
+            latencies.append(time.monotonic() - last_edge)
+            _bounce(gpio, BUTTON_BENCH_PIN, gpio.HIGH)
+            # Neither the release nor a late bounce may count as another press
+            state.wait_for_change(version, controls.BUTTON_SETTLE_TIME * 5)
+            if len(toggles) != press + 1 or state['should_record'] != (press % 2 == 0):
+                errors.append(F"press {press + 1} toggled should_record {len(toggles) - press} times")
+                break
+    finally:
+        buttons.close()
+        gpio.remove_event_detect(BUTTON_BENCH_PIN)
+        state.close()
+        state.unlink()
+    latencies.sort()
+    result = {
+        'toggles': len(toggles),
+        'latency_p50_ms': _percentile(latencies, 0.5) * 1e3,
+        'latency_max_ms': latencies[-1] * 1e3,
+    }
+    print(F"  toggles={result['toggles']} press_to_wakeup_p50={result['latency_p50_ms']:.1f} ms "
+          F"max={result['latency_max_ms']:.1f} ms")
+    if latencies[-1] > BUTTON_LATENCY_LIMIT:
+        errors.append(F"a press took {latencies[-1] * 1e3:.1f} ms to reach the shared state")
+    if errors:
+        raise SystemExit(F"button check failed: {'; '.join(errors)}")
+    return result
+
+
+ROTATIONS = 1000
+# The fake cameras deliver a frame every millisecond and segments rotate after 4 ms,
+# so the next segment is being opened on the rotator's thread while frames keep coming
+ROTATION_FRAMERATE = 1000
+ROTATION_SEGMENT_LENGTH = 0.004
+
+
+def _rotation_run(camera, night, directory):
+    """
+    Record through one camera's real path, DayCam or RotatingOutput.outputframe, until ROTATIONS segments were rotated
+    Returns: (SegmentInfo of every closed segment, FrameRecords from frames.idx, Telemetry)
+    """
+    import fake_hardware
+    import frame_index
+    metrics = Telemetry()
+    camera.metrics = metrics
+    camera.segments = []
+    camera.SEGMENT_LENGTH = ROTATION_SEGMENT_LENGTH
+    camera.recording_index = frame_index.FrameIndexWriter(os.path.join(directory, frame_index.INDEX_NAME))
+    if night:
+        camera.night_metrics = (metrics.metric('night_frames_captured'), metrics.metric('night_frames_written'),
+                                metrics.metric('night_write_seconds'))
+        camera.night_cam = camera.Picamera2()
+        camera.night_cam.configure(camera.night_cam.create_video_configuration(main={"size": camera.RESOLUTION},
+                                                                               controls={"FrameRate": ROTATION_FRAMERATE}))
+        camera.night_cam.start()
+        camera.encoder = camera.MJPEGEncoder()
+    else:
+        camera.day_cam = camera.DayCam(0, camera.RESOLUTION, camera.RECORD_FRAMERATE, passthrough=True, metrics=metrics)
+        camera.day_cam.start_capture()
+    camera.start_segments(night, directory, 1, 0)
+    rotator = camera.recording_rotator
+    while rotator.number <= ROTATIONS:
+        time.sleep(0.01)
+    camera.stop_segments(night)
+    if night:
+        camera.night_cam.stop()
+    else:
+        camera.day_cam.stop_capture()
+    camera.recording_index.close()
+    closed = sorted(rotator.closed_segments, key=lambda info: info.number)
+    return closed, list(frame_index.FrameIndex(os.path.join(directory, frame_index.INDEX_NAME))), metrics
+
+
+def _rotation_errors(directory, closed, records):
+    """Every way the segments and frames.idx disagree with an unbroken recording, an empty list if they don't"""
+    import avi
+    errors = []
+    if [info.number for info in closed] != list(range(1, len(closed) + 1)):
+        errors.append("segment numbers are not contiguous")
+    if len(closed) <= ROTATIONS:
+        errors.append(F"only {len(closed) - 1} of {ROTATIONS} rotations done")
+    if [record.frame_id for record in records] != list(range(len(records))):
+        errors.append("frame ids in frames.idx are not contiguous")
+    by_segment = {}
+    for record in records:
+        by_segment.setdefault(record.segment, []).append(record)
+    for info in closed:
+        segment_records = by_segment.pop(info.number, [])
+        if [record.frame_id for record in segment_records] != list(range(info.first_frame, info.first_frame + info.frames)):
+            errors.append(F"frames.idx does not hold the frames of segment {info.number}")
+        offsets = [offset for offset, _ in avi.read_frames(os.path.join(directory, F"video_{info.number}.avi"))]
+        if offsets != [record.offset for record in segment_records]:
+            errors.append(F"video_{info.number}.avi does not hold the frames indexed for it")
+    if by_segment:
+        errors.append(F"frames.idx points into segments that were never closed: {sorted(by_segment)}")
+    return errors
+
+
+def bench_rotation(seconds):
+    """
+    Rotate each camera's real recording path through ROTATIONS short segments and check
+    from frames.idx and the segments themselves that no frame is lost, duplicated or misplaced
+    """
+    camera = _fake_camera_module(ROTATION_FRAMERATE)
+    if camera is None:
+        print("rotation: skipped, needs numpy and OpenCV")
+        return None
+    import fake_hardware
+    print(F"rotation: {ROTATIONS} rotations of {ROTATION_SEGMENT_LENGTH * 1e3:.0f} ms segments at {ROTATION_FRAMERATE} fps per camera")
+    saved = (fake_hardware.config['framerate'], fake_hardware.config['source'], camera.WRITE_QUEUE_POLICY)
+    fake_hardware.config['framerate'] = ROTATION_FRAMERATE
+    # Bare frames keep thousands of segments small, and a full queue holds capture back instead of dropping
+    fake_hardware.config['source'] = fake_hardware.SyntheticSource(camera.RESOLUTION[0], camera.RESOLUTION[1], frame_size=0)
+    camera.WRITE_QUEUE_POLICY = 'block'
+    results = {}
+    try:
+        for label, night in (("day", False), ("night", True)):
+            directory = tempfile.mkdtemp(prefix="bwct_bench_")
+            try:
+                start = time.monotonic()
+                closed, records, metrics = _rotation_run(camera, night, directory)
+                elapsed = time.monotonic() - start
+                errors = _rotation_errors(directory, closed, records)
+            finally:
+                shutil.rmtree(directory)
+            write_seconds = metrics.snapshot()[F"{label}_write_seconds"]['buckets']
+            rotation_gaps = [b.timestamp - a.timestamp for a, b in zip(records, records[1:]) if a.segment != b.segment]
+            result = {
+                'segments': len(closed),
+                'frames': len(records),
+                'rotations_per_s': (len(closed) - 1) / elapsed,
+                'write_p99_ms': (quantile(write_seconds, 0.99) or float('inf')) * 1e3,
+                'rotation_gap_max_ms': max(rotation_gaps, default=0) * 1e3,
+            }
+            print(F"  {label:6s} segments={result['segments']} frames={result['frames']} "
+                  F"rotations={result['rotations_per_s']:.0f}/s write_p99<={result['write_p99_ms']:.1f} ms "
+                  F"rotation_gap_max={result['rotation_gap_max_ms']:.1f} ms errors={len(errors)}")
+            # This is the rotation test as well, any lost, duplicated or misplaced frame fails the run with exit status 1
+            if errors:
+                raise SystemExit(F"rotation check failed for the {label} camera: {'; '.join(errors[:5])}")
+            results[label] = result
+    finally:
+        fake_hardware.config['framerate'], fake_hardware.config['source'], camera.WRITE_QUEUE_POLICY = saved
+    return results
+
+
+def _fake_camera_module(framerate):
+    """camera.py running on fake_hardware, None if numpy or OpenCV are not installed"""
+    if importlib.util.find_spec("numpy") is None or importlib.util.find_spec("cv2") is None:
+        return None
+    import fake_hardware
+    fake_hardware.install(framerate=framerate)
+    import camera
+    return camera
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+
+# Short segments, so a run of a few seconds goes through several rotations
+RECORD_BENCH_SEGMENT_LENGTH = 1.0
+
+
+def _record_run(camera, framerate, seconds, directory, scene_script=None):
+    import fake_hardware
+    import frame_index
+    fake_hardware.config['framerate'] = framerate
+    metrics = Telemetry()
+    day_cam = camera.DayCam(0, camera.RESOLUTION, camera.RECORD_FRAMERATE, passthrough=True, metrics=metrics)
+    camera.day_cam = day_cam
+    camera.metrics = metrics
+    camera.segments = []
+    camera.SEGMENT_LENGTH = RECORD_BENCH_SEGMENT_LENGTH
+    camera.recording_index = frame_index.FrameIndexWriter(os.path.join(directory, frame_index.INDEX_NAME))
+    day_cam.start_capture()
+    start = time.monotonic()
+    camera.start_segments(False, directory, 1, 0)
+    if scene_script is not None:
+        scene_script(start, seconds)
+    else:
+        time.sleep(seconds)
+    camera.stop_segments(False)
+    elapsed = time.monotonic() - start
+    day_cam.stop_capture()
+    camera.recording_index.close()
+
+    snapshot = metrics.snapshot()
+    index = frame_index.FrameIndex(os.path.join(directory, frame_index.INDEX_NAME))
+    records = list(index)
+    intervals = [b.timestamp - a.timestamp for a, b in zip(records, records[1:])]
+    # Capture time gap between the last frame of a segment and the first frame of the next one
+    rotation_gaps = [b.timestamp - a.timestamp for a, b in zip(records, records[1:]) if a.segment != b.segment]
+    written = int(snapshot['day_frames_written'])
+    # Frames dropped or skipped still use up their ids, every frame id is either in the index or accounted for
+    frame_ids = [record.frame_id for record in records]
+    unwritten = int(snapshot['write_queue_dropped'] + snapshot['motion_skipped'])
+    contiguous = frame_ids == sorted(set(frame_ids)) and (not records or records[-1].frame_id + 1 <= len(records) + unwritten)
+    return {
+        'captured': int(snapshot['day_frames_captured']),
+        'written': written,
+        'dropped': int(snapshot['write_queue_dropped']),
+        'written_fps': written / elapsed,
+        'write_p50_ms': quantile(snapshot['day_write_seconds']['buckets'], 0.5) * 1e3,
+        'write_p99_ms': (quantile(snapshot['day_write_seconds']['buckets'], 0.99) or float('inf')) * 1e3,
+        'segments': len(camera.segments),
+        'indexed': len(records),
+        'index_contiguous': contiguous,
+        'frame_interval_p50_ms': (_percentile(intervals, 0.5) or 0) * 1e3,
+        'rotation_gap_max_ms': max(rotation_gaps, default=0) * 1e3,
+        'bytes': sum(os.path.getsize(path) for path in camera.segments),
+        'records': records,
+    }
+
+
+def bench_record(seconds, directory=None):
+    """Sustained day camera recording through the real DayCam, rotator, AVI writer and frame index"""
+    camera = _fake_camera_module(20)
+    if camera is None:
+        print("record: skipped, needs numpy and OpenCV")
+        return None
+    print(F"record: {camera.RESOLUTION[0]}x{camera.RESOLUTION[1]} passthrough, {RECORD_BENCH_SEGMENT_LENGTH:.0f} s segments, "
+          F"{seconds} s per run into {directory or tempfile.gettempdir()}")
+    results = {}
+    # The camera's real rate, then as fast as the writer keeps up to find the sustained ceiling
+    for label, framerate in (("realtime", camera.RECORD_FRAMERATE), ("max", 0)):
+        run_directory = tempfile.mkdtemp(prefix="bwct_bench_", dir=directory)
+        try:
+            result = _record_run(camera, framerate, seconds, run_directory)
+        finally:
+            shutil.rmtree(run_directory)
+        print(F"  {label:8s} captured={result['captured']} written={result['written']} dropped={result['dropped']} "
+              F"written_fps={result['written_fps']:.1f} write_p50<={result['write_p50_ms']:.1f} ms "
+              F"write_p99<={result['write_p99_ms']:.1f} ms segments={result['segments']} "
+              F"frame_interval_p50={result['frame_interval_p50_ms']:.1f} ms "
+              F"rotation_gap_max={result['rotation_gap_max_ms']:.1f} ms")
+        if result['indexed'] != result['written'] or not result['index_contiguous']:
+            raise SystemExit("the frame index does not match the frames written")
+        del result['records']
+        results[label] = result
+    return results
+
+
+def bench_motion(seconds):
+    """Motion gated day camera recording of a scene that only moves for a tenth of the time"""
+    camera = _fake_camera_module(20)
+    if camera is None:
+        print("motion: skipped, needs numpy and OpenCV")
+        return None
+    import fake_hardware
+    import motion
+    # Still, then flickering between two levels (every pixel changes) for a tenth of the run, then still.
+    # Pre- and post-roll are recorded too, so longer runs show the saving better.
+    active = (0.45 * seconds, 0.55 * seconds)
+
+    def scene_script(start, seconds):
+        while time.monotonic() - start < seconds:
+            now = time.monotonic() - start
+            moving = active[0] <= now < active[1]
+            fake_hardware.scene.level = 128 + (80 if moving and int(now * 10) % 2 else 0)
+            time.sleep(0.01)
+        fake_hardware.scene.level = 128
+
+    print(F"motion: {seconds} s, moving from {active[0]:.1f} to {active[1]:.1f} s, idle rate {motion.IDLE_FRAMERATE} fps, "
+          F"pre-roll {motion.PRE_ROLL} s, post-roll {motion.POST_ROLL} s")
+    results = {}
+    for label, gating in (("ungated", False), ("gated", True)):
+        camera.MOTION_GATING = gating
+        run_directory = tempfile.mkdtemp(prefix="bwct_bench_")
+        try:
+            result = _record_run(camera, camera.RECORD_FRAMERATE, seconds, run_directory, scene_script)
+        finally:
+            shutil.rmtree(run_directory)
+            camera.MOTION_GATING = False
+        records = result.pop('records')
+        first = records[0].timestamp - records[0].frame_id / camera.RECORD_FRAMERATE if records else 0
+        # Every frame from the pre-roll before the motion to the post-roll after it has to be there
+        window = [record for record in records
+                  if active[0] - motion.PRE_ROLL + 0.2 <= record.timestamp - first <= active[1] + motion.POST_ROLL - 0.2]
+        window_complete = all(b.frame_id == a.frame_id + 1 for a, b in zip(window, window[1:]))
+        result['window_complete'] = window_complete
+        print(F"  {label:8s} captured={result['captured']} written={result['written']} "
+              F"last id={records[-1].frame_id if records else None} bytes={result['bytes']} "
+              F"active window complete={window_complete} index ok={result['index_contiguous']}")
+        if result['indexed'] != result['written'] or not result['index_contiguous'] or not window_complete:
+            raise SystemExit("motion gating lost frames it should have kept or mixed up frame ids")
+        results[label] = result
+    results['storage_ratio'] = results['gated']['bytes'] / results['ungated']['bytes']
+    print(F"  gated recording is {results['storage_ratio'] * 100:.1f}% of the ungated size")
+    return results
+
+
+# Frame rate of the synthetic road, and seconds between two vehicles
+COUNTING_BENCH_FRAMERATE = 20
+COUNTING_BENCH_GAP = 3.0
+
+
+def _road_frames(numpy, seconds, width, height):
+    """
+    Synthetic road at the counter's frame size: vehicles alternately drive left to right in the upper lane
+    and right to left in the lower one, each taking COUNTING_BENCH_GAP seconds to cross.
+    Only whole vehicles are generated, at least one in each direction, so the run can take longer than seconds.
+    Returns: list of frames, expected (forward, backward) counts
+    """
+    rng = numpy.random.default_rng(1)
+    background = numpy.full((height, width), 90, numpy.uint8)
+    frames = []
+    expected = [0, 0]
+    gap_frames = int(COUNTING_BENCH_GAP * COUNTING_BENCH_FRAMERATE)
+    # The first gap lets the background model settle
+    vehicles = max(2, int(seconds * COUNTING_BENCH_FRAMERATE) // gap_frames - 1)
+    size = width // 10
+    for number in range((vehicles + 1) * gap_frames):
+        frame = background + rng.integers(0, 8, (height, width), dtype=numpy.uint8)
+        vehicle, progress = divmod(number, gap_frames)
+        if vehicle > 0:
+            x = int((width + size) * progress / gap_frames) - size
+            if vehicle % 2:
+                frame[height // 3:height // 3 + size // 2, max(x, 0):max(x + size, 0)] = 200
+            else:
+                frame[2 * height // 3:2 * height // 3 + size // 2, max(width - x - size, 0):max(width - x, 0)] = 30
+            # The centre passes the counting line in the middle of the frame, going the other way in the lower lane
+            previous_x = int((width + size) * (progress - 1) / gap_frames) - size
+            if progress > 0 and previous_x + size / 2 < width / 2 <= x + size / 2:
+                expected[0 if vehicle % 2 else 1] += 1
+        frames.append(frame)
+    return frames, tuple(expected)
+
+
+def bench_counting(seconds):
+    """Traffic counter speed and accuracy at full frame rate and shedding load by analysing every 2nd or 4th frame"""
+    camera = _fake_camera_module(20)
+    if camera is None:
+        print("counting: skipped, needs numpy and OpenCV")
+        return None
+    import numpy
+    import counting
+    width, height = camera.RESOLUTION[0] // camera.COUNTING_SCALE, camera.RESOLUTION[1] // camera.COUNTING_SCALE
+    frames, expected = _road_frames(numpy, seconds, width, height)
+    if min(expected) < 1:
+        raise SystemExit("the synthetic road has no vehicle in one of the directions")
+    print(F"counting: {width}x{height}, {len(frames)} frames, {expected[0]} forward and {expected[1]} backward vehicles, "
+          F"budget {counting.FRAME_BUDGET * 1e3:.0f} ms per frame")
+    results = {}
+    for stride in (1, 2, 4):
+        counter = counting.TrafficCounter()
+        times = []
+        for number in range(0, len(frames), stride):
+            start = time.perf_counter()
+            counter.update(frames[number], stride)
+            times.append(time.perf_counter() - start)
+        counted = (counter.totals['forward'], counter.totals['backward'])
+        result = {
+            'frame_p50_ms': _percentile(times, 0.5) * 1e3,
+            'frame_p99_ms': _percentile(times, 0.99) * 1e3,
+            'within_budget': _percentile(times, 0.5) <= counting.FRAME_BUDGET * stride,
+            'forward': counted[0],
+            'backward': counted[1],
+            'correct': counted == expected,
+        }
+        print(F"  every {stride} frame{'s' if stride > 1 else ' '} frame_p50={result['frame_p50_ms']:.2f} ms "
+              F"p99={result['frame_p99_ms']:.2f} ms forward={counted[0]} backward={counted[1]} correct={result['correct']}")
+        if not result['correct']:
+            raise SystemExit("the traffic counter miscounted")
+        results[F"stride_{stride}"] = result
+    return results
+
+
+# Frames per segment file in the writeback benchmark, a minute of video
+WRITEBACK_BENCH_SEGMENT_FRAMES = 20 * 60
+
+
+def _writeback_run(open_file, seconds, directory, frame):
+    """
+    Write AVI segments through files from open_file(path) as fast as possible
+    Returns: (bytes per second including closing and syncing every segment, per frame write latencies, close latencies)
+    """
+    from avi import MjpegAviWriter
+    latencies = []
+    close_latencies = []
+    written = 0
+    number = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        number += 1
+        path = os.path.join(directory, F"video_{number}.avi")
+        writer = MjpegAviWriter(path, 800, 600, 20, file=open_file(path))
+        for _ in range(WRITEBACK_BENCH_SEGMENT_FRAMES):
+            write_start = time.perf_counter()
+            writer.write(frame)
+            latencies.append(time.perf_counter() - write_start)
+            if time.monotonic() - start >= seconds:
+                break
+        close_start = time.perf_counter()
+        writer.release()
+        close_latencies.append(time.perf_counter() - close_start)
+        written += os.path.getsize(path)
+        os.remove(path)
+    return written / (time.monotonic() - start), latencies, close_latencies
+
+
+class SyncedFile:
+    """Plain buffered file that syncs on close, how segments were written before writeback.py"""
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def seek(self, offset):
+        return self.file.seek(offset)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+def bench_writeback(seconds, directory=None):
+    """Sustained segment writing through a plain file, the aligned write buffer, and the write-behind staging area"""
+    import writeback
+    frame = os.urandom(60 * 1024)
+    configs = (
+        ("plain", SyncedFile),
+        ("buffered", lambda path: writeback.SegmentFile(path, write_behind=False)),
+        ("write_behind", lambda path: writeback.SegmentFile(path)),
+    )
+    print(F"writeback: {len(frame) // 1024} KB frames, {WRITEBACK_BENCH_SEGMENT_FRAMES} frames per segment, "
+          F"{seconds} s per run into {directory or tempfile.gettempdir()}")
+    results = {}
+    for label, open_file in configs:
+        run_directory = tempfile.mkdtemp(prefix="bwct_bench_", dir=directory)
+        try:
+            rate, latencies, close_latencies = _writeback_run(open_file, seconds, run_directory, frame)
+        finally:
+            shutil.rmtree(run_directory)
+        result = {
+            'throughput_mb_s': rate / 1024 ** 2,
+            'write_p50_ms': _percentile(latencies, 0.5) * 1e3,
+            'write_p99_ms': _percentile(latencies, 0.99) * 1e3,
+            'write_max_ms': max(latencies) * 1e3,
+            'close_max_ms': max(close_latencies) * 1e3,
+        }
+        print(F"  {label:12s} throughput={result['throughput_mb_s']:.1f} MB/s write_p50={result['write_p50_ms']:.3f} ms "
+              F"write_p99={result['write_p99_ms']:.3f} ms write_max={result['write_max_ms']:.1f} ms "
+              F"close_max={result['close_max_ms']:.1f} ms")
+        results[label] = result
+    return results
+
+
+# Frames per segment in the recovery benchmark's sessions, and records lost from the index's buffer
+RECOVERY_BENCH_SEGMENT_FRAMES = 20 * 60
+RECOVERY_BENCH_LOST_RECORDS = 100
+
+
+def _interrupted_session(directory, frames, segment_count, index_ahead):
+    """
+    Record a session of segment_count segments of the given JPEG frames and cut it off like a power loss would:
+    the last segment is never released and ends half way into a frame, and an empty next segment was opened.
+    With index_ahead, frames.idx has a record of the torn frame and day_night.csv a switch after it.
+    Otherwise the index lost its last RECOVERY_BENCH_LOST_RECORDS records, and the last segment is from the night camera.
+    Returns: (frame id, segment number, camera, offset) of every frame that should survive, in order
+    """
+    import avi
+    import frame_index
+    import sessions
+    from segments import SegmentInfo
+    index = frame_index.FrameIndexWriter(os.path.join(directory, frame_index.INDEX_NAME))
+    switch = (segment_count - 1) * RECOVERY_BENCH_SEGMENT_FRAMES
+    with open(os.path.join(directory, "day_night.csv"), "w") as f:
+        f.write("frame_id,night_true\n0,False\n")
+        if not index_ahead:
+            f.write(F"{switch},True\n")
+    written = []
+    frame_id = 0
+    for number in range(1, segment_count + 1):
+        path = os.path.join(directory, F"video_{number}.avi")
+        writer = avi.MjpegAviWriter(path, 800, 600, 20)
+        camera = frame_index.CAMERA_NIGHT if frame_id >= switch and not index_ahead else frame_index.CAMERA_DAY
+        info = SegmentInfo(number, frame_id, frame_id / 20)
+        for _ in range(RECOVERY_BENCH_SEGMENT_FRAMES):
+            offset = writer.write(frames[frame_id % len(frames)])
+            written.append((frame_id, number, camera, offset))
+            info.frames += 1
+            info.last_frame = frame_id
+            info.end_time = frame_id / 20
+            frame_id += 1
+        if number < segment_count:
+            writer.release()
+            sessions.record_segment(path, info, camera)
+        else:
+            writer.file.close()
+            # Half of the last frame made it to the drive
+            os.truncate(path, written[-1][3] + len(frames[(frame_id - 1) % len(frames)]) // 2)
+    # The writer for the next segment was already open
+    avi.MjpegAviWriter(os.path.join(directory, F"video_{segment_count + 1}.avi"), 800, 600, 20).file.close()
+    records = written if index_ahead else written[:-RECOVERY_BENCH_LOST_RECORDS]
+    for record_id, number, camera, offset in records:
+        index.append(record_id, record_id / 20, number, camera, offset)
+    index.close()
+    if index_ahead:
+        with open(os.path.join(directory, "day_night.csv"), "a") as f:
+            f.write(F"{frame_id - 1},True\n")
+    return written[:-1]
+
+
+def bench_recovery(seconds, directory=None):
+    """Repair sessions cut off by a power loss, and check the segments, index and day/night log that come out"""
+    try:
+        import cv2
+        import numpy
+    except ImportError:
+        print("recovery: skipped, needs numpy and OpenCV")
+        return None
+    import queue
+    import fake_hardware
+    import frame_index
+    import recovery
+    import sessions
+    rng = numpy.random.default_rng(1)
+    # Smooth noise compresses to about the size of a camera frame, odd sizes need the chunk padding
+    frames = [cv2.imencode(".jpg", cv2.resize(rng.integers(0, 255, (10, 13, 3), dtype=numpy.uint8), (800, 600),
+                                              interpolation=cv2.INTER_CUBIC))[1].tobytes()
+              for _ in range(8)]
+    segment_count = max(2, int(seconds))
+    results = {}
+    for label, index_ahead in (("index_ahead", True), ("index_behind", False)):
+        session = tempfile.mkdtemp(prefix="bench_recovery_", dir=directory)
+        try:
+            expected = _interrupted_session(session, frames, segment_count, index_ahead)
+            size = sum(os.path.getsize(os.path.join(session, name)) for name in os.listdir(session))
+            merge_queue = queue.Queue()
+            start = time.perf_counter()
+            recovery.recover_session(session, merge_queue)
+            elapsed = time.perf_counter() - start
+            records = [(record.frame_id, record.segment, record.camera, record.offset)
+                       for record in frame_index.FrameIndex(os.path.join(session, frame_index.INDEX_NAME))]
+            last = os.path.join(session, F"video_{segment_count}.avi")
+            # The camera benchmarks put fake_hardware's camera in cv2's place, a file needs the real one
+            capture = (fake_hardware.real_video_capture or cv2.VideoCapture)(last)
+            playable = capture.get(cv2.CAP_PROP_FRAME_COUNT) == RECOVERY_BENCH_SEGMENT_FRAMES - 1
+            capture.set(cv2.CAP_PROP_POS_FRAMES, RECOVERY_BENCH_SEGMENT_FRAMES - 2)
+            playable = playable and capture.read()[0]
+            capture.release()
+            with open(os.path.join(session, "day_night.csv")) as f:
+                day_night = f.read().splitlines()[1:]
+            switch = (segment_count - 1) * RECOVERY_BENCH_SEGMENT_FRAMES
+            listed = [segment['frames'] for segment in sessions.read_segments(session)]
+            result = {
+                'seconds': elapsed,
+                'scan_mb_s': size / elapsed / 1e6,
+                'index_correct': records == expected,
+                'playable': playable,
+                'day_night_correct': day_night == (["0,False"] if index_ahead else ["0,False", F"{switch},True"]),
+                'segments_listed': listed == [RECOVERY_BENCH_SEGMENT_FRAMES] * (segment_count - 1) + [RECOVERY_BENCH_SEGMENT_FRAMES - 1],
+                'queued': merge_queue.get_nowait() == session,
+                'empty_segment_removed': not os.path.exists(os.path.join(session, F"video_{segment_count + 1}.avi")),
+            }
+            print(F"  {label:12s} {size / 1e6:.0f} MB in {elapsed * 1e3:.0f} ms ({result['scan_mb_s']:.0f} MB/s) "
+                  + " ".join(F"{key}={value}" for key, value in result.items() if isinstance(value, bool)))
+            if not all(value for value in result.values() if isinstance(value, bool)):
+                raise SystemExit("recovery left a session inconsistent")
+            results[label] = result
+        finally:
+            shutil.rmtree(session, ignore_errors=True)
+    return results
+
+
+PREVIEW_LATENCY_CONFIGS = ("day_passthrough", "day_decode", "night_lores")
+
+
+def _preview_latency_run(config, seconds, results):
+    camera = _fake_camera_module(20)
+    import fake_hardware
+    import webui
+    camera.PASSTHROUGH_RECORDING = config == "day_passthrough"
+    camera.metrics = Telemetry()
+    camera.preview_metrics = (camera.metrics.metric('preview_frames'), camera.metrics.metric('preview_encode_seconds'))
+    camera.preview_ring = FrameRing.create()
+    # The process is terminated when the run is over, the block stays mapped until then
+    camera.preview_ring.unlink()
+    camera.PREVIEW_FRAMERATE = PREVIEW_BENCH_FRAMERATE
+    camera.camera_init()
+    camera.use_night = config == "night_lores"
+    update_thread = threading.Thread(target=camera.update_frame)
+    update_thread.daemon = True
+    update_thread.start()
+    hub = webui.PreviewHub(camera.preview_ring, PREVIEW_BENCH_FRAMERATE, camera.metrics)
+    client = hub.add_client(PREVIEW_BENCH_FRAMERATE, webui.PREVIEW_QUALITY)
+    # The clock starts at the first frame, camera start up is not part of the measurement
+    while hub.next_frame(client) is None:
+        pass
+    latencies = []
+    received = 0
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        frame = hub.next_frame(client)
+        if frame is None:
+            continue
+        received += 1
+        # Only forwarded frames keep the capture time stamped into them by the fake camera
+        stamp = fake_hardware.read_stamp(frame)
+        if stamp is not None:
+            latencies.append(time.monotonic() - stamp)
+    encode = camera.metrics.snapshot()['preview_encode_seconds']
+    results.put((config, {
+        'received_fps': received / seconds,
+        'capture_to_viewer_p50_ms': None if not latencies else _percentile(latencies, 0.5) * 1e3,
+        'capture_to_viewer_p99_ms': None if not latencies else _percentile(latencies, 0.99) * 1e3,
+        'encode_mean_ms': encode['sum'] / encode['count'] * 1e3 if encode['count'] else None,
+    }))
+
+
+def bench_preview_latency(seconds):
+    """Camera to viewer preview path: update_frame, the ring and the PreviewHub, for each camera path"""
+    if _fake_camera_module(20) is None:
+        print("preview_latency: skipped, needs numpy and OpenCV")
+        return None
+    print(F"preview_latency: one viewer at {PREVIEW_BENCH_FRAMERATE} fps for {seconds} s")
+    results = {}
+    # update_frame never returns, so each configuration runs in its own process
+    for config in PREVIEW_LATENCY_CONFIGS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_preview_latency_run, args=(config, seconds, queue))
+        process.start()
+        _, result = queue.get()
+        process.terminate()
+        process.join()
+        def ms(value):
+            return "n/a" if value is None else F"{value:.2f} ms"
+        print(F"  {config:15s} received={result['received_fps']:.1f} fps "
+              F"capture_to_viewer_p50={ms(result['capture_to_viewer_p50_ms'])} "
+              F"p99={ms(result['capture_to_viewer_p99_ms'])} encode_mean={ms(result['encode_mean_ms'])}")
+        results[config] = result
+    return results
+
+
+BENCHMARKS = {
+    "preview_ipc": bench_preview_ipc,
+    "state": bench_state,
+    "buttons": bench_buttons,
+    "rotation": bench_rotation,
+    "record": bench_record,
+    "preview_latency": bench_preview_latency,
+    "motion": bench_motion,
+    "counting": bench_counting,
+    "writeback": bench_writeback,
+    "recovery": bench_recovery,
+}
+
+
+def flatten(results, prefix=""):
+    """Nested result dicts as {'benchmark.config.metric': value}"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, F"{prefix}{key}."))
+        else:
+            flat[F"{prefix}{key}"] = value
+    return flat
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """Print every numeric result next to the one from an earlier run"""
+    print(F"compared with {previous.get('commit')} from {time.ctime(previous['time'])}:")
+    old = flatten(previous['results'])
+    for key, value in flatten(current['results']).items():
+        before = old.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(before, (int, float)):
+            continue
+        change = F"{(value - before) / before * 100:+.1f}%" if before else ""
+        print(F"  {key:55s} {before:14.3f} -> {value:14.3f} {change}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hardware-free benchmarks for the recording device")
+    parser.add_argument("benchmarks", nargs="*", help=F"any of {', '.join(BENCHMARKS)}, default is all of them")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--directory", help="where the record, writeback and recovery benchmarks write, e.g. the flash drive, default is the temp directory")
+    parser.add_argument("--json", help="append the results as one JSON line to this file")
+    parser.add_argument("--compare", help="compare with the last run recorded in this JSON lines file")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(F"unknown benchmark {name}")
+    run = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'seconds': args.seconds,
+        'results': {},
+    }
+    for name in args.benchmarks or BENCHMARKS:
+        if name in ("record", "writeback", "recovery"):
+            # These write segments to disk, point --directory at the USB drive to measure it there
+            result = BENCHMARKS[name](args.seconds, args.directory)
+        else:
+            result = BENCHMARKS[name](args.seconds)
+        if result is not None:
+            run['results'][name] = result
+    if args.compare:
+        with open(args.compare) as f:
+            lines = f.read().splitlines()
+        if lines:
+            compare(json.loads(lines[-1]), run)
+    if args.json:
+        with open(args.json, "a") as f:
+            f.write(json.dumps(run) + "\n")
@@ -1,19 +1,31 @@
 
 from picamera2 import Picamera2
 from picamera2.encoders import H264Encoder, Quality, MJPEGEncoder
-from picamera2.outputs import FileOutput, FfmpegOutput
+from picamera2.outputs import FileOutput, Output
 import time
 import threading
 import io
 import os
-import subprocess
+import collections
+import math
 
+import numpy
 # need cv2 to check if the frame is too dark
 import cv2
 
-DEBUG = False
+from segments import SegmentRotator
+from avi import MjpegAviWriter
+import daynight
+import frame_index
+import merge
+import motion
+import counting
+import recovery
+import sessions
+import writeback
+from telemetry import Telemetry, RollingSummary
 
-SEGMENT_CHUNKS = 5 # Segments to merge at a time
+DEBUG = False
 
 # Segment lengths of our chunks, in seconds. variety for testing
 SEGMENT_LENGTH = 15 * 60 # 15 minutes * 60 seconds
@@ -24,9 +36,43 @@ SEGMENT_LENGTH = 15 * 60 # 15 minutes * 60 seconds
 RECORD_FRAMERATE = 20
 # This can only be a resolution supported by the usb camera.
 RESOLUTION = (800, 600)
-SWITCH_CHECK_INTERVAL = SEGMENT_LENGTH / 3
-# SWITCH_CHECK_INTERVAL = 5
-DARK_THRESHOLD = 50 # average pixel value below this is considered too dark
+# The preview and the light level come from frames this many times smaller than RESOLUTION,
+# full resolution frames only go to the recording. One of 1, 2, 4 or 8, the scales libjpeg can decode to.
+LORES_SCALE = 2
+LORES_RESOLUTION = (RESOLUTION[0] // LORES_SCALE, RESOLUTION[1] // LORES_SCALE)
+# Take a light level sample for the day/night switch every this many frames, thresholds are in daynight.py
+LIGHT_SAMPLE_FRAMES = RECORD_FRAMERATE
+# Frames the day camera can hold in memory while the flash drive is slow, one second of video
+WRITE_QUEUE_SIZE = RECORD_FRAMERATE
+# What to do when that queue is full: 'block' capture, 'drop_oldest' queued frame or 'drop_newest' captured frame
+WRITE_QUEUE_POLICY = 'drop_oldest'
+# How often the writer queue counters are published to state
+WRITER_STATS_INTERVAL = 1.0
+# How often the preview thread checks for viewers when no one has the web UI open
+NO_VIEWER_INTERVAL = 1.0
+# Record at the full frame rate only around motion and at motion.IDLE_FRAMERATE otherwise, see motion.py
+MOTION_GATING = False
+# Count traffic crossing counting.COUNT_LINE while recording, into counts.csv and the shared state, see counting.py
+TRAFFIC_COUNTING = False
+# The traffic counter works on frames this many times smaller than RESOLUTION, a multiple of LORES_SCALE up to 8
+COUNTING_SCALE = 4
+# Record the USB camera's own JPEG frames into the AVI segments instead of decoding and re-encoding them.
+# Falls back to decoding if the V4L2 backend cannot hand out the compressed frames.
+PASSTHROUGH_RECORDING = True
+# cv2.imdecode flags that decode a JPEG straight to 1/LORES_SCALE size
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# The same for the traffic counter's greyscale frames
+REDUCED_GREY_DECODE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
 
 state = None
 
@@ -36,14 +82,28 @@ night_cam = None
 night_cfg = None
 use_night = False # True = night, False = day
 lock = threading.Lock()
-latest_frame_queue = None
+preview_ring = None
 latest_frame = None
-last_camera_check = 0
+last_light_sample = 0
+light_meter = None
 fourcc = None
 frame_id = 0
+recording_rotator = None
+# frame_index.FrameIndexWriter of the current recording
+recording_index = None
+# motion.MotionGate of the current recording with MOTION_GATING, None otherwise
+recording_gate = None
+# counting.TrafficCounter of the current recording with TRAFFIC_COUNTING, None otherwise
+traffic_counter = None
+# telemetry.Telemetry shared with the web process, and the handles the preview and night camera paths update
+metrics = None
+preview_metrics = None
+night_metrics = None
+# Paths of the closed segments of the current recording, appended from the rotator's helper thread
+segments = []
 
 class DayCam:
-    def __init__(self, device_index=0, resolution=(1280, 720), framerate=30):
+    def __init__(self, device_index=0, resolution=(1280, 720), framerate=30, passthrough=False, metrics=None):
         print("before day cam init")
         self.cap = cv2.VideoCapture(device_index, cv2.CAP_V4L2)
         print("after day cam init")
@@ -53,30 +113,155 @@ class DayCam:
         fourcc = cv2.VideoWriter_fourcc(*'MJPG')
 
         self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
-        print("configured day cam")
+        # The camera may not support the exact size we asked for
+        self.resolution = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.passthrough = passthrough and self.enable_passthrough()
+        print(F"configured day cam, passthrough recording {'on' if self.passthrough else 'off'}")
         self.is_recording = False
         self.is_capturing = False
         self.frame = None
-        self.video_writer = None
+        # In passthrough mode: (capture count, JPEG bytes) of the latest frame, decoded only on request
+        self.jpeg = (0, None)
+        self.decoded = (0, None)
+        self.decoded_lores = (0, None)
+        self.decode_lock = threading.Lock()
+        self.rotator = None
+        # motion.MotionGate deciding which frames get queued, None to queue every frame
+        self.gate = None
+        # The capture thread hands frames to the gate or the queue while this is set, pushing while it does
+        self.feeding = False
+        self.pushing = False
         self.capture_thread = threading.Thread(target=self.capture_loop)
         self.capture_thread.daemon = True
+        # Frames waiting for the writer thread, bounded by WRITE_QUEUE_SIZE
+        self.write_queue = collections.deque()
+        self.write_queue_size = WRITE_QUEUE_SIZE
+        self.write_condition = threading.Condition()
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
         self.busy = False
-        self.frame_id = 0
-        
+        self.dropped_frames = 0
+        # Frame ids of dropped frames not yet passed on with a queued frame
+        self.pending_skips = 0
+        self.max_queue_depth = 0
+        # Metric handles are created once here, updating them on the frame path allocates nothing
+        if metrics is None:
+            metrics = Telemetry()
+        self.frames_captured = metrics.metric('day_frames_captured')
+        self.read_seconds = metrics.metric('day_read_seconds')
+        self.capture_seconds = metrics.metric('day_capture_seconds')
+        self.frames_written = metrics.metric('day_frames_written')
+        self.write_seconds = metrics.metric('day_write_seconds')
+        self.queue_depth_gauge = metrics.metric('write_queue_depth')
+        self.queue_dropped = metrics.metric('write_queue_dropped')
+
+    def enable_passthrough(self):
+        """Ask the V4L2 backend for the undecoded MJPEG buffers, returns True if the camera delivers them"""
+        if not self.cap.isOpened():
+            return False
+        self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        ret, frame = self.cap.read()
+        # Raw frames come back as a single row of bytes starting with the JPEG start of image marker
+        if ret and frame.ndim == 2 and frame.shape[0] == 1 and frame.shape[1] > 2 and frame[0, 0] == 0xFF and frame[0, 1] == 0xD8:
+            return True
+        self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        return False
+
     def capture_loop(self):
+        count = 0
         while self.is_capturing:
+            read_start = time.monotonic()
             ret, frame = self.cap.read()
             if ret:
-                self.frame = frame
-                if self.is_recording and self.video_writer is not None:
-                    self.busy = True
-                    self.video_writer.write(frame)
-                    self.busy = False
-                    # increment the global recording frame id
-                    self.frame_id += 1
+                read_end = time.monotonic()
+                count += 1
+                if self.passthrough:
+                    frame = frame.reshape(-1)
+                    self.jpeg = (count, frame)
                 else:
-                    self.frame_id = 0
-                
+                    self.frame = frame
+                if self.feeding:
+                    self.feed(frame, read_end)
+                self.frames_captured.inc()
+                self.read_seconds.observe(read_end - read_start)
+                self.capture_seconds.observe(time.monotonic() - read_end)
+
+    def feed(self, frame, timestamp):
+        with self.write_condition:
+            if not self.feeding:
+                return
+            gate = self.gate
+            self.pushing = True
+        try:
+            if gate is not None:
+                gate.push(frame, timestamp)
+            else:
+                self.queue_frame(frame, timestamp)
+        finally:
+            with self.write_condition:
+                self.pushing = False
+                self.write_condition.notify_all()
+
+    def queue_frame(self, frame, timestamp, skipped=0):
+        """
+        Hand a captured frame to the writer thread, applying WRITE_QUEUE_POLICY if the queue is full.
+        skipped frame ids are used up before the frame, frame is None to only use up ids.
+        Dropped frames keep their ids too, so every written frame has the id it was captured as.
+        """
+        with self.write_condition:
+            if not self.is_recording:
+                return
+            if len(self.write_queue) >= self.write_queue_size:
+                if WRITE_QUEUE_POLICY == 'block':
+                    # Capture waits for the writer, the V4L2 driver drops frames instead of us
+                    self.write_condition.wait_for(lambda: len(self.write_queue) < self.write_queue_size or not self.is_recording)
+                    if not self.is_recording:
+                        return
+                elif WRITE_QUEUE_POLICY == 'drop_oldest':
+                    _, _, dropped_skips = self.write_queue.popleft()
+                    # The next frame in line uses up the dropped frame's id along with its own skips
+                    if self.write_queue:
+                        next_frame, next_timestamp, next_skips = self.write_queue[0]
+                        self.write_queue[0] = (next_frame, next_timestamp, next_skips + dropped_skips + 1)
+                    else:
+                        skipped += dropped_skips + 1
+                    self.dropped_frames += 1
+                    self.queue_dropped.inc()
+                else: # drop_newest
+                    self.pending_skips += skipped + 1
+                    self.dropped_frames += 1
+                    self.queue_dropped.inc()
+                    return
+            self.write_queue.append((frame, timestamp, skipped + self.pending_skips))
+            self.pending_skips = 0
+            self.max_queue_depth = max(self.max_queue_depth, len(self.write_queue))
+            self.queue_depth_gauge.set(len(self.write_queue))
+            self.write_condition.notify_all()
+
+    def writer_loop(self):
+        while True:
+            with self.write_condition:
+                self.write_condition.wait_for(lambda: self.write_queue)
+                frame, timestamp, skipped = self.write_queue.popleft()
+                self.queue_depth_gauge.set(len(self.write_queue))
+                rotator = self.rotator
+                self.busy = True
+                # Wakes a capture thread blocked on a full queue
+                self.write_condition.notify_all()
+            # Writing happens outside the lock so capture never waits on the flash drive.
+            # The rotator switches segments on this exact frame if the current one is long enough.
+            if skipped:
+                rotator.skip(skipped)
+            if frame is not None:
+                write_start = time.monotonic()
+                rotator.write(frame, timestamp)
+                self.write_seconds.observe(time.monotonic() - write_start)
+                self.frames_written.inc()
+            with self.write_condition:
+                self.busy = False
+                self.write_condition.notify_all()
+
     def start_capture(self):
         self.is_capturing = True
         if not self.capture_thread.is_alive():
@@ -86,29 +271,102 @@ class DayCam:
     def stop_capture(self):
         self.is_capturing = False
     
-    def start_recording(self, video_writer):
-        self.video_writer = video_writer
-        self.is_recording = True
+    def start_recording(self, rotator, gate=None):
+        with self.write_condition:
+            self.rotator = rotator
+            self.gate = gate
+            # The gate hands over its whole pre-roll at once when motion starts, on top of the usual backlog
+            self.write_queue_size = WRITE_QUEUE_SIZE + (gate.pre_roll_frames if gate is not None else 0)
+            self.pending_skips = 0
+            self.is_recording = True
+            self.feeding = True
             
-    def stop_recording(self):
-        self.is_recording = False
-        if self.video_writer is not None:
-            while self.busy:
-                pass
-            self.video_writer.release()  # Properly close the video file
-            print("released video writer")
-
-        self.video_writer = None  # Reset the videoWriter object
-
-
+    def stop_recording(self, flush=None):
+        """
+        Stop recording once everything captured so far is written.
+        flush is called after the capture thread stopped handing over frames and before the
+        writer is drained, e.g. the gate's flush so its post-roll still reaches the queue.
+        """
+        with self.write_condition:
+            self.feeding = False
+            self.write_condition.wait_for(lambda: not self.pushing)
+        if flush is not None:
+            flush()
+        with self.write_condition:
+            self.is_recording = False
+            self.write_condition.notify_all()
+            if self.rotator is not None:
+                # Let the writer thread finish everything that was captured before the stop
+                self.write_condition.wait_for(lambda: not self.write_queue and not self.busy)
+            # The caller releases the rotator, which closes the video file
+            self.rotator = None
+            self.gate = None
 
     def get_latest_frame(self):
         # Return the latest frame captured by the capture thread
-        return self.frame
-    
-    def get_frame_id(self):
-        # Return he current recording frame count
-        return self.frame_id
+        if not self.passthrough:
+            return self.frame
+        # Decode the latest JPEG at most once, and only when someone asks for pixels
+        with self.decode_lock:
+            count, jpeg = self.jpeg
+            if jpeg is not None and self.decoded[0] != count:
+                self.decoded = (count, cv2.imdecode(jpeg, cv2.IMREAD_COLOR))
+            return self.decoded[1]
+
+    def get_lores_frame(self):
+        """Latest frame at LORES_RESOLUTION for the preview, the day side counterpart of the night camera's lores stream"""
+        if not self.passthrough:
+            frame = self.frame
+            if frame is None or LORES_SCALE == 1:
+                return frame
+            return cv2.resize(frame, LORES_RESOLUTION, interpolation=cv2.INTER_AREA)
+        # Decoding at a reduced scale skips most of the IDCT work instead of decoding and resizing
+        with self.decode_lock:
+            count, jpeg = self.jpeg
+            if jpeg is not None and self.decoded_lores[0] != count:
+                self.decoded_lores = (count, cv2.imdecode(jpeg, REDUCED_DECODE_FLAGS[LORES_SCALE]))
+            return self.decoded_lores[1]
+
+    def get_light_level(self):
+        """Light level of the latest frame for the day/night switch, None if there is no frame yet"""
+        if not self.passthrough:
+            frame = self.frame
+            return None if frame is None else daynight.light_level(frame)
+        jpeg = self.jpeg[1]
+        if jpeg is None:
+            return None
+        # libjpeg decodes straight to 1/8 scale by skipping most of the IDCT, a fraction of a full decode
+        frame = cv2.imdecode(jpeg, cv2.IMREAD_REDUCED_COLOR_8)
+        return None if frame is None else daynight.light_level(frame, 1)
+
+    def get_grey_frame(self, scale):
+        """Latest frame in greyscale at 1/scale of the capture resolution for the traffic counter, None if there is no frame yet"""
+        if not self.passthrough:
+            frame = self.frame
+            if frame is None:
+                return None
+            grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if scale == 1:
+                return grey
+            return cv2.resize(grey, (grey.shape[1] // scale, grey.shape[0] // scale), interpolation=cv2.INTER_AREA)
+        jpeg = self.jpeg[1]
+        if jpeg is None:
+            return None
+        return cv2.imdecode(jpeg, REDUCED_GREY_DECODE_FLAGS[scale])
+
+    def get_latest_jpeg(self):
+        # Return the latest undecoded JPEG in passthrough mode, None otherwise
+        return self.jpeg[1]
+
+    def get_writer_stats(self):
+        """
+        Returns: (current queue depth, highest queue depth since the last call, total dropped frames)
+        """
+        with self.write_condition:
+            depth = len(self.write_queue)
+            max_depth = self.max_queue_depth
+            self.max_queue_depth = depth
+            return depth, max_depth, self.dropped_frames
 
 
 
@@ -134,49 +392,253 @@ class DayCam:
 #         time.sleep(1/PREVIEW_FRAMERATE)
 
 def update_frame():
-    global PREVIEW_FRAMERATE, use_night, day_cam, night_cam, lock, latest_frame_queue, latest_frame
+    global PREVIEW_FRAMERATE, use_night, day_cam, night_cam, lock, preview_ring, latest_frame, preview_metrics
+    frames, encode_seconds = preview_metrics
+    # The last day camera JPEG count and raw frame sent, previewing faster than the camera sends nothing twice
+    last_jpeg_count = None
+    last_day_frame = None
     while True:
+        # Only encode as often, and as well, as the most demanding connected viewer asks for
+        viewers, framerate, quality = preview_ring.demand()
+        # The demand comes from the web process, a bad value must not stop the preview
+        if not math.isfinite(framerate) or framerate <= 0:
+            framerate = PREVIEW_FRAMERATE
+        quality = min(max(quality, 1), 100)
+        if viewers == 0:
+            # Nobody is watching, skip capturing and encoding entirely
+            time.sleep(NO_VIEWER_INTERVAL)
+            continue
+        jpeg = None
+        frame = None
+        night = use_night
         with lock:
-            if use_night:
-                # Assuming night_cam still uses Picamera2 methods
-                # Adjust accordingly if you also replace night_cam with a similar class to DayCam
-                # data = io.BytesIO()
-                # night_cam.capture_file(data, format='jpeg')
-                latest_frame = night_cam.capture_array()
-                latest_frame = cv2.cvtColor(latest_frame, cv2.COLOR_BGR2RGB)
-                frame = cv2.imencode('.jpg', latest_frame)[1].tobytes()
-                latest_frame_queue.put(frame)
-            else:
-                # Use DayCam's method to get the latest frame
-                latest_frame = day_cam.get_latest_frame()
-                if latest_frame is not None:
-                    frame = cv2.imencode('.jpg', latest_frame)[1].tobytes()
-                    latest_frame_queue.put(frame)
-        time.sleep(1/PREVIEW_FRAMERATE)
-
-def frame_is_dark(frame):
-    """This function checks if the green channel of the image is below a certain threshold"""
-    # check if the average pixel value is below a certain threshold
-    avg_pixel = cv2.mean(frame)
-    # Dark camera is IR, so only use green channel for average pixel value
-    avg_pixel = avg_pixel[1]
-    # print(F"Average: {avg_pixel} | Dark threshold: {DARK_THRESHOLD}")
-    if avg_pixel < DARK_THRESHOLD:
-        return True
-    else:
-        return False
+            if night:
+                # Small YUV420 frame from the lores stream, the main stream only feeds the encoder
+                latest_frame = frame = night_cam.capture_array("lores")
+            elif day_cam.passthrough:
+                # The camera's own JPEG is forwarded as is, no decode or encode needed
+                count, jpeg = day_cam.jpeg
+                if count == last_jpeg_count:
+                    jpeg = None
+                last_jpeg_count = count
+            elif day_cam.frame is not last_day_frame:
+                last_day_frame = day_cam.frame
+                latest_frame = frame = day_cam.get_lores_frame()
+        if jpeg is not None:
+            preview_ring.write(jpeg)
+            frames.inc()
+        elif frame is not None:
+            encode_start = time.monotonic()
+            if night:
+                frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+            # Encoding happens outside the lock so it never holds up a camera switch
+            jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1]
+            encode_seconds.observe(time.monotonic() - encode_start)
+            preview_ring.write(jpeg)
+            frames.inc()
+        time.sleep(1/min(framerate, PREVIEW_FRAMERATE))
+
+
+def get_light_level():
+    """Light level of the active camera for the day/night switch, None if there is no frame yet"""
+    global use_night, day_cam, night_cam, lock
+    with lock:
+        if use_night:
+            # Dark camera is IR, so the luma plane of the lores stream is as good as the green channel
+            luma = night_cam.capture_array("lores")[:LORES_RESOLUTION[1]]
+            return daynight.light_level(luma, max(daynight.SAMPLE_STRIDE // LORES_SCALE, 1))
+        return day_cam.get_light_level()
+
+
+def get_counting_frame():
+    """
+    Returns: (True if it came from the night camera, greyscale frame at 1/COUNTING_SCALE of RESOLUTION or None if there is no frame yet)
+    """
+    global use_night, day_cam, night_cam, lock
+    with lock:
+        if not use_night:
+            return False, day_cam.get_grey_frame(COUNTING_SCALE)
+        luma = night_cam.capture_array("lores")[:LORES_RESOLUTION[1]]
+    scale = COUNTING_SCALE // LORES_SCALE
+    if scale == 1:
+        return True, luma
+    return True, cv2.resize(luma, (luma.shape[1] // scale, luma.shape[0] // scale), interpolation=cv2.INTER_AREA)
+
+
+def count_traffic():
+    """
+    Traffic counting thread, analyses the latest frame of the active camera while a recording has a counter.
+    It only ever looks at the newest frame, so capture and recording never wait for it.
+    """
+    global traffic_counter, state, metrics
+    analysed_frames, skipped_frames, analyse_seconds = (metrics.metric('counting_frames'), metrics.metric('counting_skipped'),
+                                                        metrics.metric('counting_seconds'))
+    frame_interval = 1 / RECORD_FRAMERATE
+    counter = None
+    while True:
+        if traffic_counter is None:
+            counter = None
+            time.sleep(0.1)
+            continue
+        if traffic_counter is not counter:
+            # A new recording
+            counter = traffic_counter
+            night = None
+            frames = 1
+            next_frame_time = time.monotonic()
+        frame_night, frame = get_counting_frame()
+        if frame_night != night:
+            # The other camera's background and tracks mean nothing to this one
+            counter.reset()
+            night = frame_night
+        start = time.monotonic()
+        if frame is None:
+            counter.skip(frames)
+            skipped_frames.inc(frames)
+        else:
+            crossings = counter.update(frame, frames)
+            analyse_seconds.observe(time.monotonic() - start)
+            analysed_frames.inc()
+            skipped_frames.inc(frames - 1)
+            if crossings:
+                state.update({'traffic_' + direction: count for direction, count in counter.totals.items()})
+        # Over budget, leave out as many frames as the analysis took budgets rather than falling behind capture
+        frames = max(1, math.ceil((time.monotonic() - start) / counting.FRAME_BUDGET))
+        next_frame_time += frames * frame_interval
+        now = time.monotonic()
+        if next_frame_time > now:
+            time.sleep(next_frame_time - now)
+        else:
+            # Waiting on the night camera took longer than the frames it was meant to cover
+            frames += int((now - next_frame_time) / frame_interval)
+            next_frame_time = now
+
+class RotatingOutput(Output):
+    """Picamera2 encoder output that hands every encoded frame to a SegmentRotator, or to a motion.MotionGate first"""
+    def __init__(self, rotator, gate=None):
+        super().__init__()
+        self.rotator = rotator
+        self.gate = gate
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        global night_metrics
+        frames_captured, _, _ = night_metrics
+        arrival = time.monotonic()
+        frames_captured.inc()
+        if self.gate is not None:
+            # The pre-roll holds on to frames, so they must not point into a buffer the encoder reuses
+            self.gate.push(numpy.frombuffer(bytes(frame), numpy.uint8), arrival)
+        else:
+            self.write(frame, arrival, 0, keyframe)
+
+    def write(self, frame, timestamp, skipped, keyframe=True):
+        """Write a frame after using up skipped frame ids, frame is None to only use up ids"""
+        global night_metrics
+        _, frames_written, write_seconds = night_metrics
+        if skipped:
+            self.rotator.skip(skipped)
+        if frame is None:
+            return
+        write_start = time.monotonic()
+        self.rotator.write(frame, timestamp, keyframe)
+        write_seconds.observe(time.monotonic() - write_start)
+        frames_written.inc()
+
+
+def segment_path(directory, number):
+    return f"{directory}/video_{number}.avi"
+
+
+def open_avi_segment(path):
+    """MjpegAviWriter for a segment, writing through a preallocated write-behind file, see writeback.py"""
+    global metrics
+    output = writeback.SegmentFile(path, metrics=metrics)
+    return MjpegAviWriter(path, RESOLUTION[0], RESOLUTION[1], RECORD_FRAMERATE, file=output)
+
+
+def open_day_segment(path):
+    global day_cam
+    if day_cam.passthrough:
+        # The camera's JPEG frames go straight into the AVI file
+        return open_avi_segment(path)
+    # Set up VideoWriter for recording with the same resolution and framerate as DayCam
+    video_writer = cv2.VideoWriter(path, fourcc, RECORD_FRAMERATE, RESOLUTION)  # Adjust filename, codec, and parameters as needed
+    video_writer.set(cv2.CAP_PROP_FPS, RECORD_FRAMERATE)
+    return video_writer
+
 
-def night_camera_callback(request):
-    """Checks if the night camera encoder is running and if it is, increments the frame count"""
-    global night_encoder_running, frame_id
-    if night_encoder_running:
-        frame_id += 1
+def start_segments(night, directory, first_number, first_frame):
+    """Start recording the given camera into video_N.avi segments, rotating every SEGMENT_LENGTH seconds"""
+    global day_cam, night_cam, encoder, recording_rotator, recording_index, recording_gate, segments, metrics
+    if night:
+        # The MJPEG encoder's frames go straight into the AVI file, like the day camera's in passthrough mode
+        open_segment = lambda number: open_avi_segment(segment_path(directory, number))
+    else:
+        open_segment = lambda number: open_day_segment(segment_path(directory, number))
+    camera = frame_index.CAMERA_NIGHT if night else frame_index.CAMERA_DAY
+
+    def frame_written(frame_id, timestamp, number, offset):
+        recording_index.append(frame_id, timestamp, number, camera, offset)
+
+    def segment_closed(info):
+        print(F"Closed segment {info.number} with {info.frames} frames")
+        segments.append(segment_path(directory, info.number))
+        # The session browser reads sizes and durations from here instead of opening the segments
+        sessions.record_segment(segment_path(directory, info.number), info, camera)
+
+    def discard_segment(number, writer):
+        # The pre-opened next segment was never used, its number is reused by the next camera
+        writer.release()
+        if os.path.exists(segment_path(directory, number)):
+            os.remove(segment_path(directory, number))
+
+    recording_rotator = SegmentRotator(open_segment, SEGMENT_LENGTH, first_number, first_frame,
+                                       on_segment_closed=segment_closed, discard_segment=discard_segment,
+                                       on_frame_written=frame_written)
+    if night:
+        output = RotatingOutput(recording_rotator)
+        if MOTION_GATING:
+            recording_gate = output.gate = motion.MotionGate(output.write, RECORD_FRAMERATE, metrics=metrics)
+        night_cam.start_encoder(encoder, output, quality=Quality.HIGH)
+    else:
+        if MOTION_GATING:
+            recording_gate = motion.MotionGate(day_cam.queue_frame, RECORD_FRAMERATE, metrics=metrics)
+        day_cam.start_recording(recording_rotator, recording_gate)
+    print(F"{'Night' if night else 'Day'} camera recording started: {segment_path(directory, first_number)}")
+
+
+def stop_segments(night):
+    """
+    Stop recording the given camera and close its last segment
+    Returns: (number for the next segment, id for the next frame)
+    """
+    global day_cam, night_cam, recording_rotator, recording_gate
+    # Frames held back for the pre-roll are written or skipped, trailing skips still use up their ids.
+    # The camera stops handing frames to the gate first, so nothing is pushed after the flush.
+    flush = recording_gate.flush if recording_gate is not None else None
+    if night:
+        night_cam.stop_encoder()
+        if flush is not None:
+            flush()
+    else:
+        # Drains the writer after the flush, so the post-roll is written before the rotator is released
+        day_cam.stop_recording(flush)
+    recording_gate = None
+    next_number = recording_rotator.release()
+    next_frame = recording_rotator.next_frame
+    recording_rotator = None
+    print("Encoder stopped")
+    return next_number, next_frame
 
 def camera_init():
-    global RESOLUTION, PREVIEW_FRAMERATE, day_cam, day_cfg, lock, latest_frame_queue, encoder, night_cam, night_cfg, latest_frame, use_night, last_camera_check, fourcc
+    global RESOLUTION, PREVIEW_FRAMERATE, day_cam, day_cfg, lock, preview_ring, encoder, night_cam, night_cfg, latest_frame, use_night, fourcc, metrics
     night_cam = Picamera2() # the CSI2 camera
     print("Created camera instance")
-    night_cfg = night_cam.create_video_configuration(main={"size": RESOLUTION})
+    # The lores stream has to be YUV420 on the Pi's ISP.
+    # The frame rate matches the day camera's, it is the rate written into the AVI headers.
+    night_cfg = night_cam.create_video_configuration(main={"size": RESOLUTION},
+                                                     lores={"size": LORES_RESOLUTION, "format": "YUV420"},
+                                                     controls={"FrameRate": RECORD_FRAMERATE})
     print("Created camera configuration")
     night_cam.configure(night_cfg)
     print("Configured camera")
@@ -184,16 +646,14 @@ def camera_init():
     # Set up VideoWriter for recording with the same resolution and framerate as DayCam
     fourcc = cv2.VideoWriter_fourcc(*'MJPG') # try with h264 fourcc
     print("Created encoder")
-    # Attach the frame counter callback to the night camera.
-    night_cam.pre_callback = night_camera_callback
     night_cam.start()
     print("Started camera")
     index = 0
-    day_cam = DayCam(device_index=index, resolution=RESOLUTION, framerate=RECORD_FRAMERATE)  # Adjust device_index as needed
+    day_cam = DayCam(device_index=index, resolution=RESOLUTION, framerate=RECORD_FRAMERATE, passthrough=PASSTHROUGH_RECORDING, metrics=metrics)  # Adjust device_index as needed
     if not day_cam.cap.isOpened():
         print(F"Day cam index {index} failed")
         index = 1
-        day_cam = DayCam(device_index=index, resolution=RESOLUTION, framerate=RECORD_FRAMERATE)  # Adjust device_index as needed
+        day_cam = DayCam(device_index=index, resolution=RESOLUTION, framerate=RECORD_FRAMERATE, passthrough=PASSTHROUGH_RECORDING, metrics=metrics)  # Adjust device_index as needed
         if not day_cam.cap.isOpened():
             print(F"Day cam index {index} failed")
         else:
@@ -212,13 +672,16 @@ def camera_init():
 
 
 
-def camera_worker(preview_framerate, queue, state_arg):
+def camera_worker(preview_framerate, ring, state_arg, merge_queue, telemetry):
     print(F"Starting camera worker with preview framerate: {preview_framerate}")
     # Initialize the camera and worker process
-    global RESOLUTION, PREVIEW_FRAMERATE, day_cam, day_cfg, lock, latest_frame_queue, encoder, night_cam, night_cfg, latest_frame, use_night, last_camera_check, fourcc, state, night_encoder_running, frame_id
+    global RESOLUTION, PREVIEW_FRAMERATE, day_cam, day_cfg, lock, preview_ring, encoder, night_cam, night_cfg, latest_frame, use_night, last_light_sample, light_meter, fourcc, state, frame_id, segments, recording_index, metrics, preview_metrics, night_metrics, traffic_counter
     PREVIEW_FRAMERATE = preview_framerate
-    latest_frame_queue = queue
+    preview_ring = ring
     state = state_arg
+    metrics = telemetry
+    preview_metrics = (metrics.metric('preview_frames'), metrics.metric('preview_encode_seconds'))
+    night_metrics = (metrics.metric('night_frames_captured'), metrics.metric('night_frames_written'), metrics.metric('night_write_seconds'))
 
     camera_init()
 
@@ -234,56 +697,61 @@ def camera_worker(preview_framerate, queue, state_arg):
     update_thread.start()
     print("update thread started")
 
+    if TRAFFIC_COUNTING:
+        counting_thread = threading.Thread(target=count_traffic)
+        counting_thread.daemon = True
+        counting_thread.start()
+
+    # Sessions cut off by a power loss are repaired in the background, recording does not wait for it
+    recovery_thread = threading.Thread(target=recovery.recovery_worker, args=(state, merge_queue))
+    recovery_thread.daemon = True
+    recovery_thread.start()
+
     segments = []
     segment_count = 1
-    segment_start_time = None
-    should_combine = False
     last_camera = use_night
-    night_encoder_running = False
+    light_meter = daynight.LightMeter(night=use_night)
     frame_id = 0
-
+    last_writer_stats_time = 0
+    last_writer_stats = None
+    # Capture rates are worked out from the frame counters once per WRITER_STATS_INTERVAL
+    fps_counters = [(metrics.metric('day_frames_captured'), metrics.metric('day_capture_fps')),
+                    (metrics.metric('night_frames_captured'), metrics.metric('night_capture_fps'))]
+    last_frame_counts = [counter.get() for counter, _ in fps_counters]
+    preview_oversize = metrics.metric('preview_oversize')
+    telemetry_summary = None
 
     while True:
-        # Check if the camera should be switched
-        if time.time() - last_camera_check >= SWITCH_CHECK_INTERVAL and latest_frame is not None:
-            # Check latest_frame to see if it's too dark
-
-            if frame_is_dark(latest_frame):
-                use_night = True
-                state['night'] = True
-            else:
-                use_night = False
-                state['night'] = False
-                
-            last_camera_check = time.time()
+        # Publish the day camera writer queue counters and the capture rates
+        if time.time() - last_writer_stats_time >= WRITER_STATS_INTERVAL:
+            elapsed = time.time() - last_writer_stats_time
+            last_writer_stats_time = time.time()
+            _, max_depth, dropped = day_cam.get_writer_stats()
+            if (max_depth, dropped) != last_writer_stats:
+                state.update({'record_queue_depth': max_depth, 'record_dropped_frames': dropped})
+                last_writer_stats = (max_depth, dropped)
+            for i, (counter, fps) in enumerate(fps_counters):
+                count = counter.get()
+                fps.set((count - last_frame_counts[i]) / elapsed)
+                last_frame_counts[i] = count
+            preview_oversize.set(preview_ring.dropped())
+        if telemetry_summary is not None:
+            telemetry_summary.update()
+
+        # Check if the camera should be switched, the light meter only switches after a sustained change
+        if time.monotonic() - last_light_sample >= LIGHT_SAMPLE_FRAMES / RECORD_FRAMERATE:
+            level = get_light_level()
+            if level is not None:
+                last_light_sample = time.monotonic()
+                if light_meter.update(level, last_light_sample):
+                    use_night = light_meter.night
+                state.update({'night': use_night, 'light_level': round(light_meter.level or level, 1)})
 
         if last_camera != use_night and state['recording']: # Camera has switched
-            segments.append(f"{state['recording_directory']}/video_{segment_count}.avi")
-
-            segment_count += 1
-
-            if use_night:
-                print("Switching to night camera")
-                frame_id += day_cam.get_frame_id()
-                day_cam.stop_recording()
-                output = FfmpegOutput(f"{state['recording_directory']}/video_{segment_count}.avi")
-                # print("created new encoder")
-                if not night_encoder_running:
-                    night_cam.start_encoder(encoder, output, quality=Quality.HIGH)
-                    night_encoder_running = True
-                    print(f"night time camera recording started: {state['recording_directory']}/video_{segment_count}.avi")
-
-            else:
-                print("Switching to day camera")
-                night_cam.stop_encoder()
-                night_encoder_running = False
-
-                # Set up VideoWriter for recording with the same resolution and framerate as DayCam
-
-                video_writer = cv2.VideoWriter(f"{state['recording_directory']}/video_{segment_count}.avi", fourcc, RECORD_FRAMERATE, RESOLUTION)  # Adjust filename, codec, and parameters as needed
-                video_writer.set(cv2.CAP_PROP_FPS, RECORD_FRAMERATE)
-                print(f"daytime camera recording started: {state['recording_directory']}/video_{segment_count}.avi")
-                day_cam.start_recording(video_writer)
+            print(F"Switching to {'night' if use_night else 'day'} camera")
+            # The previous camera's last segment ends on its last frame, the other camera continues the numbering
+            segment_count, frame_id = stop_segments(last_camera)
+            start_segments(use_night, state['recording_directory'], segment_count, frame_id)
 
             # TODO when you change from dark to light, write to a file that records the frame ID of the switch so Raif's script knows when to switch color processing
             # TODO you have to add a counter to keep track of frame ID. can't use timestamp bc that assumes constant frame times which is not guaranteed
@@ -297,105 +765,10 @@ def camera_worker(preview_framerate, queue, state_arg):
                 with open(day_night_file_path, "a") as f:
                     f.write(f"{frame_id},{use_night}\n")
 
-            segment_start_time = time.time()
             last_camera = use_night
 
-        if state['recording'] and (time.time() - segment_start_time) >= SEGMENT_LENGTH:
-            print("Segment length reached")
-            # cam.stop_recording()
-            if use_night:
-                night_cam.stop_encoder()
-                night_encoder_running = False
-            else:
-                day_cam.stop_recording()
-            print("Encoder stopped")
-            segments.append(f"{state['recording_directory']}/video_{segment_count}.avi")
-            segment_count += 1
-            if use_night:
-                output = FfmpegOutput(f"{state['recording_directory']}/video_{segment_count}.avi")
-                night_cam.start_encoder(encoder, output, quality=Quality.HIGH)
-                night_encoder_running = True
-
-            else:
-                video_writer = cv2.VideoWriter(f"{state['recording_directory']}/video_{segment_count}.avi", fourcc, RECORD_FRAMERATE, RESOLUTION)  # Adjust filename, codec, and parameters as needed
-                video_writer.set(cv2.CAP_PROP_FPS, RECORD_FRAMERATE)
-                day_cam.start_recording(video_writer)
-            segment_start_time = time.time()
-            print(F"Encoder started, recording to {state['recording_directory']}/video_{segment_count}.avi")
-
-        if should_combine:
-            print("Combining segments")
-            # Combine segments using ffmpeg
-            # ffmpeg -i "concat:input1.mp4|input2.mp4|input3.mp4" -c copy output.mp4
-            state['combining'] = True
+        # Segments rotate by themselves in the recording rotator, on an exact frame boundary
 
-            
-            # Concatenate segments in chunks
-            # Keep iterating through segment list, concatenating chunks of SEGMENT_CHUNKS segments at a time
-            # If there are less than SEGMENT_CHUNKS segments left, concatenate the remaining segments and name the output video "video_full.avi"
-            # to_delete = segments
-            # segment_names = []
-            # merge_stage = 1
-            # while len(segments) > SEGMENT_CHUNKS:
-            #     chunk = []
-            #     for i in range(0, len(segments)):
-            #         if len(chunk) < SEGMENT_CHUNKS and i < len(segments):
-            #             chunk.append(segments[i])
-            #         else:
-            #             chunk_concatenated = "|".join(chunk)
-            #             chunk_output = f"{state['recording_directory']}/chunk{merge_stage}_{i//SEGMENT_CHUNKS}.avi"
-            #             cmd = [
-            #                 "ffmpeg",
-            #                 "-i",
-            #                 f"concat:{chunk_concatenated}",
-            #                 "-c", "copy", chunk_output]
-            #             print(f"cmd: {cmd}")
-            #             # os.system(f"ffmpeg -i 'concat:{chunk_concatenated}' -c copy {state['recording_directory']}/video_full.avi")
-            #             subprocess.call(
-            #                 cmd
-            #             )
-            #             segment_names.append(chunk_output)
-            #             to_delete.append(chunk_output)
-            #             chunk = []
-            #     segments = segment_names
-            #     merge_stage += 1
-            # # os.system(f"ffmpeg -i 'concat:{'|'.join(segment_names)}' -c copy {state['recording_directory']}/video_full.avi")
-            # chunk_concatenated = "|".join(segment_names)
-
-            # videoListFile = "videoList.txt"
-            # with open(videoListFile, "w") as f:
-            #     for videoFile in segments:
-            #         f.write(f"file '{videoFile}'\n")
-            # cmd = [
-            #     "ffmpeg",
-            #     "-f", "concat",
-            #     "-safe", "0"
-            #     "-i", "videoList.txt",
-            #     "-c", "copy", f"{state['recording_directory']}/video_full.avi"]
-            # print(f"cmd: {cmd}")
-            # subprocess.call(
-            #     cmd
-            # )
-            # for segment in segments:
-            #     os.remove(segment)
-
-            # segment_names = []
-            # for i in range(1, segment_count + 1):
-            #     segment_names.append(f"{state['recording_directory']}/video_ffmpeged{i}.mp4")
-            #     os.system(f"ffmpeg -y -r {RECORD_FRAMERATE} -i {state['recording_directory']}/video_{i}.mp4 {segment_names[i-1]}") # maybe fix framerate?
-            # os.system(F"ffmpeg -i concat:{'|'.join(segment_names)} -c copy {state['recording_directory']}/video.mp4")
-            # os.system(f"ffmpeg -i 'concat:{'|'.join(segments)}' -c copy {state['recording_directory']}/video_full.avi")
-
-            # Remove segments
-            # for segment in segments:
-            #     os.remove(segment)
-            segments = []
-            segment_count = 1
-            should_combine = False
-            state['recording_directory'] = None
-            print("Combined segments")
-            state['combining'] = False
-        
         if state['should_record'] and not state['recording']:
             # Wait for the recording directory to be set
             while state['recording_directory'] is None:
@@ -409,33 +782,32 @@ def camera_worker(preview_framerate, queue, state_arg):
                 f.write("frame_id,night_true\n")
                 f.write(f"{frame_id},{use_night}\n")
             # Directory for current recording session will have already been created
+            recording_index = frame_index.FrameIndexWriter(os.path.join(state['recording_directory'], frame_index.INDEX_NAME))
+            telemetry_summary = RollingSummary(metrics, state['recording_directory'])
+            if TRAFFIC_COUNTING:
+                traffic_counter = counting.TrafficCounter(state['recording_directory'])
+                state.update({'traffic_forward': 0, 'traffic_backward': 0})
             # Start recording first segment
-            if use_night:
-                output = FfmpegOutput(f"{state['recording_directory']}/video_{segment_count}.avi")
-                night_cam.start_encoder(encoder, output, quality=Quality.HIGH)
-                night_encoder_running = True
-            else:
-                video_writer = cv2.VideoWriter(f"{state['recording_directory']}/video_{segment_count}.avi", fourcc, RECORD_FRAMERATE, RESOLUTION)  # Adjust filename, codec, and parameters as needed
-                video_writer.set(cv2.CAP_PROP_FPS, RECORD_FRAMERATE)
-                day_cam.start_recording(video_writer)
+            start_segments(use_night, state['recording_directory'], segment_count, frame_id)
             state['recording_start_time'] = time.time()
-            segment_start_time = time.time()
-            print(F"Encoder started, recording to {state['recording_directory']}/video_{segment_count}.avi")
             state['recording'] = True
             last_camera = use_night
         elif not state['should_record'] and state['recording']:
             print("Stopping recording")
-            output = None
-            if use_night:
-                night_cam.stop_encoder()
-                night_encoder_running = False
-            else:
-                day_cam.stop_recording()
-            print("Encoder stopped")
-            segments.append(f"{state['recording_directory']}/video_{segment_count}.avi")
+            segment_count, frame_id = stop_segments(last_camera)
+            recording_index.close()
+            recording_index = None
+            telemetry_summary.update(force=True)
+            telemetry_summary = None
+            if traffic_counter is not None:
+                traffic_counter.close()
+                traffic_counter = None
+            # Merging happens in the merge worker process, the camera is ready for the next recording right away
+            merge.queue_session(merge_queue, state['recording_directory'], segments)
+            segments = []
+            segment_count = 1
             state['recording'] = False
             state['recording_directory'] = None # set it only once we're finished writing to that directory
-            should_combine = True
         time.sleep(0.1)
 
 if __name__ == "__main__":
@@ -443,16 +815,8 @@ if __name__ == "__main__":
 
     if DEBUG:
         import multiprocessing
-        preview_queue = multiprocessing.Queue()
-        manager = multiprocessing.Manager()
-        # Use shared dictionary to store device state
-        state = manager.dict()
-        state['should_record'] = False
-        state['recording'] = False
-        state['recording_start_time'] = None
-        state['recording_directory'] = None
-        state['combining'] = False
-        state['night'] = False
-        state['error'] = None
-        state['cam_heartbeat'] = False
-        camera_worker(PREVIEW_FRAMERATE, preview_queue, state)
\ No newline at end of file
+        from frame_ring import FrameRing
+        from shared_state import SharedState
+        preview_ring = FrameRing.create()
+        state = SharedState.create()
+        camera_worker(PREVIEW_FRAMERATE, preview_ring, state, multiprocessing.Queue(), Telemetry())
\ No newline at end of file
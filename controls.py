@@ -0,0 +1,147 @@
+"""
+Buttons and status LEDs without polling.
+
+ButtonWatcher registers an edge callback for every button with
+GPIO.add_event_detect, so a press is noticed when it happens, also while
+the supervisor is busy waiting for a recording to stop or a drive to
+unmount. Every edge restarts a short settle timer and the pin is only read
+once it has been steady for BUTTON_SETTLE_TIME, so contact bounce on press
+and on release never counts as an extra press. Press handlers run on the
+timer thread and should be short, main.py's only write the shared state.
+
+LedController runs every LED pattern on one timer thread: steady on or
+off, blinking until told otherwise, or a number of flashes followed by
+another pattern. The thread sleeps until the next LED has to change, so
+nothing in main.py sleeps to blink an LED.
+"""
+
+import threading
+import time
+
+# Seconds a button has to be steady after its last edge before the press or release counts
+BUTTON_SETTLE_TIME = 0.02
+
+
+class ButtonWatcher:
+    def __init__(self, gpio, settle_time=BUTTON_SETTLE_TIME):
+        """
+        Input: the GPIO module (RPi.GPIO or fake_hardware.gpio), settle time in seconds
+        """
+        self.gpio = gpio
+        self.settle_time = settle_time
+        self.lock = threading.Lock()
+        self.handlers = {}
+        self.timers = {}
+        # Last steady level of every pin
+        self.levels = {}
+
+    def watch(self, pin, handler):
+        """
+        Call handler() every time the button on pin is pressed.
+        The pin has to be set up as an input with a pull up, a press pulls it LOW.
+        """
+        self.handlers[pin] = handler
+        self.levels[pin] = self.gpio.input(pin)
+        self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self.edge)
+
+    def edge(self, pin):
+        # Called by GPIO for every edge, bounces included
+        with self.lock:
+            timer = self.timers.get(pin)
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(self.settle_time, self.settled, (pin,))
+            timer.daemon = True
+            self.timers[pin] = timer
+            timer.start()
+
+    def settled(self, pin):
+        level = self.gpio.input(pin)
+        with self.lock:
+            if level == self.levels[pin]:
+                return
+            self.levels[pin] = level
+        if level == self.gpio.LOW:
+            self.handlers[pin]()
+
+    def close(self):
+        with self.lock:
+            for pin in self.handlers:
+                self.gpio.remove_event_detect(pin)
+            for timer in self.timers.values():
+                timer.cancel()
+
+
+class LedController:
+    def __init__(self, gpio):
+        """
+        Input: the GPIO module, the LED pins have to be set up as outputs
+        """
+        self.gpio = gpio
+        self.changed = threading.Condition()
+        self.levels = {}
+        # pin -> [time of the next change, interval, toggles left or None for no end, what follows]
+        self.blinking = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def set(self, pin, level):
+        """Turn an LED steadily on (GPIO.HIGH) or off (GPIO.LOW), ending any blinking"""
+        with self.changed:
+            self.blinking.pop(pin, None)
+            self.output(pin, level)
+            self.changed.notify()
+
+    def blink(self, pin, interval, flashes=None, then=None):
+        """
+        Blink an LED, starting with it on right away.
+        Input: pin, seconds on and seconds off, number of flashes or None to blink until told otherwise,
+               and what follows the last flash: None to leave the LED off, a GPIO level to set,
+               or a tuple of blink() arguments (interval, flashes, then) for another pattern
+        """
+        with self.changed:
+            self.start_blink(pin, time.monotonic(), interval, flashes, then)
+            self.changed.notify()
+
+    def start_blink(self, pin, now, interval, flashes, then):
+        self.output(pin, self.gpio.HIGH)
+        toggles = None if flashes is None else 2 * flashes - 1
+        self.blinking[pin] = [now + interval, interval, toggles, then]
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+        self.gpio.output(pin, level)
+
+    def run(self):
+        with self.changed:
+            while self.running:
+                now = time.monotonic()
+                for pin, blink in list(self.blinking.items()):
+                    next_change, interval, toggles, then = blink
+                    if next_change > now:
+                        continue
+                    if toggles == 0:
+                        # The last flash is over
+                        del self.blinking[pin]
+                        if isinstance(then, tuple):
+                            self.start_blink(pin, now, *then)
+                        elif then is not None:
+                            self.output(pin, then)
+                        continue
+                    self.output(pin, self.gpio.LOW if self.levels[pin] == self.gpio.HIGH else self.gpio.HIGH)
+                    # Stay on the original schedule unless this thread fell more than an interval behind it
+                    blink[0] = next_change + interval if next_change + interval > now else now + interval
+                    if toggles is not None:
+                        blink[2] = toggles - 1
+                if self.blinking:
+                    self.changed.wait(min(blink[0] for blink in self.blinking.values()) - now)
+                else:
+                    self.changed.wait()
+
+    def close(self):
+        with self.changed:
+            self.running = False
+            self.changed.notify()
+        self.thread.join()
@@ -0,0 +1,201 @@
+"""
+On-device traffic counting.
+
+With camera.TRAFFIC_COUNTING on, a thread in the camera process takes a
+small greyscale copy of the active camera's latest frame (1/COUNTING_SCALE
+of the recording resolution, a reduced JPEG decode on the day camera) and
+feeds it to a TrafficCounter:
+
+- an OpenCV MOG2 background subtractor marks what is not background,
+- the foreground is cleaned up and split into blobs of at least
+  MIN_BLOB_AREA of the frame,
+- blobs are matched to the tracks of the previous frame by nearest
+  centroid, and every track that moves across COUNT_LINE is counted once,
+  in the direction it crossed.
+
+Each recording gets a counts.csv in its session directory with one row
+per minute: the crossings in each direction, and how many frames were
+analysed and skipped. The totals of the current recording are published
+in the shared state, so /status shows them live.
+
+Counting never slows capture down: it works on the latest frame, and a
+frame that took longer than FRAME_BUDGET seconds to analyse makes the
+thread skip as many frames as it took budgets. Tracks allow for the
+skipped frames when matching.
+"""
+
+import math
+import os
+import threading
+import time
+
+import cv2
+
+# Counting line from its first to its second point, in fractions of the frame width and height.
+# 'forward' is crossing from the left of the line to its right, looking from the first point to the second.
+# The default runs top to bottom through the middle, so forward is left to right on screen.
+COUNT_LINE = ((0.5, 0.0), (0.5, 1.0))
+DIRECTION_NAMES = ('forward', 'backward')
+# Most CPU seconds counting may spend per camera frame, on average
+FRAME_BUDGET = 0.015
+# Smallest blob that is tracked, as a fraction of the frame area
+MIN_BLOB_AREA = 0.002
+# Furthest a blob moves between two frames and is still the same track, as a fraction of the frame width
+MAX_TRACK_DISTANCE = 0.08
+# Frames a track survives without a matching blob
+TRACK_TIMEOUT = 10
+# Frames the background model remembers
+BACKGROUND_HISTORY = 300
+COUNTS_NAME = "counts.csv"
+
+
+class Track:
+    def __init__(self, track_id, position):
+        self.track_id = track_id
+        self.position = position
+        self.missed = 0
+        # Every track is counted once, at its first crossing, so someone dithering on the line is not counted twice
+        self.counted = False
+
+
+def side_of(line, point):
+    """Positive on the left of the line (first point to second point, y pointing down), negative on the right"""
+    (ax, ay), (bx, by) = line
+    return (bx - ax) * (point[1] - ay) - (by - ay) * (point[0] - ax)
+
+
+def crosses(line, start, end):
+    """True if the move from start to end goes through the line segment"""
+    if (side_of(line, start) > 0) == (side_of(line, end) > 0):
+        return False
+    # and the line's end points are on different sides of the move
+    return (side_of((start, end), line[0]) > 0) != (side_of((start, end), line[1]) > 0)
+
+
+class TrafficCounter:
+    def __init__(self, directory=None, line=COUNT_LINE, min_area=MIN_BLOB_AREA, max_distance=MAX_TRACK_DISTANCE,
+                 track_timeout=TRACK_TIMEOUT):
+        """
+        Input: session directory for counts.csv (None to only count), counting line and tracking settings as above
+        """
+        self.line = line
+        self.min_area = min_area
+        self.max_distance = max_distance
+        self.track_timeout = track_timeout
+        self.lock = threading.Lock()
+        self.totals = dict((name, 0) for name in DIRECTION_NAMES)
+        self.tracks = []
+        self.next_track_id = 0
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        self.reset()
+        self.path = None if directory is None else os.path.join(directory, COUNTS_NAME)
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                f.write("minute,forward,backward,frames_analysed,frames_skipped\n")
+        self.minute = None
+        self.minute_counts = None
+        self.closed = False
+
+    def reset(self):
+        """Start over with the background and tracks, e.g. after a camera switch. Totals are kept."""
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(history=BACKGROUND_HISTORY, detectShadows=False)
+        self.tracks = []
+
+    def blobs(self, frame):
+        """Centroids of the foreground blobs as fractions of the frame size"""
+        height, width = frame.shape[:2]
+        foreground = self.subtractor.apply(frame)
+        foreground = cv2.morphologyEx(foreground, cv2.MORPH_OPEN, self.kernel)
+        foreground = cv2.dilate(foreground, self.kernel, iterations=2)
+        contours, _ = cv2.findContours(foreground, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        centroids = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if w * h >= self.min_area * width * height:
+                centroids.append(((x + w / 2) / width, (y + h / 2) / height))
+        return centroids
+
+    def track(self, centroids, frames):
+        """
+        Match blobs to tracks and move them.
+        Returns: list of direction names of the tracks that crossed the line
+        """
+        reach = self.max_distance * frames
+        crossings = []
+        # Closest pairs first, every blob and track is used once
+        pairs = sorted((math.dist(track.position, centroid), i, j)
+                       for i, track in enumerate(self.tracks) for j, centroid in enumerate(centroids))
+        matched_tracks = set()
+        matched_blobs = set()
+        for distance, i, j in pairs:
+            if distance > reach:
+                break
+            if i in matched_tracks or j in matched_blobs:
+                continue
+            matched_tracks.add(i)
+            matched_blobs.add(j)
+            track = self.tracks[i]
+            if not track.counted and crosses(self.line, track.position, centroids[j]):
+                track.counted = True
+                crossings.append(DIRECTION_NAMES[0] if side_of(self.line, track.position) > 0 else DIRECTION_NAMES[1])
+            track.position = centroids[j]
+            track.missed = 0
+        unmatched = [centroid for j, centroid in enumerate(centroids) if j not in matched_blobs]
+        tracks = []
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.missed += frames
+            if track.missed <= self.track_timeout:
+                tracks.append(track)
+        for centroid in unmatched:
+            tracks.append(Track(self.next_track_id, centroid))
+            self.next_track_id += 1
+        self.tracks = tracks
+        return crossings
+
+    def update(self, frame, frames=1, now=None):
+        """
+        Analyse one frame.
+        Input: greyscale frame, camera frames since the last analysed one, wall clock time for the minute rows
+        Returns: list of direction names counted in this frame
+        """
+        with self.lock:
+            if self.closed:
+                return []
+            crossings = self.track(self.blobs(frame), frames)
+            for direction in crossings:
+                self.totals[direction] += 1
+            self.add_to_minute(now, crossings, 1, frames - 1)
+            return crossings
+
+    def skip(self, frames, now=None):
+        """Count frames that were not analysed at all, e.g. while there was no camera frame"""
+        with self.lock:
+            if not self.closed:
+                self.add_to_minute(now, (), 0, frames)
+
+    def add_to_minute(self, now, crossings, analysed, skipped):
+        now = time.time() if now is None else now
+        minute = int(now // 60)
+        if minute != self.minute:
+            self.write_minute()
+            self.minute = minute
+            self.minute_counts = dict((name, 0) for name in DIRECTION_NAMES + ('frames_analysed', 'frames_skipped'))
+        for direction in crossings:
+            self.minute_counts[direction] += 1
+        self.minute_counts['frames_analysed'] += analysed
+        self.minute_counts['frames_skipped'] += skipped
+
+    def write_minute(self):
+        if self.path is None or self.minute is None:
+            return
+        counts = self.minute_counts
+        with open(self.path, "a") as f:
+            f.write(F"{time.strftime('%Y-%m-%d %H:%M', time.localtime(self.minute * 60))},{counts['forward']},"
+                    F"{counts['backward']},{counts['frames_analysed']},{counts['frames_skipped']}\n")
+
+    def close(self):
+        """Write the row of the last, partial minute, frames handed over afterwards are ignored"""
+        with self.lock:
+            self.write_minute()
+            self.closed = True
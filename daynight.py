@@ -0,0 +1,115 @@
+"""
+Day/night detection for the camera switch.
+
+The camera worker feeds a LightMeter one light level sample every
+LIGHT_SAMPLE_FRAMES frames. A sample is the mean green value of a strided
+subsample of the active camera's frame, a few thousand pixels instead of
+the whole frame. The meter smooths the samples with an exponential moving
+average and switches with hysteresis: the smoothed level has to drop below
+NIGHT_ENTER_THRESHOLD to go to night and rise above NIGHT_EXIT_THRESHOLD to
+go back to day, and it has to stay past the threshold for SWITCH_HOLD_TIME
+seconds. A passing headlight or shadow moves the average a little for a
+few samples and never switches cameras.
+
+Every decision is logged with the inputs that led to it, so thresholds can
+be tuned from the log. The module only needs the frames to support numpy
+slicing, it does not import cv2 or picamera2.
+"""
+
+# The smoothed green level (0-255) has to drop below this to switch to the night camera
+NIGHT_ENTER_THRESHOLD = 45
+# and rise above this to switch back to the day camera
+NIGHT_EXIT_THRESHOLD = 60
+# Weight of a new sample in the moving average, about a 10 sample time constant
+SMOOTHING = 0.1
+# Seconds the smoothed level has to stay past a threshold before the cameras switch
+SWITCH_HOLD_TIME = 20.0
+# Use every SAMPLE_STRIDE-th pixel of every SAMPLE_STRIDE-th row
+SAMPLE_STRIDE = 8
+
+
+def light_level(frame, stride=SAMPLE_STRIDE):
+    """
+    Input: numpy frame, either BGR/RGB (green is channel 1 in both) or a single channel luma plane
+    Returns: mean level of the strided subsample as a float
+    """
+    if frame.ndim == 3:
+        sample = frame[::stride, ::stride, 1]
+    else:
+        sample = frame[::stride, ::stride]
+    return float(sample.mean())
+
+
+class LightMeter:
+    def __init__(self, night=False, enter_threshold=NIGHT_ENTER_THRESHOLD, exit_threshold=NIGHT_EXIT_THRESHOLD,
+                 smoothing=SMOOTHING, hold_time=SWITCH_HOLD_TIME, log=print):
+        """
+        Input: starting camera, thresholds and timing (defaults above), log(message) for decisions or None.
+               Samples are compared against the thresholds of the camera they were taken from.
+        """
+        self.night = night
+        self.enter_threshold = enter_threshold
+        self.exit_threshold = exit_threshold
+        self.smoothing = smoothing
+        self.hold_time = hold_time
+        self.log = log
+        # Smoothed level, None until the first sample after start or after a camera switch
+        self.level = None
+        self.last_sample = None
+        # Timestamp the smoothed level first went past the threshold, None while it is not past it
+        self.pending_since = None
+        self.started = False
+
+    def past_threshold(self):
+        if self.night:
+            return self.level > self.exit_threshold
+        return self.level < self.enter_threshold
+
+    def decide(self, decision, timestamp):
+        if self.log is None:
+            return
+        held = 0.0 if self.pending_since is None else timestamp - self.pending_since
+        self.log(F"Day/night {decision}: {'night' if self.night else 'day'} camera, sample {self.last_sample:.1f}, "
+                 F"smoothed {self.level:.1f}, enter below {self.enter_threshold}, exit above {self.exit_threshold}, "
+                 F"held {held:.1f}/{self.hold_time}s")
+
+    def update(self, sample, timestamp):
+        """
+        Add one light level sample taken from the active camera.
+        Input: sample from light_level(), timestamp in seconds (monotonic or frame time, only differences are used)
+        Returns: True if the cameras should switch, self.night is the new state
+        """
+        self.last_sample = sample
+        if self.level is None:
+            self.level = sample
+        else:
+            self.level += self.smoothing * (sample - self.level)
+
+        if not self.started:
+            # The very first sample picks the starting camera right away, like the old check did at startup
+            self.started = True
+            if self.past_threshold():
+                self.decide(F"initial switch to {'day' if self.night else 'night'}", timestamp)
+                self.night = not self.night
+                self.level = None
+                return True
+            self.decide("initial", timestamp)
+            return False
+
+        if not self.past_threshold():
+            if self.pending_since is not None:
+                self.decide("switch cancelled", timestamp)
+                self.pending_since = None
+            return False
+        if self.pending_since is None:
+            self.pending_since = timestamp
+            self.decide("switch pending", timestamp)
+            return False
+        if timestamp - self.pending_since < self.hold_time:
+            return False
+        self.decide(F"switch to {'day' if self.night else 'night'}", timestamp)
+        self.night = not self.night
+        self.pending_since = None
+        # The other camera sees the scene differently, start averaging again from its first sample
+        self.level = None
+        return True
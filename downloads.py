@@ -0,0 +1,194 @@
+"""
+Download server for recorded sessions.
+
+Runs on its own port next to the web UI, in the web process, because
+neither the Flask development server nor uvicorn hand out the client
+socket: here the file is copied to the socket with os.sendfile, so
+segments go from the page cache to the network without passing through
+Python. Requests for /sessions/<session>/<file> are served from the
+recording directory on the mounted drive, with single Range requests
+(resumed downloads, seeking in a browser's video player) answered with
+206 Partial Content.
+
+All downloads together read at most DOWNLOAD_RATE_LIMIT bytes per second,
+so pulling a segment over Wi-Fi never takes the flash drive's bandwidth
+away from the recording writer. Downloads stop as soon as the drive is
+about to be unmounted or is gone, so they never keep it busy.
+"""
+
+import http.server
+import mimetypes
+import os
+import select
+import socket
+import threading
+import time
+from urllib.parse import unquote
+
+DOWNLOAD_PORT = 8081
+# Bytes per second for all downloads together, None for no limit
+DOWNLOAD_RATE_LIMIT = 4 * 1024 ** 2
+# Bytes handed to sendfile at a time, also how often the rate limit and the drive are checked
+SENDFILE_CHUNK = 256 * 1024
+# Seconds a client may stall, sending its request or reading the file, before its connection is dropped
+DOWNLOAD_TIMEOUT = 60
+
+mimetypes.add_type('video/x-msvideo', '.avi')
+
+
+class RateLimiter:
+    """Token bucket shared by every download thread"""
+    def __init__(self, rate, burst=SENDFILE_CHUNK):
+        self.rate = rate
+        self.burst = max(burst, SENDFILE_CHUNK)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        """Block until amount bytes may be sent"""
+        if self.rate is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            # Go into debt and sleep it off, later callers queue up behind it
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_range(header, size):
+    """
+    Input: Range header value, file size
+    Returns: (first byte, last byte) inclusive, None to send the whole file (no header, or more than one range)
+    Raises: ValueError if the range is outside the file
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if start == '':
+            # Suffix range, the last N bytes
+            length = int(end)
+            if length <= 0:
+                raise ValueError(header)
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = size - 1 if end == '' else min(int(end), size - 1)
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class DownloadHandler(http.server.BaseHTTPRequestHandler):
+    # Applied to the client socket, so a stalled client doesn't hold a thread and the drive forever
+    timeout = DOWNLOAD_TIMEOUT
+
+    def log_message(self, format, *args):
+        # Requests are not logged, like the web UI's
+        pass
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def file_path(self):
+        """Path of the requested file under the recording directory, None if there is no such file"""
+        root = self.server.root()
+        parts = unquote(self.path.split('?', 1)[0]).strip('/').split('/')
+        if root is None or len(parts) != 3 or parts[0] != 'sessions':
+            return None
+        # One session directory and one file name, nothing that walks out of the recording directory
+        if any(part in ('', '.', '..') or part.startswith('.') for part in parts[1:]):
+            return None
+        path = os.path.join(root, parts[1], parts[2])
+        return path if os.path.isfile(path) else None
+
+    def serve(self, send_body):
+        path = self.file_path()
+        if path is None:
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            try:
+                byte_range = parse_range(self.headers.get('Range'), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', F"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', F"bytes {start}-{end}/{size}")
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            self.send_header('Content-Disposition', F'attachment; filename="{os.path.basename(path)}"')
+            self.end_headers()
+            if send_body:
+                self.send_file(f, start, end + 1 - start)
+
+    def send_file(self, f, offset, remaining):
+        self.wfile.flush()
+        socket_fd = self.connection.fileno()
+        try:
+            while remaining > 0:
+                if self.server.should_stop():
+                    print("Drive is going away, ending download")
+                    break
+                count = min(SENDFILE_CHUNK, remaining)
+                self.server.limiter.take(count)
+                sent = self.sendfile_chunk(socket_fd, f, offset, count)
+                if sent == 0:
+                    # The file got shorter than it was when the headers were sent
+                    break
+                offset += sent
+                remaining -= sent
+        except (BrokenPipeError, ConnectionResetError, socket.timeout, TimeoutError):
+            pass
+        # Whatever was left out, the client notices the short body and can resume with a Range request
+        self.close_connection = True
+
+    def sendfile_chunk(self, socket_fd, f, offset, count):
+        """os.sendfile that waits for the client, the timeout puts the socket in non-blocking mode"""
+        while True:
+            try:
+                return os.sendfile(socket_fd, f.fileno(), offset, count)
+            except BlockingIOError:
+                if not select.select([], [socket_fd], [], self.timeout)[1]:
+                    raise socket.timeout("client stopped reading")
+
+
+class DownloadServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, should_stop=None, port=DOWNLOAD_PORT, rate=DOWNLOAD_RATE_LIMIT):
+        """
+        Input: root() returns the recording directory or None while there is none,
+               should_stop() returns True while downloads have to let go of the drive,
+               port and bytes per second for all downloads together
+        """
+        self.root = root
+        self.should_stop = should_stop if should_stop is not None else lambda: False
+        self.limiter = RateLimiter(rate)
+        super().__init__(('0.0.0.0', port), DownloadHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print(F"Download server listening on port {self.server_address[1]}")
+        return thread
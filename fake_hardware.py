@@ -0,0 +1,526 @@
+"""
+Stand-ins for the camera and GPIO hardware, so camera.py, webui.py and
+main.py can run and be benchmarked on any Linux box.
+
+install() puts fake picamera2 and RPi.GPIO modules into sys.modules and
+replaces cv2.VideoCapture, so it has to run before camera.py or main.py is
+imported:
+
+    import fake_hardware
+    gpio = fake_hardware.install(framerate=20)
+    import camera
+
+Both cameras deliver real JPEG frames at the configured rate. By default
+they are solid grey frames, padded to a realistic size, whose brightness
+follows fake_hardware.scene.level, so a script can fake dusk by lowering
+it. A FileSource replays the frames of a recorded video_N.avi segment
+instead. The fake GPIO keeps pin levels in memory, records every output,
+can script button presses and calls add_event_detect callbacks on their
+edges.
+
+Only numpy and OpenCV are needed (both cameras hand out numpy arrays like
+the real ones), picamera2 and RPi.GPIO are not.
+"""
+
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import types
+
+import avi
+
+# Size of the day camera's JPEG frames at 800x600, the synthetic frames are padded up to this
+SYNTHETIC_FRAME_SIZE = 60 * 1024
+# Comment segment the synthetic frames start with: marker, length, tag and capture time
+STAMP_TAG = b'BWCT'
+STAMP_OFFSET = 10
+STAMP_FORMAT = "<d"
+
+
+class Scene:
+    """What the cameras are looking at, shared by both fake cameras"""
+    def __init__(self, level=128):
+        self.level = level
+
+
+scene = Scene()
+
+
+def _huffman_table(table_class, symbols_by_length):
+    bits = bytes(len(symbols_by_length.get(length, ())) for length in range(1, 17))
+    values = bytes(symbol for length in range(1, 17) for symbol in symbols_by_length.get(length, ()))
+    return b'\xff\xc4' + struct.pack(">HB", 2 + 1 + 16 + len(values), table_class) + bits + values
+
+
+def solid_jpeg(width, height, level=128, size=0):
+    """
+    Baseline greyscale JPEG of a single brightness, written by hand so no image library is needed.
+    Input: frame size, level 0-255, size to pad the file up to with comment segments
+    Returns: JPEG bytes, starting with a comment segment that stamp_frame() can write a time into
+    """
+    # With a quantiser of 1 a flat 8x8 block is just its DC coefficient, 8 * (level - 128)
+    dc = 8 * (min(max(level, 0), 255) - 128)
+    category = abs(dc).bit_length()
+    # Two DC symbols (the first block's difference and 0 for every later block) and one AC symbol, end of block
+    dc_symbols = sorted({0, category or 1})
+    stamp = b'\xff\xfe' + struct.pack(">H", 2 + len(STAMP_TAG) + struct.calcsize(STAMP_FORMAT)) + STAMP_TAG + bytes(8)
+    tables = b'\xff\xdb' + struct.pack(">HB", 67, 0) + bytes([1] * 64)
+    tables += b'\xff\xc0' + struct.pack(">HBHHB", 11, 8, height, width, 1) + bytes([1, 0x11, 0])
+    tables += _huffman_table(0x00, {2: dc_symbols})
+    tables += _huffman_table(0x10, {1: [0x00]})
+    tables += b'\xff\xda' + struct.pack(">HB", 8, 1) + bytes([1, 0x00, 0, 63, 0])
+
+    def dc_code(symbol):
+        return format(dc_symbols.index(symbol), "02b")
+    # Negative values are coded as their ones' complement in `category` bits
+    value = dc if dc >= 0 else dc + (1 << category) - 1
+    bits = dc_code(category) + (format(value, F"0{category}b") if category else "") + "0"
+    blocks = ((width + 7) // 8) * ((height + 7) // 8)
+    bits += (dc_code(0) + "0") * (blocks - 1)
+    bits += "1" * (-len(bits) % 8)
+    data = int(bits, 2).to_bytes(len(bits) // 8, "big").replace(b'\xff', b'\xff\x00')
+
+    padding = b''
+    remaining = size - (2 + len(stamp) + len(tables) + len(data) + 2)
+    while remaining > 4:
+        chunk = min(remaining - 4, 65533)
+        padding += b'\xff\xfe' + struct.pack(">H", chunk + 2) + bytes(chunk)
+        remaining -= chunk + 4
+    return b'\xff\xd8' + stamp + padding + tables + data + b'\xff\xd9'
+
+
+def stamp_frame(frame, timestamp):
+    """Write a capture time into a synthetic frame's comment segment, returns the stamped copy"""
+    frame = bytearray(frame)
+    struct.pack_into(STAMP_FORMAT, frame, STAMP_OFFSET, timestamp)
+    return frame
+
+
+def read_stamp(frame):
+    """Capture time stamped into a synthetic frame, None for any other JPEG"""
+    if bytes(frame[6:STAMP_OFFSET]) != STAMP_TAG:
+        return None
+    return struct.unpack_from(STAMP_FORMAT, frame, STAMP_OFFSET)[0]
+
+
+class SyntheticSource:
+    """Solid frames following scene.level, encoded once per level"""
+    def __init__(self, width, height, frame_size=SYNTHETIC_FRAME_SIZE):
+        self.width = width
+        self.height = height
+        self.frame_size = frame_size
+        self.cache = {}
+
+    def frame(self, number):
+        level = int(scene.level)
+        if level not in self.cache:
+            self.cache[level] = solid_jpeg(self.width, self.height, level, self.frame_size)
+        return self.cache[level]
+
+
+class FileSource:
+    """The frames of a recorded MJPEG AVI segment, looped"""
+    def __init__(self, path):
+        self.frames = [data for _, data in avi.read_frames(path)]
+        if not self.frames:
+            raise ValueError(F"{path} has no frames")
+
+    def frame(self, number):
+        return self.frames[number % len(self.frames)]
+
+
+class Pacer:
+    """Hands out frame numbers at a fixed rate, skipping frames a slow reader missed like a real sensor"""
+    def __init__(self, framerate):
+        self.interval = 1 / framerate if framerate else 0
+        self.next_time = time.monotonic()
+        self.number = 0
+        self.missed = 0
+
+    def wait(self):
+        now = time.monotonic()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        elif self.interval and now - self.next_time > self.interval:
+            missed = int((now - self.next_time) / self.interval)
+            self.missed += missed
+            self.number += missed
+            self.next_time += missed * self.interval
+        number = self.number
+        self.number += 1
+        self.next_time += self.interval
+        return number
+
+
+# Settings install() was called with
+config = {
+    'framerate': 20,
+    'source': None,
+    'devices': (0,),
+}
+
+
+class FakeVideoCapture:
+    """cv2.VideoCapture for a V4L2 MJPEG camera"""
+    def __init__(self, index=0, api=None):
+        import cv2
+        self.cv2 = cv2
+        self.opened = index in config['devices']
+        self.properties = {
+            cv2.CAP_PROP_FRAME_WIDTH: 640,
+            cv2.CAP_PROP_FRAME_HEIGHT: 480,
+            cv2.CAP_PROP_FPS: config['framerate'],
+            cv2.CAP_PROP_CONVERT_RGB: 1,
+            cv2.CAP_PROP_FOURCC: 0,
+        }
+        self.source = None
+        self.pacer = None
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        if not self.opened:
+            return False
+        self.properties[prop] = value
+        return True
+
+    def get(self, prop):
+        return float(self.properties.get(prop, 0))
+
+    def read(self):
+        import numpy
+        if not self.opened:
+            return False, None
+        if self.pacer is None:
+            # Frame size and rate are fixed by the first read, like a started V4L2 stream
+            self.pacer = Pacer(config['framerate'])
+            self.source = config['source'] or SyntheticSource(int(self.get(self.cv2.CAP_PROP_FRAME_WIDTH)),
+                                                              int(self.get(self.cv2.CAP_PROP_FRAME_HEIGHT)))
+        number = self.pacer.wait()
+        frame = stamp_frame(self.source.frame(number), time.monotonic())
+        if self.properties[self.cv2.CAP_PROP_CONVERT_RGB]:
+            return True, self.cv2.imdecode(numpy.frombuffer(frame, numpy.uint8), self.cv2.IMREAD_COLOR)
+        # Undecoded buffers come back as a single row of bytes
+        return True, numpy.frombuffer(frame, numpy.uint8).reshape(1, -1)
+
+    def release(self):
+        self.opened = False
+
+
+class Quality:
+    VERY_LOW = 0
+    LOW = 1
+    MEDIUM = 2
+    HIGH = 3
+    VERY_HIGH = 4
+
+
+class Encoder:
+    pass
+
+
+class H264Encoder(Encoder):
+    pass
+
+
+class MJPEGEncoder(Encoder):
+    pass
+
+
+class Output:
+    def __init__(self, pts=None):
+        self.recording = False
+
+    def start(self):
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        pass
+
+
+class FileOutput(Output):
+    def __init__(self, file=None, pts=None):
+        super().__init__(pts)
+        self.file = file
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        if self.file is not None:
+            self.file.write(frame)
+
+
+class FfmpegOutput(FileOutput):
+    pass
+
+
+class Picamera2:
+    """The CSI camera: main and lores streams and an MJPEG encoder, all synthetic"""
+    def __init__(self, camera_num=0):
+        self.config = None
+        self.started = False
+        self.encoder_thread = None
+        self.encoding = False
+
+    def create_video_configuration(self, main=None, lores=None, controls=None, **kwargs):
+        return {
+            'main': dict({'size': (640, 480), 'format': 'XBGR8888'}, **(main or {})),
+            'lores': None if lores is None else dict({'format': 'YUV420'}, **lores),
+            'controls': dict({'FrameRate': 30}, **(controls or {})),
+        }
+
+    def configure(self, config):
+        self.config = config
+        self.source = config_source(config['main']['size'])
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stop_encoder()
+        self.started = False
+
+    def close(self):
+        self.stop()
+
+    def capture_array(self, name="main"):
+        import numpy
+        level = int(scene.level)
+        width, height = self.config[name]['size']
+        if self.config[name]['format'] == 'YUV420':
+            frame = numpy.full((height * 3 // 2, width), 128, numpy.uint8)
+            frame[:height] = level
+            return frame
+        return numpy.full((height, width, 4), level, numpy.uint8)
+
+    def start_encoder(self, encoder, output, quality=None, **kwargs):
+        self.encoding = True
+        output.start()
+        self.encoder_thread = threading.Thread(target=self.encode_loop, args=(output,))
+        self.encoder_thread.daemon = True
+        self.encoder_thread.start()
+
+    def encode_loop(self, output):
+        pacer = Pacer(self.config['controls']['FrameRate'])
+        while self.encoding:
+            number = pacer.wait()
+            now = time.monotonic()
+            output.outputframe(stamp_frame(self.source.frame(number), now), True, int(now * 1e6))
+
+    def stop_encoder(self, *args):
+        if self.encoder_thread is not None:
+            self.encoding = False
+            self.encoder_thread.join()
+            self.encoder_thread = None
+
+
+def config_source(size):
+    return config['source'] or SyntheticSource(size[0], size[1])
+
+
+class FakeGPIO:
+    """RPi.GPIO with pins kept in memory. Buttons are pulled up, so a press drives the pin LOW."""
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.levels = {}
+        self.directions = {}
+        # (time.monotonic(), pin, value) of every output() call
+        self.history = []
+        # pin -> [edge, bouncetime in seconds, time of the last reported edge, callbacks, edge seen since event_detected()]
+        self.detects = {}
+        # Callbacks run one at a time on their own thread, like RPi.GPIO's
+        self.callback_queue = queue.Queue()
+        self.callback_thread = None
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=None):
+        with self.lock:
+            self.directions[pin] = direction
+            if direction == self.IN:
+                self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+            else:
+                self.levels[pin] = self.LOW if initial is None else initial
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def output(self, pin, value):
+        with self.lock:
+            self.levels[pin] = value
+            self.history.append((time.monotonic(), pin, value))
+
+    def cleanup(self, *args):
+        with self.lock:
+            self.levels.clear()
+            self.directions.clear()
+            self.detects.clear()
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            if pin in self.detects:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self.detects[pin] = [edge, (bouncetime or 0) / 1000, None, [], False]
+            if self.callback_thread is None:
+                self.callback_thread = threading.Thread(target=self.run_callbacks)
+                self.callback_thread.daemon = True
+                self.callback_thread.start()
+        if callback is not None:
+            self.add_event_callback(pin, callback)
+
+    def add_event_callback(self, pin, callback):
+        with self.lock:
+            self.detects[pin][3].append(callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.detects.pop(pin, None)
+
+    def event_detected(self, pin):
+        with self.lock:
+            detect = self.detects.get(pin)
+            if detect is None or not detect[4]:
+                return False
+            detect[4] = False
+            return True
+
+    def run_callbacks(self):
+        while True:
+            callback, pin = self.callback_queue.get()
+            callback(pin)
+
+    def set_input(self, pin, level):
+        """Drive an input pin from outside, like a button or a switch would, and report the edge"""
+        with self.lock:
+            previous = self.levels.get(pin)
+            self.levels[pin] = level
+            detect = self.detects.get(pin)
+            if detect is None or previous == level:
+                return
+            edge, bouncetime, last_edge, callbacks, _ = detect
+            if edge != self.BOTH and edge != (self.RISING if level == self.HIGH else self.FALLING):
+                return
+            now = time.monotonic()
+            # Like RPi.GPIO, edges within bouncetime of the last reported one are dropped
+            if last_edge is not None and now - last_edge < bouncetime:
+                return
+            detect[2] = now
+            detect[4] = True
+            for callback in callbacks:
+                self.callback_queue.put((callback, pin))
+
+    def press(self, pin, duration=0.1, bounces=0):
+        """
+        Press and release a button on its own thread.
+        Input: pin, how long it stays pressed, and how many times the contact bounces on press and on release
+        """
+        def run():
+            for _ in range(bounces):
+                self.set_input(pin, self.LOW)
+                time.sleep(0.001)
+                self.set_input(pin, self.HIGH)
+                time.sleep(0.001)
+            self.set_input(pin, self.LOW)
+            time.sleep(duration)
+            for _ in range(bounces):
+                self.set_input(pin, self.HIGH)
+                time.sleep(0.001)
+                self.set_input(pin, self.LOW)
+                time.sleep(0.001)
+            self.set_input(pin, self.HIGH)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def script(self, presses):
+        """
+        Run a list of (seconds from now, pin, press duration) button presses on a thread
+        """
+        def run():
+            start = time.monotonic()
+            for at, pin, duration in sorted(presses):
+                delay = start + at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.press(pin, duration).join()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+gpio = FakeGPIO()
+# cv2.VideoCapture from before install(), for code that still has to read real video files
+real_video_capture = None
+
+
+def install(framerate=20, source=None, devices=(0,), mount_point=None):
+    """
+    Make picamera2, RPi.GPIO and cv2.VideoCapture the fakes in this process.
+    Input: camera frame rate (0 for as fast as the reader goes), a FileSource or None for synthetic
+           frames, the day camera device indexes that open, and a directory mounts.py should report
+           as a mounted removable drive (None for only the real ones)
+    Returns: the FakeGPIO instance
+    """
+    global real_video_capture
+    import cv2
+    import mounts
+    config['framerate'] = framerate
+    config['source'] = source
+    config['devices'] = tuple(devices)
+
+    picamera2 = types.ModuleType("picamera2")
+    picamera2.Picamera2 = Picamera2
+    encoders = types.ModuleType("picamera2.encoders")
+    encoders.Encoder = Encoder
+    encoders.H264Encoder = H264Encoder
+    encoders.MJPEGEncoder = MJPEGEncoder
+    encoders.Quality = Quality
+    outputs = types.ModuleType("picamera2.outputs")
+    outputs.Output = Output
+    outputs.FileOutput = FileOutput
+    outputs.FfmpegOutput = FfmpegOutput
+    picamera2.encoders = encoders
+    picamera2.outputs = outputs
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules.update({
+        'picamera2': picamera2,
+        'picamera2.encoders': encoders,
+        'picamera2.outputs': outputs,
+        'RPi': rpi,
+        'RPi.GPIO': gpio,
+    })
+    if cv2.VideoCapture is not FakeVideoCapture:
+        real_video_capture = cv2.VideoCapture
+    cv2.VideoCapture = FakeVideoCapture
+    if mount_point is not None:
+        os.makedirs(mount_point, exist_ok=True)
+        real_mount_points = mounts.removable_mount_points
+        mounts.removable_mount_points = lambda text, sysfs=mounts.SYSFS_DEV_BLOCK: \
+            [mount_point] + real_mount_points(text, sysfs)
+    return gpio
@@ -0,0 +1,167 @@
+"""
+Per-frame index of a recording session.
+
+Every recorded frame gets one fixed size record in frames.idx in the
+session directory:
+
+    frame_id    uint64   global frame id, the same ids day_night.csv uses
+    timestamp   float64  time.monotonic() when the frame was captured
+    segment     uint32   N of the video_N.avi segment the frame is in
+    camera      uint8    CAMERA_DAY or CAMERA_NIGHT
+    offset      uint64   byte offset of the frame's chunk in the segment,
+                         OFFSET_UNKNOWN if the writer can't tell
+
+Records are packed into a fixed size buffer and appended to the file
+FLUSH_RECORDS at a time, so the recording threads never do a write per
+frame. A crash loses at most the records still in the buffer, and a torn
+last record is ignored by the reader.
+
+Frame ids and timestamps only go up, so FrameIndex can find a frame by id
+or by time with a binary search, without reading the video.
+
+Convert an index to CSV with:
+    python3 frame_index.py <session>/frames.idx [output.csv]
+"""
+
+import argparse
+import os
+import struct
+import sys
+import threading
+from collections import namedtuple
+
+INDEX_NAME = "frames.idx"
+MAGIC = b'BWFI'
+VERSION = 1
+HEADER_FORMAT = "<4sHH8x"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = "<QdIB3xQ"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+# Records kept in memory before they are appended to the file, about 13 seconds at 20 fps
+FLUSH_RECORDS = 256
+
+CAMERA_DAY = 0
+CAMERA_NIGHT = 1
+CAMERA_NAMES = {CAMERA_DAY: 'day', CAMERA_NIGHT: 'night'}
+OFFSET_UNKNOWN = 2 ** 64 - 1
+
+FrameRecord = namedtuple('FrameRecord', ['frame_id', 'timestamp', 'segment', 'camera', 'offset'])
+
+
+class FrameIndexWriter:
+    def __init__(self, path):
+        """Create a new index file at path, replacing an old one"""
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE))
+        self.buffer = bytearray(FLUSH_RECORDS * RECORD_SIZE)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, frame_id, timestamp, segment, camera, offset=None):
+        """Add the record for one frame, called by the thread that wrote the frame"""
+        if offset is None:
+            offset = OFFSET_UNKNOWN
+        with self.lock:
+            struct.pack_into(RECORD_FORMAT, self.buffer, self.count * RECORD_SIZE,
+                             frame_id, timestamp, segment, camera, offset)
+            self.count += 1
+            if self.count == FLUSH_RECORDS:
+                self._flush()
+
+    def _flush(self):
+        if self.count:
+            self.file.write(memoryview(self.buffer)[:self.count * RECORD_SIZE])
+            self.file.flush()
+            self.count = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self._flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+
+class FrameIndex:
+    """Read access to a frames.idx file. Works on an index that is still being written."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER_SIZE:
+            raise ValueError(F"{path} is not a frame index")
+        magic, version, record_size = struct.unpack_from(HEADER_FORMAT, data)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            raise ValueError(F"{path} is not a version {VERSION} frame index")
+        self.data = data
+        # A record cut off by a crash is left out
+        self.count = (len(data) - HEADER_SIZE) // RECORD_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return FrameRecord._make(struct.unpack_from(RECORD_FORMAT, self.data, HEADER_SIZE + i * RECORD_SIZE))
+
+    def __iter__(self):
+        for fields in struct.iter_unpack(RECORD_FORMAT, self.data[HEADER_SIZE:HEADER_SIZE + self.count * RECORD_SIZE]):
+            yield FrameRecord._make(fields)
+
+    def _search(self, field, value):
+        # First record whose field is >= value
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle][field] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_frame(self, frame_id):
+        """
+        Returns: the FrameRecord of frame_id, None if that frame is not in the index
+        """
+        i = self._search(0, frame_id)
+        if i < self.count and self[i].frame_id == frame_id:
+            return self[i]
+        return None
+
+    def find_time(self, timestamp):
+        """
+        Returns: the FrameRecord of the first frame captured at or after timestamp, None if there is none
+        """
+        i = self._search(1, timestamp)
+        if i < self.count:
+            return self[i]
+        return None
+
+
+def write_csv(index, f):
+    f.write("frame_id,timestamp,segment,camera,offset\n")
+    for record in index:
+        offset = "" if record.offset == OFFSET_UNKNOWN else record.offset
+        f.write(F"{record.frame_id},{record.timestamp:.6f},{record.segment},{CAMERA_NAMES[record.camera]},{offset}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a frames.idx frame index to CSV")
+    parser.add_argument("index", help="path of the frames.idx file")
+    parser.add_argument("output", nargs="?", help="CSV file to write, standard output if left out")
+    args = parser.parse_args()
+    index = FrameIndex(args.index)
+    if args.output is None:
+        write_csv(index, sys.stdout)
+    else:
+        with open(args.output, 'w') as f:
+            write_csv(index, f)
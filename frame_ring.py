@@ -0,0 +1,140 @@
+"""
+Fixed-size ring of preview frame slots in shared memory.
+
+The camera process writes encoded preview frames into the ring and the web
+process reads the most recent one. Memory use is fixed at creation time and
+the writer never waits for readers: a slow reader simply skips the frames
+that were overwritten while it was busy.
+
+Layout of the shared memory block:
+- Header: slot count, slot size, the sequence number of the latest frame and
+  the current preview demand (viewer count, frame rate and JPEG quality)
+- Slots: each slot has a small header (begin sequence, end sequence, length)
+  followed by slot_size bytes of frame data
+
+Sequence numbers start at 1 and only ever increase, a sequence of 0 means
+"no frame yet". Frame N lives in slot N % slot count. The writer stamps the
+begin sequence before copying the data and the end sequence after, so a
+reader can tell that a slot was overwritten while it was being read by
+checking that both stamps still match the sequence it wanted.
+"""
+
+import struct
+
+from shared_block import SharedBlock
+
+# slot_count, slot_size, latest_seq, dropped (frames too big for a slot)
+HEADER_FORMAT = "<IIQQ"
+# viewers, quality, framerate. Written by the web process, read by the camera process
+DEMAND_FORMAT = "<IIf"
+DEMAND_OFFSET = 24
+HEADER_SIZE = 64
+# begin_seq, end_seq, length
+SLOT_HEADER_FORMAT = "<QQI"
+SLOT_HEADER_SIZE = 24
+
+
+class FrameRing(SharedBlock):
+    VIEWS = ('buf',)
+
+    def __init__(self, shm, owner=False):
+        super().__init__(shm, owner)
+        self.buf = shm.buf
+        self.slot_count, self.slot_size, _, _ = struct.unpack_from(HEADER_FORMAT, self.buf, 0)
+        self.stride = SLOT_HEADER_SIZE + self.slot_size
+
+    @classmethod
+    def create(cls, slot_count=4, slot_size=1024 * 1024, name=None):
+        """Allocate a new ring, to be called once by the process that owns it"""
+        size = HEADER_SIZE + slot_count * (SLOT_HEADER_SIZE + slot_size)
+        shm = cls.allocate(size, name)
+        struct.pack_into(HEADER_FORMAT, shm.buf, 0, slot_count, slot_size, 0, 0)
+        struct.pack_into(DEMAND_FORMAT, shm.buf, DEMAND_OFFSET, 0, 0, 0.0)
+        for i in range(slot_count):
+            struct.pack_into(SLOT_HEADER_FORMAT, shm.buf, HEADER_SIZE + i * (SLOT_HEADER_SIZE + slot_size), 0, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to a ring created by another process"""
+        return cls(cls.attach_block(name))
+
+    def _slot_offset(self, seq):
+        return HEADER_SIZE + (seq % self.slot_count) * self.stride
+
+    def latest_seq(self):
+        """Sequence number of the most recent complete frame, 0 if none"""
+        return struct.unpack_from("<Q", self.buf, 8)[0]
+
+    def dropped(self):
+        """Number of frames the writer dropped because they did not fit in a slot"""
+        return struct.unpack_from("<Q", self.buf, 16)[0]
+
+    def set_demand(self, viewers, framerate, quality):
+        """Publish how many viewers are connected and the highest rate and quality any of them wants"""
+        struct.pack_into(DEMAND_FORMAT, self.buf, DEMAND_OFFSET, viewers, quality, framerate)
+
+    def demand(self):
+        """
+        Returns: (viewers, framerate, quality) as last published by the web process
+        """
+        viewers, quality, framerate = struct.unpack_from(DEMAND_FORMAT, self.buf, DEMAND_OFFSET)
+        return viewers, framerate, quality
+
+    def write(self, data):
+        """
+        Copy one encoded frame into the next slot and publish it as the latest frame.
+        Input: bytes-like frame data
+        Returns: the sequence number of the frame, or None if it was too large for a slot
+        """
+        length = len(data)
+        if length > self.slot_size:
+            struct.pack_into("<Q", self.buf, 16, self.dropped() + 1)
+            return None
+        seq = self.latest_seq() + 1
+        offset = self._slot_offset(seq)
+        # Mark the slot as being written before touching the data
+        struct.pack_into("<Q", self.buf, offset, seq)
+        data_offset = offset + SLOT_HEADER_SIZE
+        self.buf[data_offset:data_offset + length] = data
+        struct.pack_into("<QI", self.buf, offset + 8, seq, length)
+        struct.pack_into("<Q", self.buf, 8, seq)
+        return seq
+
+    def view(self, seq):
+        """
+        Zero-copy view of the frame with the given sequence number.
+        The view is only trustworthy if is_valid(seq) is still True after it has been used.
+        Returns: memoryview of the frame data, or None if the slot no longer holds that frame
+        """
+        if seq <= 0:
+            return None
+        offset = self._slot_offset(seq)
+        _, end_seq, length = struct.unpack_from(SLOT_HEADER_FORMAT, self.buf, offset)
+        if end_seq != seq:
+            return None
+        data_offset = offset + SLOT_HEADER_SIZE
+        return self.buf[data_offset:data_offset + length]
+
+    def is_valid(self, seq):
+        """True if the slot for seq has not started being overwritten"""
+        begin_seq = struct.unpack_from("<Q", self.buf, self._slot_offset(seq))[0]
+        return begin_seq == seq
+
+    def read_latest(self, after_seq=0):
+        """
+        Copy out the most recent frame if it is newer than after_seq.
+        Returns: (seq, bytes), or (after_seq, None) if there is nothing newer
+        """
+        while True:
+            seq = self.latest_seq()
+            if seq <= after_seq:
+                return after_seq, None
+            view = self.view(seq)
+            if view is None:
+                continue
+            frame = bytes(view)
+            view.release()
+            if self.is_valid(seq):
+                return seq, frame
+            # The writer lapped us while copying, try again with the newer frame
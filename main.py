@@ -24,6 +24,7 @@ Software Dependencies:
 - Picamera2
 - OpenCV
 - Flask
+- uvicorn (optional, only for ASYNC_WEB_SERVER)
 
 Authors:
 - Andrei Gerashchenko
@@ -31,18 +32,31 @@ Authors:
 - Wending Wu
 
 TODO:
-- Make button pushes work with interrupts
 - Draw a state diagram for the program and rewrite it according to that
 """
 
 import multiprocessing
 import time
 import os
-import json
+
+# Run on fake_hardware.py's cameras and GPIO, e.g. on a laptop: BWCT_FAKE_HARDWARE=1 python main.py
+# BWCT_FAKE_DRIVE=<directory> records to that directory as if it was a mounted drive
+if os.environ.get("BWCT_FAKE_HARDWARE"):
+    import fake_hardware
+    fake_hardware.install(mount_point=os.environ.get("BWCT_FAKE_DRIVE"))
+
 import RPi.GPIO as GPIO
 
 import camera
+import merge
+import mounts
+import storage
 import webui
+import webui_async
+from controls import ButtonWatcher, LedController
+from frame_ring import FrameRing
+from shared_state import SharedState
+from telemetry import Telemetry
 
 ## CONSTANTS 
 ### LED Pins
@@ -59,48 +73,26 @@ MOUNT_BTN_PIN = 23
 PREVIEW_FRAMERATE = 30.0
 FAST_LED_BLINK_INTERVAL = 0.1
 SLOW_LED_BLINK_INTERVAL = 1.0
-DEBOUNCE_TIME = 0.25
+# Longest the main loop sleeps without a state change, a fallback for anything that does not write the state
+STATE_WAIT_TIMEOUT = 1.0
+PREVIEW_RING_SLOTS = 4
+PREVIEW_RING_SLOT_SIZE = 1024 * 1024 # bytes, comfortably above a high quality 800x600 JPEG
+# Serve the web UI from a single asyncio event loop (needs uvicorn) instead of Flask's threaded server
+ASYNC_WEB_SERVER = False
 RECORDING_MAIN_DIRECTORY = "/recordings"
 RECORDING_SESSION_DIRECTORY_FORMAT = "%Y%m%d-%H%M%S"
 
-def get_mount_point():
+def wait_until(state, condition, timeout=STATE_WAIT_TIMEOUT):
     """
-    Get a list of all storage devices and find the mount point path of the first removable media
-    Input: None
-    Returns: None if no SD card/removable media is found, otherwise returns the mount point path as a string
+    Sleep until condition() is true, checking it every time the shared state changes
+    Input: shared state, condition function, longest sleep between checks in seconds
     """
-    
-    # Get list of storage devices and the partitions on them
-    # using terminal command `lsblk --json -o NAME,MOUNTPOINT`
-    devices = os.popen("lsblk --json -o NAME,MOUNTPOINT").read()
-    # Parse the JSON output
-    devices = json.loads(devices)
-    # Find the first device with a mount point and sd in the name
-    # when you mount any removable media (SD card/flash drive) onto Linux Pi, it will have
-    # a naming convention of "sd*" where * is some letter.
-    for device in devices['blockdevices']:
-        # Check if device is sd* and has children
-        # The children are the partitions on the drive
-        if device['name'][:2] == "sd" and 'children' in device:
-            # Check if any children have a mount point
-            for child in device['children']:
-                if 'mountpoint' in child:
-                    return child['mountpoint']
-    return None
+    version = state.version()
+    while not condition():
+        version = state.wait_for_change(version, timeout)
 
 # Main Thread
 if __name__ == '__main__':
-    # STATES
-    power_led_time = 0
-    power_led_state = GPIO.HIGH
-    recording_led_time = 0
-    recording_led_state = GPIO.LOW
-    mount_led_time = 0
-    mount_led_state = GPIO.LOW
-    power_btn_time = 0
-    recording_btn_time = 0
-    mount_btn_time = 0
-
     # GPIO PIN SETUP
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(POWER_LED_PIN, GPIO.OUT)
@@ -110,43 +102,50 @@ if __name__ == '__main__':
     GPIO.setup(RECORDING_BTN_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
     GPIO.setup(MOUNT_BTN_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
-    # Initialize status LEDs with their initial states
-    GPIO.output(POWER_LED_PIN, power_led_state)
-    GPIO.output(RECORDING_LED_PIN, recording_led_state)
-    GPIO.output(MOUNT_LED_PIN, mount_led_state)
-
-    # Pass frames from Camera to Web UI
-    preview_queue = multiprocessing.Queue()
-
-    # Use shared dictionary to store device state
-    manager = multiprocessing.Manager()
-    state = manager.dict()
-    state['should_record'] = False
-    state['recording'] = False
-    state['recording_start_time'] = None
-    state['recording_duration'] = None
-    state['recording_directory'] = None
-    state['combining'] = False
-    state['night'] = False
-    state['error'] = None
-    state['cam_heartbeat'] = False
-    state['web_heartbeat'] = False
-    state['mounted'] = False
-    state['sd_use'] = 0.0
-    state['shutdown_requested'] = False
-    state['reboot_requested'] = False
-    state['mount_requested'] = False
-    last_should_record = state['should_record']
+    # Initialize status LEDs with their initial states, blinking runs on the LED controller's timer thread
+    leds = LedController(GPIO)
+    leds.set(POWER_LED_PIN, GPIO.HIGH)
+    leds.set(RECORDING_LED_PIN, GPIO.LOW)
+    leds.set(MOUNT_LED_PIN, GPIO.LOW)
+
+    # Pass frames from Camera to Web UI through a fixed-size shared memory ring
+    preview_ring = FrameRing.create(slot_count=PREVIEW_RING_SLOTS, slot_size=PREVIEW_RING_SLOT_SIZE)
+
+    # Device state shared with the worker processes, see shared_state.FIELDS for the fields and defaults
+    state = SharedState.create()
+    # Pipeline counters and latency histograms, written by the camera and web processes, served at /metrics
+    telemetry = Telemetry.create()
+
+    # The buttons do what the web UI's buttons do: their handlers only write the shared state,
+    # which wakes up the main loop. Presses are caught by edge interrupts, also while the loop is busy.
+    def toggle_recording():
+        state['should_record'] = not state['should_record']
+
+    buttons = ButtonWatcher(GPIO)
+    buttons.watch(POWER_BTN_PIN, lambda: state.update({'shutdown_requested': True}))
+    buttons.watch(RECORDING_BTN_PIN, toggle_recording)
+    buttons.watch(MOUNT_BTN_PIN, lambda: state.update({'mount_requested': True}))
+
+    # Removable drives coming and going are written to the shared state too, see mounts.py
+    mount_watcher = mounts.MountWatcher(on_change=lambda mount_point: state.update({'media_mount_point': mount_point}))
+    mount_watcher.start()
+
+    # Sessions waiting to have their segments merged
+    merge_queue = multiprocessing.Queue()
 
     # Start camera.camera_worker in a separate process
     camera_process = multiprocessing.Process(
-        target=camera.camera_worker, args=(PREVIEW_FRAMERATE, preview_queue, state))
+        target=camera.camera_worker, args=(PREVIEW_FRAMERATE, preview_ring, state, merge_queue, telemetry))
     camera_process.start()
     camera_worker_running = True
 
-    # Start webui.web_worker in a separate process
+    # Start merge.merge_worker in a separate, low priority process
+    merge_process = multiprocessing.Process(target=merge.merge_worker, args=(merge_queue, state))
+    merge_process.start()
+
+    # Start webui.web_worker (or its asyncio counterpart) in a separate process
     web_process = multiprocessing.Process(
-        target=webui.web_worker, args=(PREVIEW_FRAMERATE, preview_queue, state))
+        target=webui_async.web_worker if ASYNC_WEB_SERVER else webui.web_worker, args=(PREVIEW_FRAMERATE, preview_ring, state, telemetry))
     web_process.start()
     web_worker_running = True
 
@@ -156,32 +155,45 @@ if __name__ == '__main__':
     mounted = False
     # string to the path of the mount point directory
     mount_point = None
+    # mount_point + RECORDING_MAIN_DIRECTORY
+    recording_main_directory = None
+    # Free space of the mounted drive, None while nothing is mounted
+    storage_monitor = None
     print("Looking for mount point")
-    while mount_point is None:
-        mount_point = get_mount_point()
-        if mount_led_state == GPIO.HIGH:
-            mount_led_state = GPIO.LOW
-        else:
-            mount_led_state = GPIO.HIGH
-        GPIO.output(MOUNT_LED_PIN, mount_led_state)
-        time.sleep(FAST_LED_BLINK_INTERVAL)
-        if GPIO.input(POWER_BTN_PIN) == GPIO.LOW:
-                state['should_record'] = False
-                GPIO.output(POWER_LED_PIN, GPIO.HIGH)
-                os.system("poweroff")
+    leds.blink(MOUNT_LED_PIN, FAST_LED_BLINK_INTERVAL)
+    while state['media_mount_point'] is None:
+        wait_until(state, lambda: state['media_mount_point'] is not None or state['shutdown_requested'] == True)
+        if state['shutdown_requested'] == True:
+            state['should_record'] = False
+            leds.set(POWER_LED_PIN, GPIO.HIGH)
+            os.system("poweroff")
+            state['shutdown_requested'] = False
+    mount_point = state['media_mount_point']
     print(F"Found mount point: {mount_point}")
     mounted = True
     state['mounted'] = True
-    mount_led_state = GPIO.HIGH
-    GPIO.output(MOUNT_LED_PIN, mount_led_state)
+    storage_monitor = storage.StorageMonitor(mount_point)
+    leds.set(MOUNT_LED_PIN, GPIO.HIGH)
 
     # Set the recording directory to the first SD card mount point
-    RECORDING_MAIN_DIRECTORY = mount_point + RECORDING_MAIN_DIRECTORY
+    recording_main_directory = mount_point + RECORDING_MAIN_DIRECTORY
     # Create the recording directory if it doesn't exist
-    if not os.path.exists(RECORDING_MAIN_DIRECTORY):
-        os.makedirs(RECORDING_MAIN_DIRECTORY)
-
-    # MAIN WHILE LOOP
+    if not os.path.exists(recording_main_directory):
+        os.makedirs(recording_main_directory)
+    # The web UI's session browser lists and serves this directory
+    state['recording_main_directory'] = recording_main_directory
+    # Finish merges that were interrupted by a power loss
+    for directory in merge.find_unfinished(recording_main_directory):
+        merge_queue.put(directory)
+
+    # Set once the stop of the current recording has been handled, until the camera has stopped
+    recording_stopping = False
+    next_duration_update = 0
+
+    # MAIN LOOP
+    # Sleeps until the shared state changes (a button, the web UI or a worker wrote it)
+    # or the next periodic job is due, instead of polling every 100 ms
+    version = state.version()
     while True:
         # if camera_worker_running and state['cam_heartbeat']:
         #     last_cam_heartbeat = time.time()
@@ -197,139 +209,115 @@ if __name__ == '__main__':
         #     state['recording_duration'] = 0
         #     state['error'] = "Camera worker process stopped unexpectedly, video segments may not have been merged. Please restart recording device."
 
-        # Control for Power Button
-        if GPIO.input(POWER_BTN_PIN) == GPIO.LOW or state['shutdown_requested'] == True:
-            if power_led_state == GPIO.HIGH:
-                state['should_record'] = False
-                while (state['recording'] == True or state['combining'] == True) and camera_worker_running and web_worker_running:
-                    if power_led_state == GPIO.HIGH:
-                        power_led_state = GPIO.LOW
-                    else:
-                        power_led_state = GPIO.HIGH
-                    time.sleep(FAST_LED_BLINK_INTERVAL)
-                    GPIO.output(POWER_LED_PIN, power_led_state)
-                GPIO.output(POWER_LED_PIN, GPIO.HIGH)
-                os.system("shutdown now")
-            state['shutdown_requested'] = False
-
-        if state['reboot_requested'] == True:
-            if power_led_state == GPIO.HIGH:
+        # Control for Power Button and the web UI's shutdown and reboot
+        if state['shutdown_requested'] == True or state['reboot_requested'] == True:
+            command = "shutdown now" if state['shutdown_requested'] == True else "reboot now"
+            state['should_record'] = False
+            leds.blink(POWER_LED_PIN, FAST_LED_BLINK_INTERVAL)
+            wait_until(state, lambda: not (state['recording'] == True or state['combining'] == True)
+                       or not (camera_worker_running and web_worker_running))
+            leds.set(POWER_LED_PIN, GPIO.HIGH)
+            os.system(command)
+            state.update({'shutdown_requested': False, 'reboot_requested': False})
+
+        # Control for Mount Button and the web UI's mount button
+        if state['mount_requested'] == True:
+            # Unmount SD card if mounted
+            if mounted:
+                print("Unmounting SD card")
+                # Stop recording if recording
                 state['should_record'] = False
-                while (state['recording'] == True or state['combining'] == True) and camera_worker_running and web_worker_running:
-                    if power_led_state == GPIO.HIGH:
-                        power_led_state = GPIO.LOW
+                # ffmpeg keeps the drive busy while merging, the merge resumes after the next mount otherwise
+                wait_until(state, lambda: state['recording'] == False and state['combining'] == False)
+                leds.blink(MOUNT_LED_PIN, FAST_LED_BLINK_INTERVAL)
+                while mounted:
+                    # Unmount with umount, checking to see whether it was successful
+                    # os.system(f"partprobe {mount_point}")
+                    if os.system(F"umount {mount_point}") == 0:
+                        print("Unmounted SD card")
+                        mounted = False
+                        state.update({'mounted': False, 'recording_main_directory': None})
+                        mount_point = None
+                        storage_monitor = None
+                        leds.set(MOUNT_LED_PIN, GPIO.LOW)
                     else:
-                        power_led_state = GPIO.HIGH
-                    time.sleep(FAST_LED_BLINK_INTERVAL)
-                    GPIO.output(POWER_LED_PIN, power_led_state)
-                GPIO.output(POWER_LED_PIN, GPIO.HIGH)
-                os.system("reboot now")
-            state['reboot_requested'] = False
-
-        # Control for Recording Button
-        if GPIO.input(RECORDING_BTN_PIN) == GPIO.LOW:
-            if time.time() - recording_btn_time >= DEBOUNCE_TIME:
-                recording_btn_time = time.time()
-                state['should_record'] = not state['should_record']
-
-        # Control for Mount Button
-        if GPIO.input(MOUNT_BTN_PIN) == GPIO.LOW or state['mount_requested'] == True:
-            if time.time() - mount_btn_time >= DEBOUNCE_TIME:
-                mount_btn_time = time.time()
-
-                # Unmount SD card if mounted
-                if mounted:
-                    print("Unmounting SD card")
-                    # Stop recording if recording
-                    state['should_record'] = False
-                    while state['recording'] == True:
-                        time.sleep(0.1)
-                    while mounted:
-                        if mount_led_state == GPIO.HIGH:
-                            mount_led_state = GPIO.LOW
-                        else:
-                            mount_led_state = GPIO.HIGH
-                        GPIO.output(MOUNT_LED_PIN, mount_led_state)   
-                        time.sleep(FAST_LED_BLINK_INTERVAL) 
-                        # Unmount with umount, checking to see whether it was successful
-                        # os.system(f"partprobe {mount_point}")
-                        if os.system(F"umount {mount_point}") == 0:
-                            print("Unmounted SD card")
-                            mounted = False
-                            state['mounted'] = False
-                            mount_point = None
-                            mount_led_state = GPIO.LOW
-                            GPIO.output(MOUNT_LED_PIN, mount_led_state)
-                else:
-                    print("Mounting SD card")
-                    # Mount SD card if not mounted
-                    while mount_point is None:
-                        mount_point = get_mount_point()
-                        if mount_led_state == GPIO.HIGH:
-                            mount_led_state = GPIO.LOW
-                        else:
-                            mount_led_state = GPIO.HIGH
-                        GPIO.output(MOUNT_LED_PIN, mount_led_state)
                         time.sleep(FAST_LED_BLINK_INTERVAL)
-                    print("Mounted SD card")
-                    mounted = True
-                    state['mounted'] = True
-                    mount_led_state = GPIO.HIGH
-                    GPIO.output(MOUNT_LED_PIN, mount_led_state)
-                    # Set the recording directory to the first SD card mount point
-                    RECORDING_MAIN_DIRECTORY = mount_point + RECORDING_MAIN_DIRECTORY
-                    # Create the recording directory if it doesn't exist
-                    if not os.path.exists(RECORDING_MAIN_DIRECTORY):
-                        os.makedirs(RECORDING_MAIN_DIRECTORY)
-                
-                state['mount_requested'] = False
-
-        # Controller for recording LED
-        if state['recording'] == True:
-            if time.time() - recording_led_time >= SLOW_LED_BLINK_INTERVAL:
-                state['recording_duration'] += SLOW_LED_BLINK_INTERVAL
-                recording_led_time = time.time()
-                if recording_led_state == GPIO.HIGH:
-                    recording_led_state = GPIO.LOW
-                else:
-                    recording_led_state = GPIO.HIGH
-                GPIO.output(RECORDING_LED_PIN, recording_led_state)
+            else:
+                print("Mounting SD card")
+                # Mount SD card if not mounted
+                leds.blink(MOUNT_LED_PIN, FAST_LED_BLINK_INTERVAL)
+                wait_until(state, lambda: state['media_mount_point'] is not None)
+                mount_point = state['media_mount_point']
+                print("Mounted SD card")
+                mounted = True
+                state['mounted'] = True
+                storage_monitor = storage.StorageMonitor(mount_point)
+                leds.set(MOUNT_LED_PIN, GPIO.HIGH)
+                # Set the recording directory to the first SD card mount point
+                recording_main_directory = mount_point + RECORDING_MAIN_DIRECTORY
+                # Create the recording directory if it doesn't exist
+                if not os.path.exists(recording_main_directory):
+                    os.makedirs(recording_main_directory)
+                state['recording_main_directory'] = recording_main_directory
+                for directory in merge.find_unfinished(recording_main_directory):
+                    merge_queue.put(directory)
+
+            state['mount_requested'] = False
+
+        # The drive went away without the mount button, e.g. it was pulled out
+        if mounted and state['media_mount_point'] != mount_point:
+            print(F"{mount_point} is no longer mounted")
+            state.update({'should_record': False, 'mounted': False, 'recording_main_directory': None})
+            mounted = False
+            mount_point = None
+            storage_monitor = None
+            leds.set(MOUNT_LED_PIN, GPIO.LOW)
+
+        # Recording duration shown in the web UI
+        if state['recording'] == True and state['recording_start_time'] is not None:
+            if time.monotonic() >= next_duration_update:
+                next_duration_update = time.monotonic() + SLOW_LED_BLINK_INTERVAL
+                state['recording_duration'] = time.time() - state['recording_start_time']
+
+        # Check free space with statvfs every storage.STORAGE_CHECK_INTERVAL, and right away before a recording starts
+        if storage_monitor is not None:
+            if state['should_record'] == True and state['recording'] == False and state['recording_directory'] is None:
+                storage_monitor.check(measure_rate=False)
+                storage_checked = True
+            else:
+                storage_checked = storage_monitor.update()
+            if storage_checked:
+                if storage_monitor.below_floor() and state['should_record'] == True:
+                    if storage.RETENTION_POLICY == 'delete_oldest':
+                        storage.free_space(storage_monitor, recording_main_directory, state['recording_directory'])
+                    if storage_monitor.below_floor():
+                        print(F"Free space below {storage_monitor.floor} bytes, stopping recording")
+                        state.update({'should_record': False, 'error': "Storage is full, recording stopped"})
+                state.update(storage_monitor.state())
 
         # Switch when we detect mismatch of recording and should_record states, aka recording toggle
         ## Detected that recording must be started but we're not recording yet. Start up stuff
-        if state['should_record'] == True and state['recording'] == False:
+        ## (the camera clears recording_directory once the previous recording is written)
+        if state['should_record'] == True and state['recording'] == False and state['recording_directory'] is None:
             # Make a new directory for this set of recordings
-            os.makedirs(
-                F"{RECORDING_MAIN_DIRECTORY}/{time.strftime(RECORDING_SESSION_DIRECTORY_FORMAT)}")
-
-            state['recording_directory'] = F"{RECORDING_MAIN_DIRECTORY}/{time.strftime(RECORDING_SESSION_DIRECTORY_FORMAT)}"
-            for i in range(10):
-                if recording_led_state == GPIO.HIGH:
-                    recording_led_state = GPIO.LOW
-                else:
-                    recording_led_state = GPIO.HIGH
-                GPIO.output(RECORDING_LED_PIN, recording_led_state)
-                time.sleep(FAST_LED_BLINK_INTERVAL)
-            recording_led_state = GPIO.HIGH
-            GPIO.output(RECORDING_LED_PIN, recording_led_state)
-            state['recording_duration'] = 0
+            recording_directory = F"{recording_main_directory}/{time.strftime(RECORDING_SESSION_DIRECTORY_FORMAT)}"
+            os.makedirs(recording_directory)
+            state.update({'recording_directory': recording_directory, 'recording_duration': 0})
+            # Flash quickly for a second, then blink slowly while recording
+            leds.blink(RECORDING_LED_PIN, FAST_LED_BLINK_INTERVAL, 5, (SLOW_LED_BLINK_INTERVAL, None, None))
+            recording_stopping = False
         ## Detected that recording must be stopped but we're still recording, clean up
-        elif state['should_record'] == False and state['recording'] == True:
-            for i in range(10):
-                if recording_led_state == GPIO.HIGH:
-                    recording_led_state = GPIO.LOW
-                else:
-                    recording_led_state = GPIO.HIGH
-                GPIO.output(RECORDING_LED_PIN, recording_led_state)
-                time.sleep(FAST_LED_BLINK_INTERVAL)
-            recording_led_state = GPIO.LOW
-            GPIO.output(RECORDING_LED_PIN, recording_led_state)
+        elif state['should_record'] == False and state['recording'] == True and not recording_stopping:
+            leds.blink(RECORDING_LED_PIN, FAST_LED_BLINK_INTERVAL, 5, GPIO.LOW)
             state['recording_duration'] = 0
-        
-        ## Use df to get the usage of the SD card, stripping percentage sign
-        # df -h | grep mount_point | awk '{print $5}' | sed 's/%//'
-        sd_use = os.popen(F"df -h | grep {mount_point} | awk '{{print $5}}' | sed 's/%//'").read()
-        if sd_use is not None and sd_use != '': 
-            state['sd_use'] = float(sd_use)
-        
-        time.sleep(0.1)
+            recording_stopping = True
+        elif state['recording'] == False:
+            recording_stopping = False
+
+        # Sleep until something changes or the next periodic job is due
+        timeout = STATE_WAIT_TIMEOUT
+        if state['recording'] == True:
+            timeout = min(timeout, max(0.0, next_duration_update - time.monotonic()))
+        if storage_monitor is not None:
+            timeout = min(timeout, max(0.0, storage_monitor.last_check + storage_monitor.interval - time.monotonic()))
+        version = state.wait_for_change(version, timeout)
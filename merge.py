@@ -0,0 +1,204 @@
+"""
+Background merge worker for recording sessions.
+
+When a recording stops, the camera worker writes a merge journal into the
+session directory and queues the directory here. This worker runs in its
+own low priority process, so merging never delays the next recording.
+
+Segments are stream copied with the ffmpeg concat demuxer, SEGMENT_CHUNKS
+files at a time. Long sessions are merged hierarchically: every level
+merges groups of SEGMENT_CHUNKS files from the level below until a single
+file is left, which becomes video_full.avi.
+
+Every output is written to a temporary name and renamed once ffmpeg has
+finished, so a file with a final name is always complete. The journal
+records which levels are done, so after a power loss the merge picks up
+where it left off: finished outputs are skipped and unfinished temporary
+files are thrown away.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import time
+
+SEGMENT_CHUNKS = 5 # Segments to merge at a time
+JOURNAL_NAME = "merge.json"
+OUTPUT_NAME = "video_full.avi"
+# Remove the original segments once video_full.avi is written. They are kept by default,
+# they are the unit the rest of the tools (recovery, downloads, the frame index) work with.
+DELETE_SEGMENTS_AFTER_MERGE = False
+# Niceness of the merge process, 19 is the lowest CPU priority
+MERGE_NICENESS = 19
+
+
+def write_json_atomic(path, data):
+    """Write JSON to a temporary file and rename it over path, so readers never see half a file"""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_journal(directory):
+    try:
+        with open(os.path.join(directory, JOURNAL_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def queue_session(queue, directory, segments):
+    """
+    Called by the camera worker when a recording stops.
+    Input: merge queue, session directory, segment file paths in recording order
+    """
+    names = [os.path.basename(segment) for segment in segments]
+    write_json_atomic(os.path.join(directory, JOURNAL_NAME), {
+        'segments': names,
+        'completed_level': -1,
+        'done': False,
+        'queued_time': time.time(),
+    })
+    queue.put(directory)
+
+
+def find_unfinished(main_directory):
+    """Session directories under main_directory whose merge has not finished, oldest first"""
+    unfinished = []
+    if not os.path.isdir(main_directory):
+        return unfinished
+    for name in sorted(os.listdir(main_directory)):
+        directory = os.path.join(main_directory, name)
+        journal = read_journal(directory)
+        if journal is not None and not journal['done']:
+            unfinished.append(directory)
+    return unfinished
+
+
+def merge_levels(names):
+    """
+    Plan the hierarchical merge.
+    Returns: list of levels, each a list of (output name, input names). A group of one file is carried up as is.
+    """
+    levels = []
+    level = 0
+    while len(names) > 1:
+        groups = []
+        outputs = []
+        for i in range(0, len(names), SEGMENT_CHUNKS):
+            group = names[i:i + SEGMENT_CHUNKS]
+            if len(group) == 1:
+                outputs.append(group[0])
+                continue
+            output = F"merge{level}_{i // SEGMENT_CHUNKS}.avi"
+            groups.append((output, group))
+            outputs.append(output)
+        levels.append(groups)
+        names = outputs
+        level += 1
+    return levels
+
+
+def low_priority_command(cmd):
+    # Idle I/O class as well, the camera writers must always win the flash drive
+    if shutil.which("ionice"):
+        return ["ionice", "-c", "3"] + cmd
+    return cmd
+
+
+def concat(directory, inputs, output):
+    """Stream copy inputs into output with the ffmpeg concat demuxer, renaming into place only on success"""
+    list_path = os.path.join(directory, output + ".txt")
+    temporary_path = os.path.join(directory, output + ".tmp")
+    with open(list_path, "w") as f:
+        for name in inputs:
+            f.write(F"file '{os.path.join(directory, name)}'\n")
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "concat", "-safe", "0",
+        "-i", list_path,
+        "-c", "copy", "-f", "avi", temporary_path]
+    print(F"cmd: {cmd}")
+    result = subprocess.call(low_priority_command(cmd))
+    os.remove(list_path)
+    if result != 0:
+        raise RuntimeError(F"ffmpeg exited with {result} while writing {output}")
+    with open(temporary_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(temporary_path, os.path.join(directory, output))
+
+
+def merge_session(directory, state):
+    journal = read_journal(directory)
+    if journal is None or journal['done']:
+        return
+    print(F"Merging segments in {directory}")
+    names = [name for name in journal['segments'] if os.path.exists(os.path.join(directory, name))]
+    if not names:
+        print(F"No segments left to merge in {directory}")
+        journal['done'] = True
+        write_json_atomic(os.path.join(directory, JOURNAL_NAME), journal)
+        return
+    # Leftovers from an interrupted ffmpeg run are incomplete by definition
+    for name in os.listdir(directory):
+        if name.endswith(".tmp") or name.endswith(".avi.txt"):
+            os.remove(os.path.join(directory, name))
+
+    levels = merge_levels(names)
+    total = sum(len(groups) for groups in levels) + 1
+    done = sum(len(groups) for groups in levels[:journal['completed_level'] + 1])
+    state['combine_progress'] = done / total
+    for level, groups in enumerate(levels):
+        if level <= journal['completed_level']:
+            continue
+        for output, inputs in groups:
+            if not os.path.exists(os.path.join(directory, output)):
+                concat(directory, inputs, output)
+            done += 1
+            state['combine_progress'] = done / total
+        journal['completed_level'] = level
+        write_json_atomic(os.path.join(directory, JOURNAL_NAME), journal)
+        # Intermediate files merged into this level are no longer needed, original segments are never removed here
+        for _, inputs in groups:
+            for name in inputs:
+                if name.startswith("merge") and os.path.exists(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+
+    # The top of the tree becomes video_full.avi. It may already have been renamed before a power loss.
+    final = levels[-1][0][0] if levels else names[0]
+    if final.startswith("merge"):
+        if os.path.exists(os.path.join(directory, final)):
+            os.replace(os.path.join(directory, final), os.path.join(directory, OUTPUT_NAME))
+    elif not os.path.exists(os.path.join(directory, OUTPUT_NAME)):
+        concat(directory, [final], OUTPUT_NAME)
+    if DELETE_SEGMENTS_AFTER_MERGE:
+        for name in names:
+            os.remove(os.path.join(directory, name))
+    journal['done'] = True
+    write_json_atomic(os.path.join(directory, JOURNAL_NAME), journal)
+    state['combine_progress'] = 1.0
+    print(F"Combined segments into {os.path.join(directory, OUTPUT_NAME)}")
+
+
+def merge_worker(queue, state):
+    print("Starting merge worker")
+    os.nice(MERGE_NICENESS)
+    while True:
+        directory = queue.get()
+        state.update({'combining': True, 'combine_progress': 0.0})
+        try:
+            merge_session(directory, state)
+        except Exception as e:
+            # Leave the journal unfinished so the merge is retried on the next boot
+            print(F"Merging {directory} failed: {e}")
+            state['error'] = F"Merging segments failed: {e}"
+        if queue.empty():
+            state['combining'] = False
+
+
+if __name__ == "__main__":
+    print("This is the merge worker module, and should not be run directly.")
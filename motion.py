@@ -0,0 +1,144 @@
+"""
+Motion gated recording.
+
+With camera.MOTION_GATING on, every captured frame passes a MotionGate on
+its way to the segment writer. A MotionDetector compares a small greyscale
+copy of the frame (a 1/8 scale JPEG decode, or a resize of a raw frame)
+against a slowly updated background, and the scene counts as active while
+enough pixels differ from it. Active stretches are recorded at the full
+frame rate, together with PRE_ROLL seconds before the first moving frame
+and POST_ROLL seconds after the last one. The rest of the time only
+IDLE_FRAMERATE frames per second are kept, so a session still shows the
+empty road and the light changing.
+
+Skipped frames keep using up frame ids: the gate tells the writer how many
+frames it skipped before every kept one, the writer passes that on to
+SegmentRotator.skip(), and every kept frame is recorded in frames.idx and
+day_night.csv with the id and timestamp it was captured with. The AVI
+headers still say RECORD_FRAMERATE, so a plain player shows idle stretches
+sped up; counting should go by the frame index.
+"""
+
+import collections
+import threading
+
+import cv2
+import numpy
+
+from telemetry import Telemetry
+
+# A pixel has changed when it differs from the background by more than this (0-255)
+MOTION_PIXEL_THRESHOLD = 25
+# The scene is active when at least this fraction of the small frame's pixels changed
+MOTION_AREA = 0.002
+# Weight of a new frame in the background average, about a second to absorb something that stopped moving
+BACKGROUND_SMOOTHING = 0.05
+# Frames per second kept while nothing moves
+IDLE_FRAMERATE = 1.0
+# Seconds recorded before the first and after the last frame with motion
+PRE_ROLL = 2.0
+POST_ROLL = 3.0
+
+
+def small_greyscale(frame):
+    """
+    Input: a JPEG as a 1D numpy byte array (passthrough and MJPEG encoder frames) or a BGR frame
+    Returns: greyscale frame at 1/8 size, None if it could not be decoded
+    """
+    if frame.ndim == 1:
+        # libjpeg skips most of the IDCT when decoding straight to 1/8 scale
+        return cv2.imdecode(frame, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(grey, (grey.shape[1] // 8, grey.shape[0] // 8), interpolation=cv2.INTER_AREA)
+
+
+class MotionDetector:
+    def __init__(self, pixel_threshold=MOTION_PIXEL_THRESHOLD, area=MOTION_AREA, smoothing=BACKGROUND_SMOOTHING):
+        self.pixel_threshold = pixel_threshold
+        self.area = area
+        self.smoothing = smoothing
+        self.background = None
+        # Fraction of pixels that differed from the background in the last frame
+        self.changed = 0.0
+
+    def update(self, frame):
+        """
+        Input: captured frame, see small_greyscale()
+        Returns: True if something moved
+        """
+        small = small_greyscale(frame)
+        if small is None:
+            return False
+        small = cv2.GaussianBlur(small, (3, 3), 0).astype(numpy.float32)
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small
+            return False
+        changed = numpy.count_nonzero(cv2.absdiff(small, self.background) > self.pixel_threshold)
+        cv2.accumulateWeighted(small, self.background, self.smoothing)
+        self.changed = changed / small.size
+        return self.changed >= self.area
+
+
+class MotionGate:
+    def __init__(self, emit, framerate, idle_framerate=IDLE_FRAMERATE, pre_roll=PRE_ROLL, post_roll=POST_ROLL,
+                 detector=None, metrics=None):
+        """
+        Input: emit(frame, timestamp, skipped) writes a kept frame after skipping `skipped` frame ids,
+               frame is None for trailing skips at flush(). Camera frame rate, the idle frame rate and
+               pre and post roll in seconds, a MotionDetector and the telemetry to count skipped frames in.
+        """
+        self.emit = emit
+        self.idle_interval = 1 / idle_framerate
+        self.pre_roll_frames = int(round(pre_roll * framerate))
+        self.post_roll = post_roll
+        self.detector = MotionDetector() if detector is None else detector
+        if metrics is None:
+            metrics = Telemetry()
+        self.skipped_frames = metrics.metric('motion_skipped')
+        self.active_gauge = metrics.metric('motion_active')
+        self.lock = threading.Lock()
+        # (frame, timestamp) of the last PRE_ROLL seconds while idle, written if motion starts
+        self.buffer = collections.deque()
+        self.skipped = 0
+        self.active_until = None
+        self.last_kept = None
+
+    def push(self, frame, timestamp):
+        """Hand over one captured frame, called from the capture path in capture order"""
+        moving = self.detector.update(frame)
+        with self.lock:
+            if moving:
+                self.active_until = timestamp + self.post_roll
+            if self.active_until is not None and timestamp <= self.active_until:
+                self.active_gauge.set(1)
+                while self.buffer:
+                    self.keep(*self.buffer.popleft())
+                self.keep(frame, timestamp)
+                return
+            self.active_gauge.set(0)
+            self.buffer.append((frame, timestamp))
+            if len(self.buffer) > self.pre_roll_frames:
+                self.release_idle(*self.buffer.popleft())
+
+    def keep(self, frame, timestamp):
+        self.emit(frame, timestamp, self.skipped)
+        self.skipped = 0
+        self.last_kept = timestamp
+
+    def release_idle(self, frame, timestamp):
+        # A frame left the pre-roll without motion, keep it only at the idle rate
+        if self.last_kept is None or timestamp - self.last_kept >= self.idle_interval:
+            self.keep(frame, timestamp)
+        else:
+            self.skipped += 1
+            self.skipped_frames.inc()
+
+    def flush(self):
+        """Decide on the frames still held back, at the end of a recording or before a camera switch"""
+        with self.lock:
+            while self.buffer:
+                self.release_idle(*self.buffer.popleft())
+            if self.skipped:
+                self.emit(None, None, self.skipped)
+                self.skipped = 0
+            self.active_gauge.set(0)
@@ -0,0 +1,132 @@
+"""
+Removable drive detection without subprocesses.
+
+The kernel marks /proc/self/mountinfo readable with an exceptional
+condition (POLLPRI) every time something is mounted or unmounted, so
+MountWatcher sleeps in poll() on it and only rereads the table when it
+changed. For every mounted block device, sysfs tells whether the disk is
+removable: /sys/dev/block/<major>:<minor> links to the partition, and its
+parent directory is the disk with its 'removable' flag.
+
+A mount counts as removable media like it did with lsblk: the disk is an
+sd* device (USB mass storage) or flagged removable, and it is not the disk
+the root filesystem is on.
+"""
+
+import os
+import select
+import threading
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+SYSFS_DEV_BLOCK = "/sys/dev/block"
+
+
+def unescape(field):
+    # mountinfo writes space, tab, newline and backslash in paths as octal escapes
+    for escaped, character in (("\\040", " "), ("\\011", "\t"), ("\\012", "\n"), ("\\134", "\\")):
+        field = field.replace(escaped, character)
+    return field
+
+
+def parse_mountinfo(text):
+    """
+    Returns: list of (device number as "major:minor", mount point, filesystem type, mount source)
+    """
+    mounts = []
+    for line in text.splitlines():
+        fields = line.split()
+        # Optional fields end with a lone "-", the filesystem type and source follow it
+        separator = fields.index("-")
+        mounts.append((fields[2], unescape(fields[4]), fields[separator + 1], fields[separator + 2]))
+    return mounts
+
+
+def disk_of(device_number, sysfs=SYSFS_DEV_BLOCK):
+    """
+    Returns: sysfs directory of the whole disk a block device number belongs to, None if it is not a block device
+    """
+    path = os.path.join(sysfs, device_number)
+    if not os.path.exists(path):
+        return None
+    path = os.path.realpath(path)
+    if os.path.exists(os.path.join(path, "partition")):
+        path = os.path.dirname(path)
+    return path
+
+
+def is_removable(disk):
+    if os.path.basename(disk).startswith("sd"):
+        return True
+    try:
+        with open(os.path.join(disk, "removable")) as f:
+            return f.read().strip() == "1"
+    except OSError:
+        return False
+
+
+def removable_mount_points(text, sysfs=SYSFS_DEV_BLOCK):
+    """
+    Input: contents of a mountinfo file
+    Returns: mount points of removable drives in mount order
+    """
+    mounts = parse_mountinfo(text)
+    root_disk = None
+    for device_number, mount_point, _, _ in mounts:
+        if mount_point == "/":
+            root_disk = disk_of(device_number, sysfs)
+    mount_points = []
+    for device_number, mount_point, _, _ in mounts:
+        disk = disk_of(device_number, sysfs)
+        if disk is not None and disk != root_disk and is_removable(disk) and mount_point not in mount_points:
+            mount_points.append(mount_point)
+    return mount_points
+
+
+class MountWatcher:
+    def __init__(self, on_change=None, path=MOUNTINFO_PATH, sysfs=SYSFS_DEV_BLOCK):
+        """
+        Input: on_change(mount point or None), called on the watcher thread when the first removable
+               drive's mount point changes, and the mountinfo and sysfs paths
+        """
+        self.on_change = on_change
+        self.sysfs = sysfs
+        self.file = open(path)
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        self.mount_point = None
+        self.read()
+        self.thread = None
+
+    def read(self):
+        """
+        Reread the mount table.
+        Returns: True if the first removable mount point changed
+        """
+        self.file.seek(0)
+        mount_points = removable_mount_points(self.file.read(), self.sysfs)
+        mount_point = mount_points[0] if mount_points else None
+        changed = mount_point != self.mount_point
+        self.mount_point = mount_point
+        return changed
+
+    def wait(self, timeout=None):
+        """
+        Sleep until the mount table changes or the timeout runs out.
+        Returns: True if the first removable mount point changed
+        """
+        if not self.poller.poll(None if timeout is None else timeout * 1000):
+            return False
+        return self.read()
+
+    def run(self):
+        while True:
+            if self.wait() and self.on_change is not None:
+                self.on_change(self.mount_point)
+
+    def start(self):
+        """Watch for changes on a background thread, on_change is called once right away with the current state"""
+        if self.on_change is not None:
+            self.on_change(self.mount_point)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
@@ -0,0 +1,360 @@
+"""
+Recovery of sessions cut off by a power loss.
+
+A recording that never stopped cleanly leaves its session behind without
+merge.json, and with:
+
+- a last video_N.avi whose headers still say zero frames, without an idx1
+  index, possibly ending in the middle of a frame, and the empty video_N+1.avi
+  that was opened ahead of the next rotation,
+- a frames.idx without the records that were still buffered in
+  FrameIndexWriter, possibly with records of frames that never reached the drive,
+- a day_night.csv that can name a switch whose frames were lost,
+- a segments.json without the segments that were still open.
+
+Every time a drive is mounted, a thread in the camera worker looks for
+such sessions and repairs them at the lowest CPU priority. Recording can
+start while it runs, the session being recorded is never touched.
+
+- Every segment is read in one streaming pass over its chunk headers. The
+  frames are not decoded, only their first and last bytes are checked for
+  the JPEG start and end markers. The segment is cut after its last
+  complete frame and gets the idx1 index and headers MjpegAviWriter.release()
+  would have written. Segments that were released only have their idx1 read.
+- frames.idx keeps the records of the frames that are still in the segments
+  and gets records for the frames on the drive whose records were lost.
+  Their ids and timestamps continue from the last record at the segment's
+  frame rate, which is exact unless motion gating skipped frames at the end.
+- day_night.csv loses the switches after the last frame, and gets any
+  switch the index shows that it is missing.
+- The segments are added to segments.json, and the session is queued for
+  merging. Its merge.json marks it as recovered.
+
+Segments written by cv2.VideoWriter (the day camera without passthrough)
+are not laid out like MjpegAviWriter's and are left as they are.
+
+Every step is written to the drive before the next one relies on it, so
+a power loss during recovery only means the session is recovered again
+on the next mount.
+"""
+
+import os
+import struct
+import threading
+
+import avi
+import frame_index
+import merge
+import sessions
+from segments import SegmentInfo
+
+DAY_NIGHT_NAME = "day_night.csv"
+# Niceness of the recovery thread, 19 is the lowest CPU priority
+RECOVERY_NICENESS = 19
+JPEG_START = b'\xff\xd8'
+JPEG_END = b'\xff\xd9'
+# Bytes at the end of a frame searched for the end marker, some USB cameras pad their frames
+JPEG_END_SEARCH = 16
+
+
+def segment_path(directory, number):
+    """Path of video_N.avi, like camera.segment_path"""
+    return os.path.join(directory, F"video_{number}.avi")
+
+
+class SegmentScan:
+    """The frames of one MjpegAviWriter segment as they are on the drive"""
+    def __init__(self, path, width, height, framerate):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        # True if release() wrote the index and headers
+        self.complete = False
+        # (chunk offset, frame size) of the complete frames, in file order
+        self.frames = []
+        # End of the last complete frame's chunk
+        self.end = avi.MOVI_DATA_OFFSET
+
+
+def scan_segment(path):
+    """
+    Find the frames of a segment, from its idx1 if it was released, by walking the chunk headers otherwise
+    Returns: SegmentScan, None if the file is not laid out by MjpegAviWriter
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        header = f.read(avi.MOVI_DATA_OFFSET)
+        if len(header) < avi.MOVI_DATA_OFFSET or header[:4] != b'RIFF' or header[8:12] != b'AVI ' \
+                or header[avi.MOVI_LIST_OFFSET:avi.MOVI_LIST_OFFSET + 4] != b'LIST' \
+                or header[avi.MOVI_DATA_OFFSET - 4:avi.MOVI_DATA_OFFSET] != b'movi':
+            return None
+        width, height = struct.unpack_from("<II", header, avi.AVIH_OFFSET + 32)
+        scale, rate = struct.unpack_from("<II", header, avi.STRH_OFFSET + 20)
+        if scale == 0 or rate == 0:
+            return None
+        scan = SegmentScan(path, width, height, rate / scale)
+        riff_size, = struct.unpack_from("<I", header, avi.RIFF_SIZE_OFFSET)
+        movi_size, = struct.unpack_from("<I", header, avi.MOVI_LIST_OFFSET + 4)
+        if riff_size != 0 and riff_size + 8 == size:
+            # Released, the index after the movi list has every frame
+            f.seek(avi.MOVI_LIST_OFFSET + 8 + movi_size)
+            chunk = f.read(8)
+            if len(chunk) == 8 and chunk[:4] == b'idx1':
+                length, = struct.unpack_from("<I", chunk, 4)
+                for _, _, offset, frame_size in struct.iter_unpack("<4sIII", f.read(length)):
+                    scan.frames.append((offset + avi.MOVI_DATA_OFFSET - 4, frame_size))
+                scan.complete = True
+                scan.end = avi.MOVI_LIST_OFFSET + 8 + movi_size
+                return scan
+
+        # Headers only: the start of every frame and the last few bytes are read, the rest is skipped over
+        offset = avi.MOVI_DATA_OFFSET
+        last_whole = 0
+        while offset + avi.CHUNK_HEADER_SIZE <= size:
+            f.seek(offset)
+            chunk = f.read(avi.CHUNK_HEADER_SIZE + len(JPEG_START))
+            fourcc, length = struct.unpack_from("<4sI", chunk)
+            end = offset + avi.CHUNK_HEADER_SIZE + length + (length & 1)
+            if fourcc != b'00dc' or end > size:
+                # The frame being written, zeros the file was extended with, or the idx1 of an interrupted recovery
+                break
+            search = min(length, JPEG_END_SEARCH)
+            f.seek(offset + avi.CHUNK_HEADER_SIZE + length - search)
+            whole = chunk[avi.CHUNK_HEADER_SIZE:] == JPEG_START and JPEG_END in f.read(search)
+            scan.frames.append((offset, length))
+            if whole:
+                # A damaged frame between whole ones is kept, only the torn ones at the end go
+                last_whole = len(scan.frames)
+                scan.end = end
+            offset = end
+        del scan.frames[last_whole:]
+        return scan
+
+
+def repair_segment(scan):
+    """Cut the segment after its last complete frame and write the index and headers like MjpegAviWriter.release()"""
+    index = bytearray()
+    max_frame_size = 0
+    for offset, size in scan.frames:
+        index += avi.index_entry(offset, size)
+        max_frame_size = max(max_frame_size, size)
+    with open(scan.path, 'r+b') as f:
+        f.truncate(scan.end)
+        f.seek(scan.end)
+        f.write(b'idx1' + struct.pack("<I", len(index)))
+        f.write(index)
+        f.flush()
+        # The index is on the drive before the headers say there is one
+        os.fsync(f.fileno())
+        f.seek(0)
+        f.write(avi.build_header(scan.width, scan.height, scan.framerate, len(scan.frames), max_frame_size,
+                                 movi_size=scan.end - avi.MOVI_LIST_OFFSET - 8, riff_size=scan.end + len(index)))
+        f.flush()
+        os.fsync(f.fileno())
+    scan.complete = True
+
+
+def read_day_night(directory):
+    """
+    Returns: (frame id, night) rows of the session's day_night.csv, None if there is none
+    """
+    try:
+        with open(os.path.join(directory, DAY_NIGHT_NAME)) as f:
+            lines = f.read().splitlines()[1:]
+    except OSError:
+        return None
+    rows = []
+    for line in lines:
+        frame_id, _, night = line.partition(',')
+        try:
+            rows.append((int(frame_id), night.strip() == 'True'))
+        except ValueError:
+            # A line cut off by the power loss
+            pass
+    return rows
+
+
+def night_at(rows, frame_id):
+    """Returns: True for night, False for day, None if no row covers the frame"""
+    night = None
+    for row_id, row_night in rows:
+        if row_id > frame_id:
+            break
+        night = row_night
+    return night
+
+
+def reconcile_day_night(rows, records):
+    """
+    Returns: day_night.csv rows that agree with the frame index
+    """
+    last_id = records[-1].frame_id
+    # A switch after the last frame on the drive has no frames
+    rows = [row for row in rows if row[0] <= last_id]
+    last_camera = None
+    for record in records:
+        if record.camera != last_camera:
+            night = record.camera == frame_index.CAMERA_NIGHT
+            if night_at(rows, record.frame_id) != night:
+                rows = sorted(rows + [(record.frame_id, night)])
+            last_camera = record.camera
+    return rows
+
+
+def write_file_atomic(path, data):
+    """Like merge.write_json_atomic, for the index and the CSV"""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+def recover_session(directory, merge_queue, should_stop=None):
+    """
+    Repair an interrupted session and queue it for merging.
+    Returns: False if should_stop() said to stop first, the session is recovered again next time
+    """
+    print(F"Recovering interrupted session {directory}")
+    numbers = sorted(number for number in map(sessions.segment_number, os.listdir(directory)) if number is not None)
+    try:
+        records = list(frame_index.FrameIndex(os.path.join(directory, frame_index.INDEX_NAME)))
+    except (OSError, ValueError):
+        # Nothing of the index made it to the drive
+        records = []
+    rows = read_day_night(directory)
+
+    scans = {}
+    for number in numbers:
+        if should_stop is not None and should_stop():
+            return False
+        scan = scan_segment(segment_path(directory, number))
+        if scan is None:
+            print(F"{segment_path(directory, number)} was not written by MjpegAviWriter, leaving it as it is")
+        else:
+            scans[number] = scan
+
+    # Records of frames that are no longer in their segment go
+    frames_on_drive = dict((number, set(offset for offset, _ in scan.frames)) for number, scan in scans.items())
+    kept = [record for record in records if record.segment in numbers and
+            (record.segment not in scans or record.offset in frames_on_drive[record.segment])]
+    # Frames written after the last record that made it to the drive get records of their own
+    last = kept[-1] if kept else None
+    next_id = 0 if last is None else last.frame_id + 1
+    timestamp = None if last is None else last.timestamp
+    camera = frame_index.CAMERA_DAY if last is None else last.camera
+    added = 0
+    for number, scan in sorted(scans.items()):
+        if last is not None and number < last.segment:
+            continue
+        for offset, _ in scan.frames:
+            if last is not None and number == last.segment and offset <= last.offset:
+                continue
+            timestamp = 0.0 if timestamp is None else timestamp + 1 / scan.framerate
+            night = None if rows is None else night_at(rows, next_id)
+            if night is not None:
+                camera = frame_index.CAMERA_NIGHT if night else frame_index.CAMERA_DAY
+            kept.append(frame_index.FrameRecord(next_id, timestamp, number, camera, offset))
+            next_id += 1
+            added += 1
+
+    repaired = set()
+    for number, scan in scans.items():
+        if not scan.frames:
+            # Opened ahead of a rotation that never came, or cut off before its first frame
+            os.remove(scan.path)
+            numbers.remove(number)
+        elif not scan.complete:
+            repair_segment(scan)
+            repaired.add(number)
+            print(F"Repaired {scan.path}: {len(scan.frames)} frames")
+
+    if kept != records:
+        header = struct.pack(frame_index.HEADER_FORMAT, frame_index.MAGIC, frame_index.VERSION, frame_index.RECORD_SIZE)
+        write_file_atomic(os.path.join(directory, frame_index.INDEX_NAME),
+                          header + b''.join(struct.pack(frame_index.RECORD_FORMAT, *record) for record in kept))
+        print(F"Frame index: {len(records) - (len(kept) - added)} records of lost frames removed, {added} added")
+    if rows is not None and kept:
+        reconciled = reconcile_day_night(rows, kept)
+        if reconciled != rows:
+            lines = ["frame_id,night_true\n"] + [F"{frame_id},{night}\n" for frame_id, night in reconciled]
+            write_file_atomic(os.path.join(directory, DAY_NIGHT_NAME), "".join(lines).encode())
+
+    # segments.json gets the segments that were still open, from the reconciled index
+    infos = {}
+    cameras = {}
+    for record in kept:
+        info = infos.get(record.segment)
+        if info is None:
+            info = infos[record.segment] = SegmentInfo(record.segment, record.frame_id, record.timestamp)
+            cameras[record.segment] = record.camera
+        info.frames += 1
+        info.last_frame = record.frame_id
+        info.end_time = record.timestamp
+    listed = set(segment['number'] for segment in sessions.read_segments(directory))
+    for number, info in sorted(infos.items()):
+        if number in numbers and (number not in listed or number in repaired):
+            sessions.record_segment(segment_path(directory, number), info, cameras[number])
+
+    merge.queue_session(merge_queue, directory, [segment_path(directory, number) for number in numbers])
+    print(F"Recovered {directory}: {len(numbers)} segments, {len(kept)} frames")
+    return True
+
+
+def find_interrupted(main_directory):
+    """Session directories under main_directory that have not been queued for merging, oldest first"""
+    interrupted = []
+    if not os.path.isdir(main_directory):
+        return interrupted
+    for name in sorted(os.listdir(main_directory)):
+        directory = os.path.join(main_directory, name)
+        if os.path.isdir(directory) and merge.read_journal(directory) is None:
+            interrupted.append(directory)
+    return interrupted
+
+
+def recover_sessions(main_directory, state, merge_queue):
+    """Recover every interrupted session under main_directory, stopping when the drive is about to go"""
+    def should_stop():
+        return state['mount_requested'] or state['recording_main_directory'] != main_directory
+
+    for directory in find_interrupted(main_directory):
+        if should_stop():
+            print("Drive is going away, stopping recovery")
+            return
+        # The camera worker writes day_night.csv only after recording_directory is set, so once the file
+        # is there, the session being recorded is known. Before that the session is skipped anyway.
+        if not os.path.exists(os.path.join(directory, DAY_NIGHT_NAME)):
+            continue
+        active = state['recording_directory']
+        if active is not None and os.path.normpath(active) == os.path.normpath(directory):
+            continue
+        # A recording that stopped in the meantime was queued by the camera worker
+        if merge.read_journal(directory) is not None:
+            continue
+        try:
+            recover_session(directory, merge_queue, should_stop)
+        except Exception as e:
+            # Left without merge.json, it is tried again on the next mount
+            print(F"Recovering {directory} failed: {e}")
+
+
+def recovery_worker(state, merge_queue):
+    """Thread of the camera worker, recovers the interrupted sessions on every drive that is mounted"""
+    print("Starting recovery thread")
+    try:
+        # Niceness is per thread on Linux, this leaves the capture and writer threads alone
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), RECOVERY_NICENESS)
+    except OSError as e:
+        print(F"Could not lower the recovery thread's priority: {e}")
+    recovered = None
+    version = state.version()
+    while True:
+        main_directory = state['recording_main_directory']
+        if main_directory != recovered:
+            recovered = main_directory
+            if main_directory is not None:
+                recover_sessions(main_directory, state, merge_queue)
+        version = state.wait_for_change(version)
@@ -0,0 +1,234 @@
+"""
+Replay recorded sessions through the day/night detection, faster than real time.
+
+Feeds the frames of a session's video_N.avi segments through the same
+daynight.LightMeter the camera worker uses, and writes the switch timeline
+it would have produced in the day_night.csv format. Tuning thresholds then
+takes minutes on a laptop instead of nights outside.
+
+Only every LIGHT_SAMPLE_FRAMES-th frame is decoded, at 1/8 scale like the
+camera does. With a frames.idx the sampled frames are read straight from
+their offsets. Segments the index has no offsets for (the day camera
+without passthrough), and sessions without an index, are walked chunk by
+chunk.
+Sessions are decoded in parallel in a process pool, once, and every
+parameter set of a sweep runs over the decoded light levels.
+
+    python3 replay.py /recordings/2024-05-01_20-00-00
+    python3 replay.py sessions/* --enter 40,45,50 --exit 55,60,70 --hold 10,20 --output tuned/
+
+A single session with a single parameter set prints its day_night.csv.
+Otherwise a table is printed with the switch count of every session and
+parameter set, and how many sampled frames agree with the session's
+recorded day_night.csv, and --output gets one CSV per session and set.
+
+The footage only holds the camera that was active while recording, so
+after a replayed switch that did not happen in the recording, the meter
+sees the other camera's frames than it would have live.
+"""
+
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+import re
+import struct
+import sys
+
+import cv2
+import numpy
+
+import avi
+import daynight
+import frame_index
+
+# Same rate as camera.LIGHT_SAMPLE_FRAMES at the camera's 20 fps, camera.py is not imported so picamera2 is not needed
+LIGHT_SAMPLE_FRAMES = 20
+RECORD_FRAMERATE = 20
+
+
+def session_segments(directory):
+    """video_N.avi paths of a session in recording order"""
+    numbered = []
+    for name in os.listdir(directory):
+        match = re.fullmatch(r"video_(\d+)\.avi", name)
+        if match:
+            numbered.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(numbered)]
+
+
+def read_sampled_frames(directory, every):
+    """
+    Every `every`-th frame of a session.
+    Returns: generator of (frame id, timestamp in seconds, JPEG bytes)
+    """
+    index_path = os.path.join(directory, frame_index.INDEX_NAME)
+    if os.path.exists(index_path):
+        index = frame_index.FrameIndex(index_path)
+        files = {}
+        # Segments written without offsets (cv2.VideoWriter) are walked in step with their records
+        walks = {}
+        try:
+            for i, record in enumerate(index):
+                sampled = i % every == 0
+                path = os.path.join(directory, F"video_{record.segment}.avi")
+                if record.offset == frame_index.OFFSET_UNKNOWN:
+                    if record.segment not in walks:
+                        walks[record.segment] = avi.read_frames(path)
+                    _, data = next(walks[record.segment], (None, None))
+                    if sampled and data is not None:
+                        yield record.frame_id, record.timestamp, data
+                    continue
+                if not sampled:
+                    continue
+                if record.segment not in files:
+                    files[record.segment] = open(path, 'rb')
+                f = files[record.segment]
+                f.seek(record.offset)
+                _, size = struct.unpack("<4sI", f.read(avi.CHUNK_HEADER_SIZE))
+                yield record.frame_id, record.timestamp, f.read(size)
+        finally:
+            for f in files.values():
+                f.close()
+            for walk in walks.values():
+                walk.close()
+        return
+    # No index: walk the segments, frame ids count up across them like the rotator's
+    frame_id = 0
+    for path in session_segments(directory):
+        for _, data in avi.read_frames(path):
+            if frame_id % every == 0:
+                yield frame_id, frame_id / RECORD_FRAMERATE, data
+            frame_id += 1
+
+
+def extract_levels(directory, every=LIGHT_SAMPLE_FRAMES):
+    """
+    Light level of every `every`-th frame of a session, decoded at 1/8 scale.
+    Returns: (session directory, list of (frame id, timestamp, level))
+    """
+    levels = []
+    for frame_id, timestamp, jpeg in read_sampled_frames(directory, every):
+        frame = cv2.imdecode(numpy.frombuffer(jpeg, numpy.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+        if frame is not None:
+            levels.append((frame_id, timestamp, daynight.light_level(frame, 1)))
+    return directory, levels
+
+
+def simulate(levels, params):
+    """
+    Run a LightMeter over extracted light levels.
+    Input: list of (frame id, timestamp, level) taken every params['base_frames'] frames,
+           and a dict of LightMeter arguments plus 'sample_frames' and 'base_frames'
+    Returns: the day_night.csv rows as a list of (frame id, night)
+    """
+    meter_args = dict((key, value) for key, value in params.items() if key not in ('sample_frames', 'base_frames'))
+    meter = daynight.LightMeter(log=None, **meter_args)
+    step = params['sample_frames'] // params['base_frames']
+    rows = []
+    for i in range(0, len(levels), step):
+        frame_id, timestamp, level = levels[i]
+        switched = meter.update(level, timestamp)
+        if not rows:
+            # The first sample decides the starting camera, the recording starts with it at frame 0
+            rows.append((0, meter.night))
+        elif switched:
+            # The other camera's first frame is the one after the sample, like stop_segments' next_frame
+            rows.append((frame_id + 1, meter.night))
+    return rows
+
+
+def read_day_night(path):
+    rows = []
+    with open(path) as f:
+        next(f)
+        for line in f:
+            frame_id, night = line.strip().split(",")
+            rows.append((int(frame_id), night == "True"))
+    return rows
+
+
+def state_at(rows, frame_id):
+    state = rows[0][1]
+    for start, night in rows:
+        if start > frame_id:
+            break
+        state = night
+    return state
+
+
+def agreement(levels, replayed, recorded):
+    """Fraction of the sampled frames where the replayed timeline and the recorded one pick the same camera"""
+    if not levels or not recorded:
+        return None
+    same = sum(state_at(replayed, frame_id) == state_at(recorded, frame_id) for frame_id, _, _ in levels)
+    return same / len(levels)
+
+
+def write_day_night(rows, f):
+    f.write("frame_id,night_true\n")
+    for frame_id, night in rows:
+        f.write(F"{frame_id},{night}\n")
+
+
+def run_simulation(task):
+    directory, levels, params = task
+    rows = simulate(levels, params)
+    recorded_path = os.path.join(directory, "day_night.csv")
+    recorded = read_day_night(recorded_path) if os.path.exists(recorded_path) else None
+    return directory, params, rows, agreement(levels, rows, recorded)
+
+
+def parse_values(text, kind):
+    return [kind(value) for value in text.split(",")]
+
+
+def params_name(params):
+    return "_".join(F"{key}-{value}" for key, value in sorted(params.items()) if key != 'base_frames')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded sessions through the day/night detection")
+    parser.add_argument("sessions", nargs="+", help="session directories")
+    parser.add_argument("--enter", default=str(daynight.NIGHT_ENTER_THRESHOLD), help="night enter threshold(s), comma separated")
+    parser.add_argument("--exit", default=str(daynight.NIGHT_EXIT_THRESHOLD), help="night exit threshold(s), comma separated")
+    parser.add_argument("--smoothing", default=str(daynight.SMOOTHING), help="moving average weight(s), comma separated")
+    parser.add_argument("--hold", default=str(daynight.SWITCH_HOLD_TIME), help="switch hold time(s) in seconds, comma separated")
+    parser.add_argument("--sample-frames", default=str(LIGHT_SAMPLE_FRAMES), help="frames between samples, comma separated")
+    parser.add_argument("--output", help="directory to write <session>_<parameters>_day_night.csv files to")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes, default is one per CPU")
+    args = parser.parse_args()
+
+    sweep = {
+        'enter_threshold': parse_values(args.enter, float),
+        'exit_threshold': parse_values(args.exit, float),
+        'smoothing': parse_values(args.smoothing, float),
+        'hold_time': parse_values(args.hold, float),
+        'sample_frames': parse_values(args.sample_frames, int),
+    }
+    # Decode at the finest sample spacing every parameter set can be built from
+    base_frames = 0
+    for sample_frames in sweep['sample_frames']:
+        base_frames = math.gcd(base_frames, sample_frames)
+    param_sets = [dict(zip(sweep, values), base_frames=base_frames) for values in itertools.product(*sweep.values())]
+
+    with multiprocessing.Pool(args.jobs) as pool:
+        extracted = pool.starmap(extract_levels, [(session, base_frames) for session in args.sessions])
+        tasks = [(directory, levels, params) for directory, levels in extracted for params in param_sets]
+        results = pool.map(run_simulation, tasks)
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        for directory, params, rows, _ in results:
+            name = os.path.basename(os.path.normpath(directory))
+            with open(os.path.join(args.output, F"{name}_{params_name(params)}_day_night.csv"), "w") as f:
+                write_day_night(rows, f)
+    if len(results) == 1 and not args.output:
+        write_day_night(results[0][2], sys.stdout)
+    else:
+        print(F"{'session':30s} {'parameters':70s} {'switches':>8s} {'agreement':>9s}")
+        for directory, params, rows, match in results:
+            name = os.path.basename(os.path.normpath(directory))
+            print(F"{name:30s} {params_name(params):70s} {len(rows) - 1:8d} "
+                  F"{'n/a' if match is None else F'{match * 100:.1f}%':>9s}")
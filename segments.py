@@ -0,0 +1,135 @@
+"""
+Gapless segment rotation for recordings.
+
+A SegmentRotator writes frames into a numbered series of segment files. The
+writer for the next segment is opened on a helper thread as soon as the
+current one starts, and the switch happens inside write() on an exact frame
+boundary. The slow parts (opening the next file, releasing the last one)
+never run on the thread that writes frames, so no frame is lost at a
+rotation. If the next writer is not ready yet when a segment is due to end,
+the current segment just runs a little longer.
+
+The rotator does not know about cameras or file formats: it gets a function
+that opens the writer for segment N, and writers only need write(frame) and
+release(). If a writer's write() returns the byte offset it wrote the frame
+at, the offset is passed on to on_frame_written with the frame's id.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SegmentInfo:
+    """What was recorded into one segment"""
+    def __init__(self, number, first_frame, start_time):
+        self.number = number
+        self.first_frame = first_frame
+        # Frames written, and the id of the last one. Ids can have gaps, see SegmentRotator.skip()
+        self.frames = 0
+        self.last_frame = first_frame - 1
+        self.start_time = start_time
+        self.end_time = start_time
+
+    def as_dict(self):
+        return {
+            'number': self.number,
+            'first_frame': self.first_frame,
+            'frames': self.frames,
+            'last_frame': self.last_frame,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+        }
+
+
+class SegmentRotator:
+    def __init__(self, open_segment, segment_length, first_number=1, first_frame=0,
+                 on_segment_closed=None, discard_segment=None, on_frame_written=None):
+        """
+        Input: open_segment(number) returns a writer for that segment,
+               segment_length in seconds of frame timestamps,
+               first_number of the first segment and first_frame id of the first frame,
+               on_segment_closed(SegmentInfo) is called once a segment's writer has been released,
+               discard_segment(number, writer) cleans up a writer that was opened but never used,
+               on_frame_written(frame id, timestamp, segment number, byte offset or None) is called for every frame
+        """
+        self.open_segment = open_segment
+        self.segment_length = segment_length
+        self.on_segment_closed = on_segment_closed
+        self.discard_segment = discard_segment
+        self.on_frame_written = on_frame_written
+        # A single helper thread keeps opens and releases in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.number = first_number
+        self.next_frame = first_frame
+        self.writer = open_segment(first_number)
+        self.info = None
+        self.closed_segments = []
+        self.next_writer = self.executor.submit(open_segment, first_number + 1)
+
+    def write(self, frame, timestamp, keyframe=True):
+        """
+        Write one frame, rotating to the pre-opened next segment first if this one is long enough.
+        Rotation only happens on keyframes so every segment starts with a decodable frame.
+        Returns: (segment number, frame id) the frame was written as
+        """
+        with self.lock:
+            if self.info is None:
+                self.info = SegmentInfo(self.number, self.next_frame, timestamp)
+            elif keyframe and timestamp - self.info.start_time >= self.segment_length and self.next_writer.done():
+                if self.next_writer.exception() is not None:
+                    # Keep recording into the current segment and try opening the next one again
+                    print(F"Failed to open segment {self.number + 1}: {self.next_writer.exception()}")
+                    self.next_writer = self.executor.submit(self.open_segment, self.number + 1)
+                else:
+                    self._rotate(timestamp)
+            offset = self.writer.write(frame)
+            frame_id = self.next_frame
+            self.next_frame += 1
+            self.info.frames += 1
+            self.info.last_frame = frame_id
+            self.info.end_time = timestamp
+            if self.on_frame_written is not None:
+                # cv2.VideoWriter.write returns None, only byte offsets are passed on
+                self.on_frame_written(frame_id, timestamp, self.number, offset if isinstance(offset, int) else None)
+            return self.number, frame_id
+
+    def skip(self, count=1):
+        """Use up frame ids without writing frames, for frames that were captured but left out"""
+        with self.lock:
+            self.next_frame += count
+
+    def _rotate(self, timestamp):
+        old_writer = self.writer
+        old_info = self.info
+        self.writer = self.next_writer.result()
+        self.number += 1
+        self.info = SegmentInfo(self.number, self.next_frame, timestamp)
+        self.executor.submit(self._release, old_writer, old_info)
+        self.next_writer = self.executor.submit(self.open_segment, self.number + 1)
+
+    def _release(self, writer, info):
+        writer.release()
+        self.closed_segments.append(info)
+        if self.on_segment_closed is not None:
+            self.on_segment_closed(info)
+
+    def release(self):
+        """
+        Finish the current segment and throw away the pre-opened next one. Blocks until everything is closed.
+        Returns: the number the next segment would have had, to continue numbering elsewhere
+        """
+        with self.lock:
+            if self.next_writer.exception() is None:
+                next_writer = self.next_writer.result()
+                if self.discard_segment is not None:
+                    self.discard_segment(self.number + 1, next_writer)
+                else:
+                    next_writer.release()
+            if self.info is None:
+                # Nothing was ever written, treat it as an empty segment
+                self.info = SegmentInfo(self.number, self.next_frame, None)
+            self.executor.submit(self._release, self.writer, self.info)
+            self.executor.shutdown(wait=True)
+            self.writer = None
+            return self.number + 1
@@ -0,0 +1,166 @@
+"""
+Recording sessions on the drive, for the web UI's session browser.
+
+Every time a segment is closed the camera worker adds it to segments.json
+in the session directory: frames, frame ids, the time it covers, which
+camera recorded it and its size. Listing a session reads that small file
+instead of opening the videos. Segments that are not in it yet (the one
+being recorded, or the last one of a session cut off by a power loss) are
+summed up from frames.idx, and SessionCatalog only reads the records that
+were appended since the last listing.
+
+The files themselves are served by downloads.py.
+"""
+
+import json
+import os
+import struct
+import threading
+
+import frame_index
+import merge
+
+SEGMENTS_NAME = "segments.json"
+
+# segments.json is rewritten by the rotator's helper thread, one session at a time
+segments_lock = threading.Lock()
+
+
+def read_segments(directory):
+    """
+    Returns: list of the segment entries in the session's segments.json, oldest first
+    """
+    try:
+        with open(os.path.join(directory, SEGMENTS_NAME)) as f:
+            return json.load(f)['segments']
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def record_segment(path, info, camera):
+    """
+    Add a closed segment to its session's segments.json, called by the camera worker
+    Input: path of the segment file, its segments.SegmentInfo and frame_index camera number
+    """
+    directory = os.path.dirname(path)
+    entry = info.as_dict()
+    entry.update({
+        'name': os.path.basename(path),
+        'camera': frame_index.CAMERA_NAMES[camera],
+        # From the first to the last frame's capture time, motion gated segments can cover more than frames / rate
+        'duration': info.end_time - info.start_time,
+        'size': os.path.getsize(path),
+    })
+    with segments_lock:
+        segments = [segment for segment in read_segments(directory) if segment['number'] != info.number]
+        segments.append(entry)
+        merge.write_json_atomic(os.path.join(directory, SEGMENTS_NAME), {'segments': segments})
+
+
+class IndexSummary:
+    """Per segment frame counts and times of a frames.idx file, updated from where the last read stopped"""
+    def __init__(self, path):
+        self.path = path
+        self.offset = frame_index.HEADER_SIZE
+        # segment number -> {'frames', 'first_frame', 'last_frame', 'start_time', 'end_time', 'camera'}
+        self.segments = {}
+
+    def update(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return
+        # A record still being written is read next time
+        data = data[:len(data) - len(data) % frame_index.RECORD_SIZE]
+        self.offset += len(data)
+        for frame_id, timestamp, number, camera, _ in struct.iter_unpack(frame_index.RECORD_FORMAT, data):
+            segment = self.segments.get(number)
+            if segment is None:
+                segment = self.segments[number] = {
+                    'frames': 0, 'first_frame': frame_id, 'start_time': timestamp,
+                    'camera': frame_index.CAMERA_NAMES[camera],
+                }
+            segment['frames'] += 1
+            segment['last_frame'] = frame_id
+            segment['end_time'] = timestamp
+
+
+class SessionCatalog:
+    """Cached listing of the sessions under a recording directory"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # session directory -> IndexSummary, for segments missing from segments.json
+        self.summaries = {}
+
+    def sessions(self, main_directory, active_directory=None):
+        """
+        Returns: list of session dicts, newest first, see session()
+        """
+        if main_directory is None or not os.path.isdir(main_directory):
+            return []
+        names = sorted((name for name in os.listdir(main_directory)
+                        if os.path.isdir(os.path.join(main_directory, name))), reverse=True)
+        return [self.session(os.path.join(main_directory, name), active_directory) for name in names]
+
+    def session(self, directory, active_directory=None):
+        """
+        Returns: {'name', 'recording', 'merged' (True once video_full.avi is complete), 'segments', 'files'},
+                 segments are segments.json entries with 'size' and 'duration', files are the other
+                 downloadable files as {'name', 'size'}
+        """
+        recording = active_directory is not None and os.path.normpath(directory) == os.path.normpath(active_directory)
+        listed = dict((segment['name'], segment) for segment in read_segments(directory))
+        segments = {}
+        files = []
+        unlisted = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                    continue
+                if entry.name in listed:
+                    # Segments deleted after merging drop out of the listing here
+                    segments[entry.name] = listed[entry.name]
+                elif segment_number(entry.name) is not None:
+                    unlisted.append(entry)
+                else:
+                    files.append({'name': entry.name, 'size': entry.stat().st_size})
+        if unlisted:
+            summary = self.summary(directory)
+            for entry in unlisted:
+                number = segment_number(entry.name)
+                segment = dict(summary.get(number, {}))
+                segment.update({'name': entry.name, 'number': number, 'size': entry.stat().st_size})
+                if 'end_time' in segment:
+                    segment['duration'] = segment['end_time'] - segment['start_time']
+                segments[entry.name] = segment
+        else:
+            with self.lock:
+                self.summaries.pop(directory, None)
+        journal = merge.read_journal(directory)
+        return {
+            'name': os.path.basename(directory),
+            'recording': recording,
+            'merged': journal is not None and journal['done'],
+            'segments': sorted(segments.values(), key=lambda segment: segment['number']),
+            'files': sorted(files, key=lambda f: f['name']),
+        }
+
+    def summary(self, directory):
+        with self.lock:
+            summary = self.summaries.get(directory)
+            if summary is None:
+                summary = self.summaries[directory] = IndexSummary(os.path.join(directory, frame_index.INDEX_NAME))
+            summary.update()
+            return dict(summary.segments)
+
+
+def segment_number(name):
+    """N of video_N.avi, None for other names"""
+    if not (name.startswith('video_') and name.endswith('.avi')):
+        return None
+    try:
+        return int(name[len('video_'):-len('.avi')])
+    except ValueError:
+        return None
@@ -0,0 +1,58 @@
+"""
+One shared memory block, the common base of SharedState, Telemetry and FrameRing.
+
+main.py allocates each block once with allocate(), and the worker processes
+get the object pickled: only the block's name travels, and unpickling
+attaches to the same block. close() drops every view into the block before
+closing it, and unlink() frees the block, which only the process that
+allocated it does.
+"""
+
+from multiprocessing import shared_memory
+
+
+class SharedBlock:
+    # Attributes that point into the block (ctypes structures, memoryviews), they have to go before the block is closed
+    VIEWS = ()
+
+    def __init__(self, shm, owner=False):
+        """
+        Input: the SharedMemory block, None for an object that only lives in this process,
+               and whether this process allocated it
+        """
+        self.shm = shm
+        self.owner = owner
+
+    @staticmethod
+    def allocate(size, name=None):
+        """New block of at least size bytes, for the create() of the subclass"""
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    @staticmethod
+    def attach_block(name):
+        """Block allocated by another process"""
+        return shared_memory.SharedMemory(name=name)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # Worker processes attach to the same block by name, subclasses add what else their __init__ takes
+    def __getstate__(self):
+        return {'name': None if self.shm is None else self.shm.name}
+
+    def __setstate__(self, data):
+        data = dict(data)
+        name = data.pop('name')
+        self.__init__(None if name is None else self.attach_block(name), **data)
+
+    def close(self):
+        for view in self.VIEWS:
+            setattr(self, view, None)
+        if self.shm is not None:
+            self.shm.close()
+
+    def unlink(self):
+        """Free the shared memory block, does nothing in a process that only attached to it"""
+        if self.owner:
+            self.shm.unlink()
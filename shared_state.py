@@ -0,0 +1,207 @@
+"""
+Device state shared between the main, camera and web processes.
+
+Replaces the multiprocessing.Manager dict. The state lives in one ctypes
+structure in shared memory, so reading a field is a local memory access
+instead of a round trip to a manager server process.
+
+Writers take a cross-process lock and bump a version counter before and
+after changing anything (a seqlock). Readers never lock: they retry if the
+version was odd (write in progress) or changed while they were reading, so
+copy() always returns a consistent snapshot of every field. The lock is the
+lock of a condition variable that writers notify, so a process that wants
+to react to changes can sleep in wait_for_change() instead of polling.
+
+Access works like the old dict, e.g. state['recording'] = True, with the
+fields fixed by the FIELDS table below.
+"""
+
+import ctypes
+import multiprocessing
+import time
+
+from shared_block import SharedBlock
+
+# Maximum length in bytes of string fields, longer values are truncated
+STRING_LENGTH = 256
+
+# name, type, default. The order is the layout in shared memory.
+FIELDS = [
+    ('should_record', 'bool', False),
+    ('recording', 'bool', False),
+    ('recording_start_time', 'float', None),
+    ('recording_duration', 'float', None),
+    ('recording_directory', 'str', None),
+    ('combining', 'bool', False),
+    # Fraction of the current merge that is done, 0.0 to 1.0
+    ('combine_progress', 'float', 0.0),
+    ('night', 'bool', False),
+    # Smoothed light level the day/night switch works from, see daynight.py
+    ('light_level', 'float', None),
+    ('error', 'str', None),
+    ('cam_heartbeat', 'bool', False),
+    ('web_heartbeat', 'bool', False),
+    ('mounted', 'bool', False),
+    # Mount point of the first removable drive the system has mounted, in use or not, see mounts.py
+    ('media_mount_point', 'str', None),
+    # Directory the sessions are recorded into on the mounted drive, None while nothing is mounted
+    ('recording_main_directory', 'str', None),
+    ('sd_use', 'float', 0.0),
+    # Free bytes on the recording drive, how fast they go down and the recording time left, see storage.py
+    ('sd_free', 'float', None),
+    ('sd_write_rate', 'float', None),
+    ('sd_time_remaining', 'float', None),
+    ('shutdown_requested', 'bool', False),
+    ('reboot_requested', 'bool', False),
+    ('mount_requested', 'bool', False),
+    # Day camera writer queue, highest depth over the last second and frames dropped since start
+    ('record_queue_depth', 'int', 0),
+    ('record_dropped_frames', 'int', 0),
+    # Vehicles counted crossing the counting line in each direction this recording, None while not counting, see counting.py
+    ('traffic_forward', 'int', None),
+    ('traffic_backward', 'int', None),
+]
+
+CTYPES = {
+    'bool': ctypes.c_bool,
+    'int': ctypes.c_int64,
+    'float': ctypes.c_double,
+    'str': ctypes.c_char * STRING_LENGTH,
+}
+
+
+class StateStruct(ctypes.Structure):
+    # none_mask has bit i set when field i holds None
+    _fields_ = [('version', ctypes.c_uint64), ('none_mask', ctypes.c_uint64)] + \
+        [(name, CTYPES[kind]) for name, kind, _ in FIELDS]
+
+
+def defaults():
+    """Every field at its default value, as a plain dict"""
+    return dict((name, default) for name, _, default in FIELDS)
+
+
+FIELD_INDEX = dict((name, (i, kind)) for i, (name, kind, _) in enumerate(FIELDS))
+
+
+class SharedState(SharedBlock):
+    VIEWS = ('struct',)
+
+    def __init__(self, shm, changed, owner=False):
+        super().__init__(shm, owner)
+        self.changed = changed
+        self.struct = StateStruct.from_buffer(shm.buf)
+
+    @classmethod
+    def create(cls):
+        """Allocate the state block with every field at its default, called once by main.py"""
+        state = cls(cls.allocate(ctypes.sizeof(StateStruct)), multiprocessing.Condition(), owner=True)
+        state.update(defaults())
+        return state
+
+    # Worker processes share the same condition as well
+    def __getstate__(self):
+        return dict(super().__getstate__(), changed=self.changed)
+
+    def _read_field(self, name):
+        i, kind = FIELD_INDEX[name]
+        if self.struct.none_mask & (1 << i):
+            return None
+        value = getattr(self.struct, name)
+        if kind == 'str':
+            return value.decode(errors='replace')
+        return value
+
+    def _convert(self, name, value):
+        # Done before the version bump, so a bad value can't leave the version odd
+        kind = FIELD_INDEX[name][1]
+        if value is None:
+            return None
+        if kind == 'str':
+            return str(value).encode()[:STRING_LENGTH - 1]
+        return CTYPES[kind](value).value
+
+    def _write_field(self, name, value):
+        i, kind = FIELD_INDEX[name]
+        if value is None:
+            self.struct.none_mask |= (1 << i)
+            return
+        setattr(self.struct, name, value)
+        self.struct.none_mask &= ~(1 << i)
+
+    def _read(self, names):
+        struct = self.struct
+        while True:
+            version = struct.version
+            if version & 1:
+                # A writer is in the middle of an update, let it run
+                time.sleep(0)
+                continue
+            values = [self._read_field(name) for name in names]
+            if struct.version == version:
+                return values
+
+    def __getitem__(self, name):
+        # Single field fast path of _read, this is called from every loop in every process
+        i, kind = FIELD_INDEX[name]
+        struct = self.struct
+        while True:
+            version = struct.version
+            if version & 1:
+                time.sleep(0)
+                continue
+            if struct.none_mask & (1 << i):
+                value = None
+            else:
+                value = getattr(struct, name)
+                if kind == 'str':
+                    value = value.decode(errors='replace')
+            if struct.version == version:
+                return value
+
+    def __setitem__(self, name, value):
+        self.update({name: value})
+
+    def __contains__(self, name):
+        return name in FIELD_INDEX
+
+    def get(self, name, default=None):
+        if name not in FIELD_INDEX:
+            return default
+        return self[name]
+
+    def keys(self):
+        return [name for name, _, _ in FIELDS]
+
+    def update(self, values):
+        """Write several fields as one atomic change"""
+        for name in values:
+            if name not in FIELD_INDEX:
+                raise KeyError(name)
+        values = [(name, self._convert(name, value)) for name, value in values.items()]
+        with self.changed:
+            self.struct.version += 1
+            try:
+                for name, value in values:
+                    self._write_field(name, value)
+            finally:
+                self.struct.version += 1
+                self.changed.notify_all()
+
+    def version(self):
+        """Even number that changes every time any field is written"""
+        return self.struct.version & ~1
+
+    def wait_for_change(self, version, timeout=None):
+        """
+        Sleep until the state is written after the given version() or the timeout runs out
+        Returns: the current version
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version() != version, timeout)
+            return self.version()
+
+    def copy(self):
+        """Consistent snapshot of every field as a plain dict, e.g. for /status"""
+        names = self.keys()
+        return dict(zip(names, self._read(names)))
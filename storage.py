@@ -0,0 +1,133 @@
+"""
+Free space monitoring of the recording drive.
+
+StorageMonitor reads os.statvfs of the mount point every
+STORAGE_CHECK_INTERVAL seconds, a single system call instead of a df
+pipeline. It tracks how fast free space goes down while recording, as a
+moving average, and estimates how long the recording can continue at that
+rate before free space reaches FREE_SPACE_FLOOR.
+
+Once free space is at the floor, main.py applies the RETENTION_POLICY:
+'stop' ends the recording cleanly, 'delete_oldest' removes the oldest
+finished sessions under the recording directory until free space is back
+above the floor, and stops the recording if there is nothing left to
+delete. The floor is kept well above zero so the segment being written
+always has room to be closed; a full disk would cut it off mid frame.
+"""
+
+import os
+import shutil
+import time
+
+import merge
+
+# Seconds between statvfs calls
+STORAGE_CHECK_INTERVAL = 5.0
+# Bytes that always stay free, the recording stops or old sessions are deleted below this
+FREE_SPACE_FLOOR = 2 * 1024 ** 3
+# 'stop' or 'delete_oldest'
+RETENTION_POLICY = 'stop'
+# Weight of a new measurement in the write rate moving average, about a minute at the check interval
+RATE_SMOOTHING = 0.1
+
+
+class StorageMonitor:
+    def __init__(self, path, floor=FREE_SPACE_FLOOR, interval=STORAGE_CHECK_INTERVAL):
+        """
+        Input: a path on the drive to watch (the mount point), free space floor in bytes, seconds between checks
+        """
+        self.path = path
+        self.floor = floor
+        self.interval = interval
+        self.total = None
+        self.free = None
+        # Bytes per second free space went down, None until two checks were made
+        self.write_rate = None
+        self.last_check = None
+
+    def check(self, measure_rate=True):
+        """Read statvfs now and update the write rate, unless measure_rate is False (e.g. right after deleting files)"""
+        stats = os.statvfs(self.path)
+        now = time.monotonic()
+        free = stats.f_bavail * stats.f_frsize
+        if measure_rate and self.free is not None and now > self.last_check:
+            # Free space going up (deleted files) counts as no writes rather than a negative rate
+            rate = max(0.0, (self.free - free) / (now - self.last_check))
+            if self.write_rate is None:
+                self.write_rate = rate
+            else:
+                self.write_rate += RATE_SMOOTHING * (rate - self.write_rate)
+        self.total = stats.f_blocks * stats.f_frsize
+        self.free = free
+        self.last_check = now
+
+    def update(self):
+        """
+        Check again if the interval is over.
+        Returns: True if a check was made
+        """
+        if self.last_check is not None and time.monotonic() - self.last_check < self.interval:
+            return False
+        self.check()
+        return True
+
+    def used_percent(self):
+        if not self.total:
+            return 0.0
+        return 100.0 * (self.total - self.free) / self.total
+
+    def below_floor(self):
+        return self.free is not None and self.free <= self.floor
+
+    def time_remaining(self):
+        """
+        Returns: seconds until free space reaches the floor at the current write rate, None while nothing is written
+        """
+        if self.free is None or not self.write_rate:
+            return None
+        return max(0.0, (self.free - self.floor) / self.write_rate)
+
+    def state(self):
+        """Shared state fields describing the drive"""
+        return {
+            'sd_use': self.used_percent(),
+            'sd_free': self.free,
+            'sd_write_rate': self.write_rate,
+            'sd_time_remaining': self.time_remaining(),
+        }
+
+
+def oldest_sessions(main_directory, active_directory=None):
+    """
+    Finished session directories under main_directory, oldest first.
+    Only sessions whose merge has finished count: this skips the session being recorded, sessions the
+    merge worker has not finished with, and sessions cut off by a power loss that recovery.py has not
+    queued for merging yet (they have no merge.json).
+    """
+    if not os.path.isdir(main_directory):
+        return []
+    active = None if active_directory is None else os.path.normpath(active_directory)
+    sessions = []
+    # Session directories are named by their start time, so name order is recording order
+    for name in sorted(os.listdir(main_directory)):
+        directory = os.path.normpath(os.path.join(main_directory, name))
+        if not os.path.isdir(directory) or directory == active:
+            continue
+        journal = merge.read_journal(directory)
+        if journal is not None and journal['done']:
+            sessions.append(directory)
+    return sessions
+
+
+def free_space(monitor, main_directory, active_directory=None):
+    """
+    Delete the oldest finished sessions until free space is above the monitor's floor.
+    Returns: True if there is room above the floor afterwards
+    """
+    for directory in oldest_sessions(main_directory, active_directory):
+        if not monitor.below_floor():
+            break
+        print(F"Free space below {monitor.floor} bytes, deleting oldest session {directory}")
+        shutil.rmtree(directory, ignore_errors=True)
+        monitor.check(measure_rate=False)
+    return not monitor.below_floor()
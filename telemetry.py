@@ -0,0 +1,237 @@
+"""
+Pipeline telemetry shared between the camera and web processes.
+
+Counters, gauges and latency histograms live in one ctypes structure in
+shared memory, laid out by the METRICS table below. The code on the frame
+path holds a handle per metric, created once at startup, and updating a
+handle only changes numbers in place: no lists, dicts or strings are
+created per frame. Each metric is updated by one thread, readers may see
+a histogram's buckets a frame ahead of its sum, which does not matter for
+monitoring.
+
+The web process reads the same block for the Prometheus text endpoint
+(/metrics), and the camera process appends a RollingSummary of every
+SUMMARY_INTERVAL to telemetry.jsonl in the session directory.
+"""
+
+import bisect
+import ctypes
+import json
+import os
+import time
+
+from shared_block import SharedBlock
+
+# Upper bounds of the latency histogram buckets in seconds, one more bucket holds everything above
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+BUCKET_COUNT = len(LATENCY_BUCKETS) + 1
+SUMMARY_NAME = "telemetry.jsonl"
+# Seconds covered by each line of the rolling summary
+SUMMARY_INTERVAL = 60.0
+
+# key, kind, Prometheus name, labels, help. Metrics sharing a name are exported as one family.
+METRICS = [
+    ('day_frames_captured', 'counter', 'bwct_frames_captured_total', 'camera="day"', "Frames read from the camera"),
+    ('night_frames_captured', 'counter', 'bwct_frames_captured_total', 'camera="night"', "Frames read from the camera"),
+    ('day_capture_fps', 'gauge', 'bwct_capture_fps', 'camera="day"', "Frames captured over the last second"),
+    ('night_capture_fps', 'gauge', 'bwct_capture_fps', 'camera="night"', "Frames captured over the last second"),
+    ('day_read_seconds', 'histogram', 'bwct_capture_read_seconds', 'camera="day"',
+     "Time blocked reading a frame from the camera, close to the frame interval while the camera keeps up"),
+    ('day_capture_seconds', 'histogram', 'bwct_capture_process_seconds', 'camera="day"',
+     "Time from a frame arriving to it being handed to the writer"),
+    ('day_frames_written', 'counter', 'bwct_frames_written_total', 'camera="day"', "Frames written to segment files"),
+    ('night_frames_written', 'counter', 'bwct_frames_written_total', 'camera="night"', "Frames written to segment files"),
+    ('day_write_seconds', 'histogram', 'bwct_write_seconds', 'camera="day"', "Time to write one frame to its segment"),
+    ('night_write_seconds', 'histogram', 'bwct_write_seconds', 'camera="night"', "Time to write one frame to its segment"),
+    ('write_queue_depth', 'gauge', 'bwct_write_queue_depth', '', "Frames waiting for the day camera writer thread"),
+    ('write_queue_dropped', 'counter', 'bwct_write_queue_dropped_total', '',
+     "Frames dropped because the day camera writer queue was full"),
+    ('preview_frames', 'counter', 'bwct_preview_frames_total', '', "Frames written to the preview ring"),
+    ('preview_encode_seconds', 'histogram', 'bwct_preview_encode_seconds', '', "Time to convert and encode one preview frame"),
+    ('preview_oversize', 'counter', 'bwct_preview_oversize_total', '', "Preview frames too big for a ring slot"),
+    ('preview_clients', 'gauge', 'bwct_preview_clients', '', "Connected preview viewers"),
+    ('preview_sent', 'counter', 'bwct_preview_sent_total', '', "Preview frames handed to viewers"),
+    ('preview_skipped', 'counter', 'bwct_preview_skipped_total', '',
+     "Preview frames viewers skipped because they were slower than the camera"),
+    ('preview_delivery_seconds', 'histogram', 'bwct_preview_delivery_seconds', '',
+     "Time from the web process picking up a preview frame to a viewer taking it"),
+    ('preview_variant_encodes', 'counter', 'bwct_preview_variant_frames_total', 'result="encoded"',
+     "Scaled preview frames requested by viewers and snapshots"),
+    ('preview_variant_hits', 'counter', 'bwct_preview_variant_frames_total', 'result="cached"',
+     "Scaled preview frames requested by viewers and snapshots"),
+    ('preview_variant_seconds', 'histogram', 'bwct_preview_variant_seconds', '', "Time to scale and encode one preview variant"),
+    ('motion_skipped', 'counter', 'bwct_motion_skipped_frames_total', '',
+     "Frames left out of the recording by the motion gate because nothing moved"),
+    ('motion_active', 'gauge', 'bwct_motion_active', '', "1 while the motion gate records at the full frame rate"),
+    ('counting_frames', 'counter', 'bwct_counting_frames_total', 'result="analysed"', "Frames seen by the traffic counter"),
+    ('counting_skipped', 'counter', 'bwct_counting_frames_total', 'result="skipped"', "Frames seen by the traffic counter"),
+    ('segment_flush_seconds', 'histogram', 'bwct_segment_flush_seconds', '',
+     "Time to write one buffer of segment data to the drive"),
+    ('segment_staged_bytes', 'gauge', 'bwct_segment_staged_bytes', '', "Segment data in memory waiting for the drive"),
+    ('counting_seconds', 'histogram', 'bwct_counting_seconds', '', "Time to analyse one frame in the traffic counter"),
+]
+
+METRIC_KINDS = dict((key, kind) for key, kind, _, _, _ in METRICS)
+
+
+class HistogramStruct(ctypes.Structure):
+    # Bucket counts are per bucket here and made cumulative when exported
+    _fields_ = [('buckets', ctypes.c_uint64 * BUCKET_COUNT), ('sum', ctypes.c_double), ('count', ctypes.c_uint64)]
+
+
+class TelemetryStruct(ctypes.Structure):
+    _fields_ = [(key, HistogramStruct if kind == 'histogram' else ctypes.c_double) for key, kind, _, _, _ in METRICS]
+
+
+class Scalar:
+    """Handle of a counter or gauge"""
+    def __init__(self, struct, key):
+        self.struct = struct
+        self.key = key
+
+    def inc(self, amount=1):
+        setattr(self.struct, self.key, getattr(self.struct, self.key) + amount)
+
+    def set(self, value):
+        setattr(self.struct, self.key, value)
+
+    def get(self):
+        return getattr(self.struct, self.key)
+
+
+class Histogram:
+    """Handle of a latency histogram"""
+    def __init__(self, struct, key):
+        self.histogram = getattr(struct, key)
+        self.buckets = self.histogram.buckets
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.histogram.sum += seconds
+        self.histogram.count += 1
+
+
+class Telemetry(SharedBlock):
+    VIEWS = ('struct',)
+
+    def __init__(self, shm=None, owner=False):
+        super().__init__(shm, owner)
+        # Without a shared memory block the metrics only live in this process, e.g. for bench.py
+        self.struct = TelemetryStruct() if shm is None else TelemetryStruct.from_buffer(shm.buf)
+
+    @classmethod
+    def create(cls):
+        """Allocate the shared block with every metric at zero, called once by main.py"""
+        shm = cls.allocate(ctypes.sizeof(TelemetryStruct))
+        shm.buf[:ctypes.sizeof(TelemetryStruct)] = bytes(ctypes.sizeof(TelemetryStruct))
+        return cls(shm, owner=True)
+
+    def metric(self, key):
+        """Handle to update one metric from the frame path, create it once and keep it"""
+        if METRIC_KINDS[key] == 'histogram':
+            return Histogram(self.struct, key)
+        return Scalar(self.struct, key)
+
+    def snapshot(self):
+        """Every metric as plain values, histograms as {'buckets': [...], 'sum': ..., 'count': ...}"""
+        values = {}
+        for key, kind, _, _, _ in METRICS:
+            value = getattr(self.struct, key)
+            if kind == 'histogram':
+                value = {'buckets': list(value.buckets), 'sum': value.sum, 'count': value.count}
+            values[key] = value
+        return values
+
+    def prometheus_text(self):
+        """Every metric in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, metrics in METRIC_FAMILIES:
+            _, kind, _, _, help_text = metrics[0]
+            lines.append(F"# HELP {name} {help_text}")
+            lines.append(F"# TYPE {name} {kind}")
+            for key, _, _, labels, _ in metrics:
+                value = snapshot[key]
+                if kind != 'histogram':
+                    lines.append(F"{name}{{{labels}}} {value}" if labels else F"{name} {value}")
+                    continue
+                separator = "," if labels else ""
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value['buckets']):
+                    cumulative += count
+                    lines.append(F'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+                suffix = F"{{{labels}}}" if labels else ""
+                lines.append(F"{name}_sum{suffix} {value['sum']}")
+                lines.append(F"{name}_count{suffix} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def metric_families():
+    families = {}
+    for metric in METRICS:
+        families.setdefault(metric[2], []).append(metric)
+    return list(families.items())
+
+
+METRIC_FAMILIES = metric_families()
+
+
+def quantile(buckets, q):
+    """Upper bound of the bucket holding the q quantile, None if it is above the last bound or there is no data"""
+    total = sum(buckets)
+    if total == 0:
+        return None
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, buckets):
+        cumulative += count
+        if cumulative >= q * total:
+            return bound
+    return None
+
+
+def summarize(previous, current, seconds):
+    """
+    Summary of what happened between two snapshots.
+    Returns: dict with per second rates of counters, current gauges and count, mean and p50/p90/p99 of histograms
+    """
+    summary = {'time': time.time(), 'seconds': round(seconds, 3)}
+    for key, kind, _, _, _ in METRICS:
+        if kind == 'counter':
+            delta = current[key] - previous[key]
+            summary[key] = {'total': current[key], 'delta': delta, 'per_second': round(delta / seconds, 3) if seconds else None}
+        elif kind == 'gauge':
+            summary[key] = current[key]
+        else:
+            buckets = [now - before for now, before in zip(current[key]['buckets'], previous[key]['buckets'])]
+            count = current[key]['count'] - previous[key]['count']
+            total = current[key]['sum'] - previous[key]['sum']
+            summary[key] = {
+                'count': count,
+                'mean': total / count if count else None,
+                'p50': quantile(buckets, 0.5),
+                'p90': quantile(buckets, 0.9),
+                'p99': quantile(buckets, 0.99),
+            }
+    return summary
+
+
+class RollingSummary:
+    """Appends one JSON line per SUMMARY_INTERVAL to telemetry.jsonl in a session directory"""
+    def __init__(self, telemetry, directory, interval=SUMMARY_INTERVAL):
+        self.telemetry = telemetry
+        self.path = os.path.join(directory, SUMMARY_NAME)
+        self.interval = interval
+        self.previous = telemetry.snapshot()
+        self.previous_time = time.monotonic()
+
+    def update(self, force=False):
+        """Write a line if the interval is over, or right away with force (at the end of a recording)"""
+        now = time.monotonic()
+        if not force and now - self.previous_time < self.interval:
+            return
+        current = self.telemetry.snapshot()
+        summary = summarize(self.previous, current, now - self.previous_time)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(summary) + "\n")
+        self.previous = current
+        self.previous_time = now
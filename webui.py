@@ -1,55 +1,518 @@
 # Web server worker for recording device
 # Uses Flask to serve a web interface for the recording device and display a preview of the camera
 
-from flask import Flask, jsonify, render_template, Response
+from flask import Flask, jsonify, render_template, request, Response
+import json
+import math
 import time
 import threading
 import logging
 
+import cv2
+import numpy
+
+from telemetry import Telemetry
+import downloads
+import sessions
+
 PREVIEW_FRAMERATE = 1.0
-preview_queue = None
+# Matches OpenCV's default JPEG quality
+PREVIEW_QUALITY = 95
+# Widths and qualities a ?width=&quality= request is rounded up to, so every viewer of a size shares one encode
+PREVIEW_WIDTHS = (160, 320, 480, 640)
+PREVIEW_QUALITIES = (30, 50, 70, 85, 95)
+# A /snapshot.jpg keeps the camera producing preview frames at this rate for this many seconds,
+# so the next snapshot is fresh even without anyone watching the stream
+SNAPSHOT_FRAMERATE = 1.0
+SNAPSHOT_DEMAND_TIME = 30.0
+# Longest a snapshot waits for the camera to wake up
+SNAPSHOT_TIMEOUT = 3.0
+preview_ring = None
+preview_hub = None
+status_broadcaster = None
 device_state = None
-preview_frame = None
+telemetry = None
+session_catalog = None
+download_server = None
+# Seconds between keep-alive comments on idle /events streams, also how fast a closed stream is noticed
+STATUS_KEEPALIVE_INTERVAL = 15.0
 
 app = Flask(__name__)
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
-def web_worker(preview_framerate, queue, state):
+def web_worker(preview_framerate, ring, state, telemetry_arg):
     print(F"Starting web worker with preview framerate: {preview_framerate}")
-    global PREVIEW_FRAMERATE, preview_queue, device_state, app
+    global PREVIEW_FRAMERATE, preview_ring, preview_hub, status_broadcaster, device_state, telemetry, app
     PREVIEW_FRAMERATE = preview_framerate
-    preview_queue = queue
+    preview_ring = ring
     device_state = state
+    telemetry = telemetry_arg
+    preview_hub = PreviewHub(ring, preview_framerate, telemetry)
+    status_broadcaster = StatusBroadcaster(state)
+    start_downloads(state)
 
-    # Start the background thread to update the latest preview frame
-    preview_thread = threading.Thread(target=get_preview_frame)
-    preview_thread.daemon = True
-    preview_thread.start()
     app.run(host='0.0.0.0', port='80', use_reloader=False, debug=False)
 
 
-def get_preview_frame():
-    print(F"Started preview thread")
-    global preview_frame, preview_queue
+# cv2.imdecode flags that decode a JPEG straight to a fraction of its size
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def jpeg_size(data):
+    """
+    Read the frame size from a JPEG's start of frame marker without decoding it
+    Returns: (width, height), None if it is not a JPEG
+    """
+    offset = 2
+    while offset + 9 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        length = (data[offset + 2] << 8) | data[offset + 3]
+        # SOF0 to SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[offset + 7] << 8) | data[offset + 8], (data[offset + 5] << 8) | data[offset + 6]
+        offset += 2 + length
+    return None
+
+
+def variant_key(width, quality):
+    """
+    Round a requested width and quality up to the nearest cached variant
+    Returns: (width or None for the source width, quality or None for the source quality)
+    """
+    if width is not None:
+        width = next((w for w in PREVIEW_WIDTHS if w >= width), None)
+    if quality is not None:
+        quality = next((q for q in PREVIEW_QUALITIES if q >= quality), PREVIEW_QUALITIES[-1])
+    return width, quality
+
+
+def scale_jpeg(frame, width, quality):
+    """
+    Input: JPEG bytes, width to scale down to or None to keep the size, JPEG quality or None for PREVIEW_QUALITY
+    Returns: the re-encoded JPEG bytes
+    """
+    size = jpeg_size(frame)
+    flags = cv2.IMREAD_COLOR
+    if size is not None and width is not None:
+        # libjpeg skips most of the IDCT when decoding to a fraction of the size
+        flags = next((flag for scale, flag in REDUCED_DECODE_FLAGS if size[0] // scale >= width), cv2.IMREAD_COLOR)
+    image = cv2.imdecode(numpy.frombuffer(frame, numpy.uint8), flags)
+    if width is not None and image.shape[1] > width:
+        height = max(round(image.shape[0] * width / image.shape[1]), 1)
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    quality = PREVIEW_QUALITY if quality is None else quality
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def start_downloads(state):
+    """Start the session catalog and the download server for the recording directory in the shared state"""
+    global session_catalog, download_server
+    session_catalog = sessions.SessionCatalog()
+    # Downloads let go of the drive as soon as someone asks to unmount it
+    download_server = downloads.DownloadServer(
+        lambda: state['recording_main_directory'] if state['mounted'] else None,
+        lambda: state['mount_requested'] or not state['mounted'])
+    download_server.start()
+
+
+def session_listing(state):
+    """Body of /sessions: the download server's port and every session on the drive, newest first"""
+    main_directory = state['recording_main_directory'] if state['mounted'] else None
+    return {
+        'download_port': download_server.server_address[1],
+        'sessions': session_catalog.sessions(main_directory, state['recording_directory']),
+    }
+
+
+class PreviewClient:
+    """One connected /video_feed viewer and its delivery counters"""
+    def __init__(self, client_id, framerate, quality, remote=None, variant=(None, None)):
+        self.id = client_id
+        self.framerate = framerate
+        self.quality = quality
+        self.remote = remote
+        # (width, quality) from variant_key(), (None, None) for the preview frames as the camera sends them
+        self.variant = variant
+        self.connected_time = time.time()
+        self.last_seq = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'remote': self.remote,
+            'framerate': self.framerate,
+            'quality': self.quality,
+            'variant': self.variant,
+            'connected_time': self.connected_time,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+        }
+
+
+class PreviewHub:
+    """
+    Pulls each preview frame out of the shared ring once and hands the same bytes to every client.
+    Every client has its own frame rate cap and always gets the newest frame, so a slow client
+    skips frames (counted as dropped) instead of holding up anyone else.
+    Scaled down variants are encoded once per frame and variant, whoever asks first, and every
+    other viewer and snapshot of that variant gets the cached bytes.
+    """
+    def __init__(self, ring, max_framerate, telemetry=None):
+        self.ring = ring
+        self.max_framerate = max_framerate
+        self.clients = {}
+        self.next_client_id = 0
+        self.seq = 0
+        self.frame = None
+        self.frame_time = 0.0
+        if telemetry is None:
+            telemetry = Telemetry()
+        # Updated with the condition held, so every stream thread can share them
+        self.clients_gauge = telemetry.metric('preview_clients')
+        self.sent = telemetry.metric('preview_sent')
+        self.skipped = telemetry.metric('preview_skipped')
+        self.delivery_seconds = telemetry.metric('preview_delivery_seconds')
+        self.variant_encodes = telemetry.metric('preview_variant_encodes')
+        self.variant_hits = telemetry.metric('preview_variant_hits')
+        self.variant_seconds = telemetry.metric('preview_variant_seconds')
+        self.condition = threading.Condition()
+        self.has_clients = threading.Event()
+        # (width, quality) -> (seq, JPEG bytes) of the newest frame encoded for that variant
+        self.variants = {}
+        # One lock per variant, so viewers wanting the same variant wait for one encode instead of each doing it
+        self.variant_locks = {}
+        # Snapshots keep the camera producing frames until this time
+        self.snapshot_until = 0.0
+        self.snapshot_timer = None
+        # Start from "no viewers" so the camera does not encode for clients of a previous run
+        self.publish_demand()
+        self.start()
+
+    def start(self):
+        self.pump_thread = threading.Thread(target=self.pump)
+        self.pump_thread.daemon = True
+        self.pump_thread.start()
+
+    def publish_demand(self):
+        """Tell the camera process how many viewers there are and the highest rate and quality any of them wants"""
+        framerates = [client.framerate for client in self.clients.values()]
+        qualities = [client.quality for client in self.clients.values()]
+        viewers = len(self.clients)
+        if time.monotonic() < self.snapshot_until:
+            # Snapshots count as one slow viewer at full quality, they scale down from there
+            viewers += 1
+            framerates.append(SNAPSHOT_FRAMERATE)
+            qualities.append(PREVIEW_QUALITY)
+        self.ring.set_demand(viewers, max(framerates, default=0.0), max(qualities, default=0))
+        self.clients_gauge.set(len(self.clients))
+
+    def add_client(self, framerate, quality, remote=None, variant=(None, None)):
+        with self.condition:
+            self.next_client_id += 1
+            client = PreviewClient(self.next_client_id, framerate, quality, remote, variant)
+            self.clients[client.id] = client
+            self.publish_demand()
+            self.has_clients.set()
+        return client
+
+    def remove_client(self, client):
+        with self.condition:
+            self.clients.pop(client.id, None)
+            self.publish_demand()
+            if not self.clients:
+                self.has_clients.clear()
+
+    def pump(self):
+        print("Started preview hub thread")
+        # Poll the ring at twice the maximum preview rate, reading the header is only a few bytes
+        poll_interval = 1 / (2 * self.max_framerate)
+        while True:
+            self.has_clients.wait()
+            seq, frame = self.ring.read_latest(self.seq)
+            if frame is None:
+                time.sleep(poll_interval)
+                continue
+            with self.condition:
+                self.seq = seq
+                self.frame = frame
+                self.frame_time = time.monotonic()
+                self.condition.notify_all()
+
+    def next_frame(self, client, timeout=1.0):
+        """
+        Block until there is a frame newer than the last one this client got
+        Returns: the frame bytes, or None if nothing new arrived within the timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq > client.last_seq, timeout):
+                return None
+            return self.take_frame(client)
+
+    def take_frame(self, client):
+        """Hand the newest frame to a client and update its counters, called with the condition held"""
+        # Latest frame wins, anything published since the last delivery was skipped
+        if client.last_seq:
+            client.dropped += self.seq - client.last_seq - 1
+            self.skipped.inc(self.seq - client.last_seq - 1)
+        client.last_seq = self.seq
+        client.delivered += 1
+        self.sent.inc()
+        self.delivery_seconds.observe(time.monotonic() - self.frame_time)
+        return self.frame
+
+    def variant(self, seq, frame, key):
+        """
+        Input: sequence number and bytes of a preview frame, variant key from variant_key()
+        Returns: the frame as that variant, encoded at most once per frame
+        """
+        if key == (None, None):
+            return frame
+        with self.condition:
+            lock = self.variant_locks.setdefault(key, threading.Lock())
+        with lock:
+            cached = self.variants.get(key)
+            if cached is not None and cached[0] >= seq:
+                # A newer frame may already be cached when this caller was slow, it is just as good
+                with self.condition:
+                    self.variant_hits.inc()
+                return cached[1]
+            encode_start = time.monotonic()
+            data = scale_jpeg(frame, *key)
+            # The counters are shared by every variant, their locks do not cover them
+            with self.condition:
+                self.variant_seconds.observe(time.monotonic() - encode_start)
+                self.variant_encodes.inc()
+            self.variants[key] = (seq, data)
+            return data
+
+    def request_frames(self):
+        """
+        Keep the camera producing frames for SNAPSHOT_DEMAND_TIME.
+        Returns: True if it was not producing any, so the frame in the ring may be old
+        """
+        with self.condition:
+            idle = not self.clients and time.monotonic() >= self.snapshot_until
+            self.snapshot_until = time.monotonic() + SNAPSHOT_DEMAND_TIME
+            self.publish_demand()
+            if self.snapshot_timer is None:
+                self.start_snapshot_timer(SNAPSHOT_DEMAND_TIME)
+        return idle
+
+    def start_snapshot_timer(self, delay):
+        self.snapshot_timer = threading.Timer(delay, self.snapshot_expired)
+        self.snapshot_timer.daemon = True
+        self.snapshot_timer.start()
+
+    def snapshot_expired(self):
+        with self.condition:
+            remaining = self.snapshot_until - time.monotonic()
+            if remaining > 0:
+                # Another snapshot came in since the timer started
+                self.start_snapshot_timer(remaining)
+                return
+            self.snapshot_timer = None
+            self.publish_demand()
+
+    def snapshot(self, key, timeout=SNAPSHOT_TIMEOUT):
+        """
+        Latest preview frame as a variant, read from the ring without registering as a viewer
+        Returns: (seq, JPEG bytes), (0, None) if the camera has not sent any frame
+        """
+        seq = self.ring.latest_seq()
+        if self.request_frames():
+            # The camera checks for demand about once a second when idle, wait for it to catch up
+            deadline = time.monotonic() + timeout
+            while self.ring.latest_seq() <= seq and time.monotonic() < deadline:
+                time.sleep(0.05)
+        with self.condition:
+            if self.ring.latest_seq() == self.seq:
+                seq, frame = self.seq, self.frame
+            else:
+                seq, frame = None, None
+        if frame is None:
+            seq, frame = self.ring.read_latest()
+            if frame is None:
+                return 0, None
+        return seq, self.variant(seq, frame, key)
+
+    def stats(self):
+        with self.condition:
+            return [client.stats() for client in self.clients.values()]
+
+
+def gen_frame(hub, framerate, quality, remote=None, variant=(None, None)):  # generate frames for video streaming
+    # Registered inside the generator so the finally below always pairs with it
+    client = hub.add_client(framerate, quality, remote, variant)
+    interval = 1 / client.framerate
+    next_time = time.time()
+    try:
+        while True:
+            # Wait out this client's own frame rate cap before picking up the newest frame
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            frame = hub.next_frame(client)
+            if frame is None:
+                continue
+            next_time = max(next_time + interval, time.time())
+            frame = hub.variant(client.last_seq, frame, client.variant)
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    finally:
+        # Runs when the client disconnects and the server closes the generator
+        hub.remove_client(client)
+
+
+class StatusBroadcaster:
+    """
+    Sleeps until the shared device state changes, then wakes every /events subscriber.
+    Each subscriber diffs the latest snapshot against the last one it sent, so it only
+    pushes the fields that changed, and a slow subscriber just sends fewer, larger updates.
+    """
+    def __init__(self, state):
+        self.state = state
+        # Counts snapshots that actually differ, writes that leave every value the same are ignored
+        self.version = 0
+        self.snapshot = state.copy()
+        self.condition = threading.Condition()
+        self.listeners = []
+        self.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self):
+        print("Started status broadcaster thread")
+        state_version = self.state.version()
+        while True:
+            state_version = self.state.wait_for_change(state_version)
+            snapshot = self.state.copy()
+            if snapshot == self.snapshot:
+                continue
+            with self.condition:
+                self.version += 1
+                self.snapshot = snapshot
+                self.condition.notify_all()
+            for listener in self.listeners:
+                listener()
+
+    def add_listener(self, listener):
+        """Call listener from the broadcaster thread after every change, used by the async server"""
+        self.listeners.append(listener)
+
+    def wait(self, version, timeout):
+        """
+        Block until the snapshot is newer than version or the timeout runs out
+        Returns: (version, snapshot)
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version, self.snapshot
+
+
+def status_changes(previous, snapshot):
+    """Fields of snapshot that differ from previous, everything if there is no previous"""
+    if previous is None:
+        return dict(snapshot)
+    return dict((key, value) for key, value in snapshot.items() if previous.get(key) != value)
+
+
+def status_event(changes):
+    return ('data: ' + json.dumps(changes) + '\n\n').encode()
+
+
+def gen_status(broadcaster):  # generate server-sent events with status changes
+    version = None
+    previous = None
     while True:
-        if (not preview_queue.empty()):
-            preview_frame = preview_queue.get()
+        version, snapshot = broadcaster.wait(version, STATUS_KEEPALIVE_INTERVAL)
+        changes = status_changes(previous, snapshot)
+        previous = snapshot
+        if changes:
+            yield status_event(changes)
+        else:
+            # Comment line, keeps proxies from timing out and lets the server notice closed connections
+            yield b': keepalive\n\n'
 
 
-def gen_frame(preview_framerate, queue):  # generate frames for video streaming
-    global preview_frame
-    while True and not (preview_frame is None):
-        time.sleep(1/preview_framerate)
-        frame = queue.get()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+@app.route('/events')
+def events():
+    global status_broadcaster
+    return Response(gen_status(status_broadcaster), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/video_feed')
 def video_feed():
-    global PREVIEW_FRAMERATE, preview_queue
-    return Response(gen_frame(PREVIEW_FRAMERATE, preview_queue), mimetype='multipart/x-mixed-replace; boundary=frame')
+    global PREVIEW_FRAMERATE, preview_hub
+    # Viewers can ask for a lower rate or quality than the defaults, but never a higher rate
+    framerate = min(request.args.get('fps', PREVIEW_FRAMERATE, type=float), PREVIEW_FRAMERATE)
+    quality = min(max(request.args.get('quality', PREVIEW_QUALITY, type=int), 1), 100)
+    width = request.args.get('width', type=int)
+    # min() passes nan through, and a nan rate would end up in the camera's sleep
+    if not math.isfinite(framerate) or framerate <= 0:
+        framerate = PREVIEW_FRAMERATE
+    # Without a width the camera already encodes at the quality viewers ask for, only a width needs a variant
+    variant = variant_key(width, quality) if width else (None, None)
+    return Response(gen_frame(preview_hub, framerate, quality, request.remote_addr, variant),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+def snapshot_etag(seq, key):
+    return '"%d-%s-%s"' % (seq, key[0] or 'full', key[1] or 'default')
+
+
+def etag_matches(header, etag):
+    """True if an If-None-Match header value lists etag, or is *. Weak tags compare like strong ones here."""
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+@app.route('/snapshot.jpg')
+def snapshot():
+    global preview_hub
+    quality = request.args.get('quality', type=int)
+    key = variant_key(request.args.get('width', type=int) or None,
+                      None if quality is None else min(max(quality, 1), 100))
+    seq, frame = preview_hub.snapshot(key)
+    if frame is None:
+        return Response("No preview frame yet", status=503, mimetype='text/plain')
+    etag = snapshot_etag(seq, key)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers=headers)
+    return Response(frame, mimetype='image/jpeg', headers=headers)
+
+
+@app.route('/sessions')
+def list_sessions():
+    global device_state
+    return jsonify(session_listing(device_state))
+
+
+@app.route('/metrics')
+def metrics():
+    global telemetry
+    # Prometheus text exposition format
+    return Response(telemetry.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/preview_clients')
+def preview_clients():
+    global preview_hub
+    return jsonify(preview_hub.stats())
 
 
 @app.route('/')
@@ -0,0 +1,327 @@
+# Asynchronous web server worker for recording device
+# Serves the same routes and template as webui.py from a single asyncio event loop, so every
+# MJPEG stream, status stream and status poller is a coroutine instead of a thread.
+# Needs an ASGI server (uvicorn) in addition to the Flask dependencies, falls back to webui.py without one.
+
+import asyncio
+import json
+import math
+import mimetypes
+import os
+import time
+from urllib.parse import parse_qs
+
+import jinja2
+
+import webui
+
+WEB_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIRECTORY = os.path.join(WEB_DIRECTORY, "static")
+TEMPLATE_DIRECTORY = os.path.join(WEB_DIRECTORY, "templates")
+
+PREVIEW_FRAMERATE = 1.0
+preview_hub = None
+status_broadcaster = None
+# Set and replaced every time the device state changes, see signal_status_change
+status_changed = None
+event_loop = None
+device_state = None
+telemetry = None
+index_page = None
+static_cache = {}
+
+# Control routes and the state flag each one sets, same as the Flask routes in webui.py
+CONTROL_ROUTES = {
+    '/start_recording': ('should_record', True),
+    '/stop_recording': ('should_record', False),
+    '/shutdown': ('shutdown_requested', True),
+    '/reboot': ('reboot_requested', True),
+    '/mount_sd': ('mount_requested', True),
+}
+
+
+class AsyncPreviewHub(webui.PreviewHub):
+    """PreviewHub whose pump and client waits run as coroutines on the server's event loop"""
+    def start(self):
+        # The pump task is started from the ASGI lifespan handler once the loop is running
+        self.new_frame = None
+        self.wake = None
+
+    async def run(self):
+        print("Started async preview hub task")
+        self.new_frame = asyncio.Event()
+        self.wake = asyncio.Event()
+        poll_interval = 1 / (2 * self.max_framerate)
+        while True:
+            if not self.clients:
+                self.wake.clear()
+                await self.wake.wait()
+            seq, frame = self.ring.read_latest(self.seq)
+            if frame is None:
+                await asyncio.sleep(poll_interval)
+                continue
+            with self.condition:
+                self.seq = seq
+                self.frame = frame
+                self.frame_time = time.monotonic()
+            # Wake every waiting client, later waits use a fresh event
+            new_frame = self.new_frame
+            self.new_frame = asyncio.Event()
+            new_frame.set()
+
+    def add_client(self, framerate, quality, remote=None, variant=(None, None)):
+        client = super().add_client(framerate, quality, remote, variant)
+        if self.wake is not None:
+            self.wake.set()
+        return client
+
+    async def next_frame_async(self, client, timeout=1.0):
+        """Async version of PreviewHub.next_frame"""
+        if self.seq <= client.last_seq:
+            try:
+                await asyncio.wait_for(self.new_frame.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        with self.condition:
+            return self.take_frame(client)
+
+
+def render_index():
+    """Render templates/index.html once, with the Flask url_for('static', ...) calls it uses"""
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIRECTORY), autoescape=True)
+    def url_for(endpoint, filename=None):
+        return F"/{endpoint}/{filename}"
+    return environment.get_template('index.html').render(url_for=url_for).encode()
+
+
+async def send_response(send, status, body, content_type):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200):
+    await send_response(send, status, json.dumps(data).encode(), 'application/json')
+
+
+async def serve_static(send, path):
+    global static_cache
+    if path not in static_cache:
+        full_path = os.path.normpath(os.path.join(STATIC_DIRECTORY, path))
+        if not full_path.startswith(STATIC_DIRECTORY + os.sep) or not os.path.isfile(full_path):
+            await send_response(send, 404, b'Not Found', 'text/plain')
+            return
+        # Static files are small and never change while running, read each one once off the loop
+        loop = asyncio.get_running_loop()
+        with open(full_path, 'rb') as f:
+            body = await loop.run_in_executor(None, f.read)
+        static_cache[path] = (body, mimetypes.guess_type(full_path)[0] or 'application/octet-stream')
+    body, content_type = static_cache[path]
+    await send_response(send, 200, body, content_type)
+
+
+def watch_disconnect(receive):
+    """
+    The server only reports a closed connection through receive(), so watch for it alongside a stream
+    Returns: (event set on disconnect, watcher task to cancel when the stream ends)
+    """
+    disconnected = asyncio.Event()
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+    return disconnected, asyncio.ensure_future(watch())
+
+
+def signal_status_change():
+    global status_changed
+    changed = status_changed
+    status_changed = asyncio.Event()
+    changed.set()
+
+
+def on_status_change():
+    # Called from the broadcaster thread, hand over to the event loop
+    global event_loop
+    event_loop.call_soon_threadsafe(signal_status_change)
+
+
+async def events(scope, receive, send):
+    global status_broadcaster, status_changed
+    disconnected, watcher = watch_disconnect(receive)
+    version = None
+    previous = None
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')],
+        })
+        while not disconnected.is_set():
+            if status_broadcaster.version == version:
+                try:
+                    await asyncio.wait_for(status_changed.wait(), webui.STATUS_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            with status_broadcaster.condition:
+                version, snapshot = status_broadcaster.version, status_broadcaster.snapshot
+            changes = webui.status_changes(previous, snapshot)
+            previous = snapshot
+            body = webui.status_event(changes) if changes else b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        watcher.cancel()
+
+
+async def video_feed(scope, receive, send):
+    global PREVIEW_FRAMERATE, preview_hub
+    params = parse_qs(scope['query_string'].decode())
+    try:
+        framerate = min(float(params.get('fps', [PREVIEW_FRAMERATE])[0]), PREVIEW_FRAMERATE)
+        quality = min(max(int(params.get('quality', [webui.PREVIEW_QUALITY])[0]), 1), 100)
+        width = int(params.get('width', [0])[0])
+    except ValueError:
+        framerate = PREVIEW_FRAMERATE
+        quality = webui.PREVIEW_QUALITY
+        width = 0
+    # min() passes nan through, and a nan rate would end up in the camera's sleep
+    if not math.isfinite(framerate) or framerate <= 0:
+        framerate = PREVIEW_FRAMERATE
+    remote = scope['client'][0] if scope.get('client') else None
+    variant = webui.variant_key(width, quality) if width else (None, None)
+    loop = asyncio.get_running_loop()
+
+    disconnected, watcher = watch_disconnect(receive)
+    client = preview_hub.add_client(framerate, quality, remote, variant)
+    interval = 1 / framerate
+    next_time = time.monotonic()
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame')],
+        })
+        while not disconnected.is_set():
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            frame = await preview_hub.next_frame_async(client)
+            if frame is None:
+                continue
+            next_time = max(next_time + interval, time.monotonic())
+            if variant != (None, None):
+                # Scaling happens on a worker thread, the loop keeps serving other viewers meanwhile
+                frame = await loop.run_in_executor(None, preview_hub.variant, client.last_seq, frame, variant)
+            await send({
+                'type': 'http.response.body',
+                'body': b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n',
+                'more_body': True,
+            })
+    finally:
+        watcher.cancel()
+        preview_hub.remove_client(client)
+
+
+async def snapshot(scope, send):
+    global preview_hub
+    params = parse_qs(scope['query_string'].decode())
+    try:
+        width = int(params.get('width', [0])[0]) or None
+        quality = int(params['quality'][0]) if 'quality' in params else None
+    except ValueError:
+        width, quality = None, None
+    key = webui.variant_key(width, None if quality is None else min(max(quality, 1), 100))
+    # May wait for the camera to wake up and encode, both off the loop
+    seq, frame = await asyncio.get_running_loop().run_in_executor(None, preview_hub.snapshot, key)
+    if frame is None:
+        await send_response(send, 503, b'No preview frame yet', 'text/plain')
+        return
+    etag = webui.snapshot_etag(seq, key)
+    headers = [(b'etag', etag.encode()), (b'cache-control', b'no-cache')]
+    if webui.etag_matches(dict(scope['headers']).get(b'if-none-match', b'').decode('latin-1'), etag):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': headers + [(b'content-type', b'image/jpeg'), (b'content-length', str(len(frame)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': frame})
+
+
+async def lifespan(receive, send):
+    global preview_hub, status_broadcaster, status_changed, event_loop
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            asyncio.ensure_future(preview_hub.run())
+            event_loop = asyncio.get_running_loop()
+            status_changed = asyncio.Event()
+            status_broadcaster.add_listener(on_status_change)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    global device_state, index_page, telemetry
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    path = scope['path']
+    if path == '/':
+        await send_response(send, 200, index_page, 'text/html; charset=utf-8')
+    elif path.startswith('/static/'):
+        await serve_static(send, path[len('/static/'):])
+    elif path == '/video_feed':
+        await video_feed(scope, receive, send)
+    elif path == '/snapshot.jpg':
+        await snapshot(scope, send)
+    elif path == '/status':
+        await send_json(send, device_state.copy())
+    elif path == '/events':
+        await events(scope, receive, send)
+    elif path == '/metrics':
+        await send_response(send, 200, telemetry.prometheus_text().encode(), 'text/plain; version=0.0.4')
+    elif path == '/sessions':
+        # Lists directories and reads small files on the drive, off the loop
+        listing = await asyncio.get_running_loop().run_in_executor(None, webui.session_listing, device_state)
+        await send_json(send, listing)
+    elif path == '/preview_clients':
+        await send_json(send, preview_hub.stats())
+    elif path in CONTROL_ROUTES:
+        key, value = CONTROL_ROUTES[path]
+        device_state[key] = value
+        await send_json(send, device_state.copy())
+    else:
+        await send_response(send, 404, b'Not Found', 'text/plain')
+
+
+def web_worker(preview_framerate, ring, state, telemetry_arg):
+    try:
+        import uvicorn
+    except ImportError:
+        print("uvicorn is not installed, falling back to the Flask web worker")
+        webui.web_worker(preview_framerate, ring, state, telemetry_arg)
+        return
+    print(F"Starting async web worker with preview framerate: {preview_framerate}")
+    global PREVIEW_FRAMERATE, preview_hub, status_broadcaster, device_state, telemetry, index_page
+    PREVIEW_FRAMERATE = preview_framerate
+    device_state = state
+    telemetry = telemetry_arg
+    preview_hub = AsyncPreviewHub(ring, preview_framerate, telemetry)
+    status_broadcaster = webui.StatusBroadcaster(state)
+    webui.start_downloads(state)
+    index_page = render_index()
+    uvicorn.run(app, host='0.0.0.0', port=80, log_level='error', lifespan='on')
+
+
+if __name__ == '__main__':
+    print("This is the async web worker module, and should not be run directly.")
@@ -0,0 +1,295 @@
+"""
+Write-behind output files for segments on USB flash drives.
+
+SegmentFile is the file object MjpegAviWriter writes a segment through.
+Instead of handing every frame to the kernel as it comes, it:
+
+- collects frames in WRITE_BUFFER_SIZE buffers of page aligned memory, so
+  the drive only ever sees large writes that start on a buffer boundary,
+  which is what flash translation layers handle best,
+- preallocates the file PREALLOCATE_STEP bytes at a time ahead of the
+  data, so a segment grows in contiguous extents instead of a cluster at
+  a time between the other files on the drive. Reserving little at a time
+  keeps the drive's free space (and storage.py's write rate and time
+  remaining) moving with the data actually written,
+- with STAGING_SIZE above zero, hands full buffers to one flusher thread
+  shared by all segments, so a slow write on the drive holds up the
+  flusher and not the thread that writes frames. That thread only waits
+  once STAGING_SIZE bytes are waiting for the drive,
+- syncs to the drive according to FSYNC_POLICY.
+
+A SegmentFile takes its buffer on the first write, so the segment the
+rotator opens ahead of time holds no memory and reserves no space until
+it is used.
+
+Preallocation uses fallocate(2) with FALLOC_FL_KEEP_SIZE directly rather
+than os.posix_fallocate, which glibc emulates by writing zeros on
+filesystems without fallocate support (older vfat and exfat drivers), so
+it is skipped there instead of writing zeros. The preallocated space
+beyond the last frame is released on close.
+
+bench.py writeback compares the throughput and write latency against a
+plain buffered file.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import threading
+import time
+
+from telemetry import Telemetry
+
+# Bytes per write to the drive, a multiple of the page size
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Bytes of full buffers of all segments together that may wait for the drive, 0 to write them on the caller's thread
+STAGING_SIZE = 8 * 1024 * 1024
+# Bytes reserved ahead of the data at a time, about 13 seconds of 800x600 MJPEG at 20 fps. 0 to not preallocate.
+PREALLOCATE_STEP = 16 * 1024 * 1024
+# 'none' leaves it to the kernel, 'close' syncs every segment when it is closed,
+# 'interval' also syncs the data written so far every FSYNC_INTERVAL seconds
+FSYNC_POLICY = 'close'
+FSYNC_INTERVAL = 10.0
+
+FALLOC_FL_KEEP_SIZE = 1
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+# fallocate64 takes 64 bit offsets on 32 bit Raspberry Pi OS as well
+fallocate = getattr(libc, 'fallocate64', libc.fallocate)
+fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+fallocate.restype = ctypes.c_int
+
+
+def preallocate(fd, offset, length):
+    """
+    Reserve length bytes from offset for the file without changing its size
+    Returns: True if the filesystem did, False if it does not support it
+    """
+    if fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.EOPNOTSUPP, errno.ENOSYS):
+        return False
+    raise OSError(error, os.strerror(error))
+
+
+def write_all(fd, data, offset):
+    """os.pwrite until everything is written"""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+class Flusher:
+    """Thread that writes the full buffers of every SegmentFile, in the order they were handed over"""
+    def __init__(self, buffer_size=WRITE_BUFFER_SIZE, staging_size=STAGING_SIZE):
+        self.buffer_size = buffer_size
+        # Empty buffers kept for reuse. Files that are being written hold one more each, buffers
+        # coming back beyond the capacity are unmapped.
+        self.capacity = max(1, staging_size // buffer_size)
+        self.free_buffers = [mmap.mmap(-1, buffer_size) for _ in range(self.capacity)]
+        self.condition = threading.Condition()
+        # (SegmentFile, buffer, length, file offset) waiting for the drive
+        self.staged = collections.deque()
+        self.staged_bytes = 0
+        self.thread = threading.Thread(target=self.flush_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stage(self, segment_file, buffer, length, offset, replace=True):
+        """
+        Hand over a buffer to write at offset
+        Returns: an empty buffer to go on with if replace, after waiting while STAGING_SIZE bytes are staged
+        """
+        with self.condition:
+            segment_file.check_error()
+            self.staged.append((segment_file, buffer, length, offset))
+            segment_file.pending += 1
+            self.staged_bytes += length
+            segment_file.staged_gauge.set(self.staged_bytes)
+            self.condition.notify_all()
+            if not replace:
+                return None
+            # Only waits when the staging area is full
+            self.condition.wait_for(lambda: self.free_buffers or segment_file.error is not None)
+            segment_file.check_error()
+            return self.free_buffers.pop()
+
+    def flush_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.staged)
+                segment_file, buffer, length, offset = self.staged[0]
+            error = None
+            if segment_file.error is None:
+                try:
+                    segment_file.flush_buffer(buffer, length, offset)
+                except OSError as e:
+                    print(F"Writing {segment_file.path} failed: {e}")
+                    error = e
+            with self.condition:
+                self.staged.popleft()
+                if error is not None:
+                    segment_file.error = error
+                segment_file.pending -= 1
+                self.staged_bytes -= length
+                segment_file.staged_gauge.set(self.staged_bytes)
+                if len(self.free_buffers) < self.capacity:
+                    self.free_buffers.append(buffer)
+                else:
+                    buffer.close()
+                self.condition.notify_all()
+
+    def wait(self, segment_file):
+        """Block until every buffer segment_file handed over is written"""
+        with self.condition:
+            self.condition.wait_for(lambda: segment_file.pending == 0)
+            segment_file.check_error()
+
+
+shared_flusher = None
+shared_flusher_lock = threading.Lock()
+
+
+def get_flusher():
+    """The Flusher all segments share, started on first use"""
+    global shared_flusher
+    with shared_flusher_lock:
+        if shared_flusher is None:
+            shared_flusher = Flusher()
+        return shared_flusher
+
+
+class SegmentFile:
+    def __init__(self, path, preallocate_step=PREALLOCATE_STEP, write_behind=True, fsync_policy=FSYNC_POLICY,
+                 metrics=None):
+        """
+        Input: path to create, bytes to preallocate at a time (0 for none), False to write full buffers on the
+               caller's thread instead of the shared flusher, the fsync policy as above, telemetry for the flush counters
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.preallocate_step = preallocate_step
+        # End of the space reserved so far
+        self.reserved = 0
+        self.flusher = get_flusher() if write_behind and STAGING_SIZE > 0 else None
+        self.buffer_size = WRITE_BUFFER_SIZE if self.flusher is None else self.flusher.buffer_size
+        self.fsync_policy = fsync_policy
+        if metrics is None:
+            metrics = Telemetry()
+        self.flush_seconds = metrics.metric('segment_flush_seconds')
+        self.staged_gauge = metrics.metric('segment_staged_bytes')
+        # mmap memory is page aligned. Taken on the first write.
+        self.buffer = None
+        self.fill = 0
+        # File offset the current buffer starts at, and the end of everything written so far
+        self.buffer_offset = 0
+        self.size = 0
+        self.last_sync = time.monotonic()
+        self.error = None
+        # Buffers handed to the flusher that it has not written yet, guarded by the flusher's condition
+        self.pending = 0
+        # Position for writes after seek(), which go straight to the file
+        self.patch_offset = None
+
+    def write(self, data):
+        """Append bytes, or overwrite them after a seek(). Returns the number of bytes written."""
+        length = len(data)
+        if self.patch_offset is not None:
+            self.drain()
+            write_all(self.fd, data, self.patch_offset)
+            self.patch_offset += length
+            self.size = max(self.size, self.patch_offset)
+            return length
+        if self.buffer is None:
+            self.buffer = mmap.mmap(-1, self.buffer_size)
+        view = memoryview(data)
+        while view:
+            count = min(len(view), self.buffer_size - self.fill)
+            self.buffer[self.fill:self.fill + count] = view[:count]
+            self.fill += count
+            view = view[count:]
+            if self.fill == self.buffer_size:
+                self.hand_off()
+        return length
+
+    def hand_off(self):
+        """Send the current buffer to the drive, or to the flusher thread, and start the next one"""
+        buffer, length, offset = self.buffer, self.fill, self.buffer_offset
+        self.buffer_offset += length
+        self.fill = 0
+        if self.flusher is None:
+            self.flush_buffer(buffer, length, offset)
+        else:
+            self.buffer = self.flusher.stage(self, buffer, length, offset)
+
+    def flush_buffer(self, buffer, length, offset):
+        start = time.monotonic()
+        if self.preallocate_step and offset + length > self.reserved:
+            self.reserve(offset + length)
+        write_all(self.fd, memoryview(buffer)[:length], offset)
+        self.flush_seconds.observe(time.monotonic() - start)
+        if self.fsync_policy == 'interval' and time.monotonic() - self.last_sync >= FSYNC_INTERVAL:
+            os.fdatasync(self.fd)
+            self.last_sync = time.monotonic()
+
+    def reserve(self, end):
+        """Preallocate up to the next PREALLOCATE_STEP boundary past end"""
+        reserved = (end // self.preallocate_step + 1) * self.preallocate_step
+        if preallocate(self.fd, self.reserved, reserved - self.reserved):
+            self.reserved = reserved
+        else:
+            # Not supported on this filesystem
+            self.preallocate_step = 0
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def drain(self):
+        """Write the partly filled buffer and wait until the flusher has written everything"""
+        if self.fill:
+            length, offset = self.fill, self.buffer_offset
+            self.buffer_offset += length
+            self.fill = 0
+            if self.flusher is None:
+                self.flush_buffer(self.buffer, length, offset)
+            else:
+                # A partial buffer goes last, a later write takes a new one
+                self.flusher.stage(self, self.buffer, length, offset, replace=False)
+                self.buffer = None
+        if self.flusher is not None:
+            self.flusher.wait(self)
+        self.size = max(self.size, self.buffer_offset)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Only absolute seeks, used to patch headers once the data is written"""
+        if whence != os.SEEK_SET:
+            raise ValueError("SegmentFile only seeks to absolute offsets")
+        self.patch_offset = offset
+        return offset
+
+    def tell(self):
+        return self.patch_offset if self.patch_offset is not None else self.buffer_offset + self.fill
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.drain()
+        finally:
+            if self.reserved > self.size:
+                # Give back the space reserved beyond the last byte
+                os.ftruncate(self.fd, self.size)
+            if self.fsync_policy != 'none':
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            if self.buffer is not None:
+                self.buffer.close()
+                self.buffer = None